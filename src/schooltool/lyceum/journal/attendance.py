@@ -0,0 +1,265 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Compact attendance storage.
+"""
+import calendar
+import datetime
+from array import array
+
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree
+from ZODB.POSException import ConflictError
+
+from schooltool.requirement.evaluation import Evaluation
+
+
+NO_MARK = 0
+
+EMPTY_CELL = (NO_MARK, 0, 0)
+
+
+def getCells(state):
+    """Return a dict of (student id, meeting key): (code, evaluator, time)."""
+    cells = {}
+    for student_id, row in state['students'].items():
+        codes = state['codes'][row]
+        evaluator_codes = state['evaluator_codes'][row]
+        times = state['times'][row]
+        for meeting_key, col in state['meetings'].items():
+            cells[student_id, meeting_key] = (
+                codes[col], evaluator_codes[col], times[col])
+    return cells
+
+
+def mergeTable(old, new, merged):
+    """Append entries new added to the old table to the merged table.
+
+    Returns a list that maps codes of the new table to the merged one.
+    Entries of the old table keep their codes, as tables only grow.
+    """
+    codes = range(len(old))
+    for entry in new[len(old):]:
+        codes.append(len(merged))
+        merged.append(entry)
+    return codes
+
+
+class AttendanceBucket(Persistent):
+    """Attendance marks of a section for one month.
+
+    Marks are kept in arrays of codes, one array per student slot,
+    indexed by meeting slot.  A code refers to a (score system, value)
+    pair in the score table, NO_MARK meaning that nothing was recorded.
+    Evaluators and evaluation times are kept in parallel arrays.  Marks
+    that were changed are kept in the history, as tuples of (student
+    id, meeting key, code, evaluator code, time).
+    """
+
+    history = None
+
+    def __init__(self):
+        self.students = {}
+        self.meetings = {}
+        self.scores = [None]
+        self.evaluators = [None]
+        self.codes = []
+        self.evaluator_codes = []
+        self.times = []
+
+    def _code(self, table, entry):
+        try:
+            return table.index(entry)
+        except ValueError:
+            table.append(entry)
+            return len(table) - 1
+
+    def _studentSlot(self, student_id):
+        slot = self.students.get(student_id)
+        if slot is None:
+            slot = self.students[student_id] = len(self.codes)
+            size = len(self.meetings)
+            self.codes.append(array('H', [NO_MARK] * size))
+            self.evaluator_codes.append(array('H', [0] * size))
+            self.times.append(array('l', [0] * size))
+        return slot
+
+    def _meetingSlot(self, meeting_key):
+        slot = self.meetings.get(meeting_key)
+        if slot is None:
+            slot = self.meetings[meeting_key] = len(self.meetings)
+            for rows in (self.codes, self.evaluator_codes, self.times):
+                for row in rows:
+                    row.append(0)
+        return slot
+
+    def get(self, student_id, meeting_key):
+        """Return (score system, value, evaluator, time) of a mark.
+
+        Returns None if nothing was recorded.
+        """
+        row = self.students.get(student_id)
+        col = self.meetings.get(meeting_key)
+        if row is None or col is None:
+            return None
+        code = self.codes[row][col]
+        if code == NO_MARK:
+            return None
+        return self._mark(code, self.evaluator_codes[row][col],
+                          self.times[row][col])
+
+    def _mark(self, code, evaluator_code, time):
+        score_system, value = self.scores[code]
+        evaluator = self.evaluators[evaluator_code]
+        time = datetime.datetime.utcfromtimestamp(time)
+        return score_system, value, evaluator, time
+
+    def getHistory(self, student_id, meeting_key):
+        """Return a list of changed marks of a cell, oldest first."""
+        return [self._mark(code, evaluator_code, time)
+                for (entry_student_id, entry_meeting_key, code,
+                     evaluator_code, time) in self.history or ()
+                if (entry_student_id == student_id and
+                    entry_meeting_key == meeting_key)]
+
+    def set(self, student_id, meeting_key, score_system, value,
+            evaluator=None, time=None):
+        if time is None:
+            time = datetime.datetime.utcnow()
+        row = self._studentSlot(student_id)
+        col = self._meetingSlot(meeting_key)
+        if self.codes[row][col] != NO_MARK:
+            if self.history is None:
+                self.history = []
+            self.history.append((student_id, meeting_key,
+                                 self.codes[row][col],
+                                 self.evaluator_codes[row][col],
+                                 self.times[row][col]))
+        self.codes[row][col] = self._code(self.scores, (score_system, value))
+        self.evaluator_codes[row][col] = self._code(self.evaluators, evaluator)
+        self.times[row][col] = calendar.timegm(time.utctimetuple())
+        self._p_changed = True
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        """Merge concurrent changes of different marks.
+
+        Marks changed in both transactions are a conflict.
+        """
+        old_cells = getCells(oldState)
+        saved_cells = getCells(savedState)
+        scores = list(savedState['scores'])
+        evaluators = list(savedState['evaluators'])
+        score_codes = mergeTable(oldState['scores'], newState['scores'],
+                                 scores)
+        evaluator_codes = mergeTable(oldState['evaluators'],
+                                     newState['evaluators'], evaluators)
+        cells = dict(saved_cells)
+        for key, cell in getCells(newState).items():
+            old = old_cells.get(key, EMPTY_CELL)
+            if cell == old:
+                continue
+            if saved_cells.get(key, EMPTY_CELL) != old:
+                raise ConflictError
+            code, evaluator_code, time = cell
+            cells[key] = (score_codes[code], evaluator_codes[evaluator_code],
+                          time)
+
+        history = list(savedState.get('history') or ())
+        old_history = oldState.get('history') or ()
+        new_history = newState.get('history') or ()
+        for (student_id, meeting_key, code, evaluator_code,
+             time) in new_history[len(old_history):]:
+            history.append((student_id, meeting_key, score_codes[code],
+                            evaluator_codes[evaluator_code], time))
+
+        students = dict(savedState['students'])
+        meetings = dict(savedState['meetings'])
+        for student_id, meeting_key in cells:
+            if student_id not in students:
+                students[student_id] = len(students)
+            if meeting_key not in meetings:
+                meetings[meeting_key] = len(meetings)
+        size = len(meetings)
+        state = dict(savedState)
+        state.update({
+            'students': students,
+            'meetings': meetings,
+            'scores': scores,
+            'evaluators': evaluators,
+            'codes': [array('H', [NO_MARK] * size) for row in students],
+            'evaluator_codes': [array('H', [0] * size) for row in students],
+            'times': [array('l', [0] * size) for row in students],
+            })
+        if history:
+            state['history'] = history
+        for (student_id, meeting_key), cell in cells.items():
+            row = students[student_id]
+            col = meetings[meeting_key]
+            (state['codes'][row][col], state['evaluator_codes'][row][col],
+             state['times'][row][col]) = cell
+        return state
+
+
+def makeEvaluation(requirement, mark):
+    score_system, value, evaluator, time = mark
+    evaluation = Evaluation(requirement, score_system, value,
+                            evaluator=evaluator)
+    evaluation.time = time
+    return evaluation
+
+
+class AttendanceStorage(Persistent):
+    """Attendance marks of a section, in one bucket per month."""
+
+    def __init__(self):
+        self.buckets = OOBTree()
+
+    def getBucket(self, date, create=False):
+        key = (date.year, date.month)
+        bucket = self.buckets.get(key)
+        if bucket is None and create:
+            bucket = self.buckets[key] = AttendanceBucket()
+        return bucket
+
+    def get(self, student_id, requirement):
+        """Return the evaluation of a requirement or None."""
+        bucket = self.getBucket(requirement.date)
+        if bucket is None:
+            return None
+        mark = bucket.get(student_id, (requirement.date, requirement.meeting_id))
+        if mark is None:
+            return None
+        return makeEvaluation(requirement, mark)
+
+    def getHistory(self, student_id, requirement):
+        """Return a list of changed evaluations of a requirement.
+
+        Evaluations are ordered from the oldest one.
+        """
+        bucket = self.getBucket(requirement.date)
+        if bucket is None:
+            return []
+        marks = bucket.getHistory(student_id, (requirement.date,
+                                               requirement.meeting_id))
+        return [makeEvaluation(requirement, mark) for mark in marks]
+
+    def set(self, student_id, requirement, score_system, value,
+            evaluator=None):
+        bucket = self.getBucket(requirement.date, create=True)
+        bucket.set(student_id, (requirement.date, requirement.meeting_id),
+                   score_system, value, evaluator=evaluator)
@@ -0,0 +1,101 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Collation keys cached per locale.
+"""
+from zope.component import getUtility
+from zope.i18n.interfaces.locales import ICollator
+from zope.security.proxy import removeSecurityProxy
+
+from schooltool.person.interfaces import IPersonFactory
+
+
+_collators = {}
+
+
+def getPersonSerial(person):
+    """Serial of the last change of a person, loading it if needed.
+
+    Ghosts do not know their serial until they are loaded.
+    """
+    person = removeSecurityProxy(person)
+    activate = getattr(person, '_p_activate', None)
+    if activate is not None:
+        activate()
+    return getattr(person, '_p_serial', None)
+
+
+class CachingCollator(object):
+    """A collator that remembers collation keys.
+
+    Keys of strings never change.  Sorting keys of persons are cached
+    by username and the serial of the last stored change of the person,
+    so they are computed again after the person is edited.
+    """
+
+    max_size = 50000
+
+    def __init__(self, collator):
+        self.collator = collator
+        self.keys = {}
+        self.person_keys = {}
+
+    def _remember(self, cache, key, value):
+        if len(cache) >= self.max_size:
+            cache.clear()
+        cache[key] = value
+        return value
+
+    def key(self, text):
+        try:
+            return self.keys[text]
+        except KeyError:
+            return self._remember(self.keys, text, self.collator.key(text))
+
+    def cmp(self, text1, text2):
+        return cmp(self.key(text1), self.key(text2))
+
+    def computePersonKey(self, person, sort_by=None):
+        if sort_by == 'last_name':
+            return (self.key(person.last_name), self.key(person.first_name))
+        elif sort_by == 'first_name':
+            return (self.key(person.first_name), self.key(person.last_name))
+        factory = getUtility(IPersonFactory)
+        return factory.getSortingKey(person, self)
+
+    def personKey(self, person, sort_by=None):
+        """Sorting key of a person, by last or first name or the default."""
+        person = removeSecurityProxy(person)
+        serial = getPersonSerial(person)
+        if serial is None:
+            return self.computePersonKey(person, sort_by)
+        cache_key = (sort_by, person.__name__, serial)
+        try:
+            return self.person_keys[cache_key]
+        except KeyError:
+            return self._remember(self.person_keys, cache_key,
+                                  self.computePersonKey(person, sort_by))
+
+
+def getCollator(locale):
+    """Return the caching collator of a locale."""
+    locale_id = (locale.id.language, locale.id.territory, locale.id.variant)
+    collator = _collators.get(locale_id)
+    if collator is None:
+        collator = _collators[locale_id] = CachingCollator(ICollator(locale))
+    return collator
@@ -19,12 +19,19 @@
 Lyceum journal views.
 """
 import calendar
+import csv
+import hashlib
 import pytz
 import urllib
 import base64
 import xlwt
 import datetime
+import transaction
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from cStringIO import StringIO
 from dateutil.parser import parse
+from BTrees.IIBTree import intersection, multiunion
+from ZODB.POSException import ConflictError
 
 from zope.security.proxy import removeSecurityProxy
 from zope.security import checkPermission
@@ -33,11 +40,13 @@ from zope.viewlet.interfaces import IViewlet
 from zope.viewlet.viewlet import CSSViewlet
 from zope.exceptions.interfaces import UserError
 from zope.publisher.browser import BrowserView
+from zope.publisher.interfaces.http import IResult
+from zope.app.publication.zopepublication import ZopePublication
+from zope.component.hooks import getSite, setSite
 from zope.browserpage.viewpagetemplatefile import ViewPageTemplateFile
 from zope.formlib.widget import quoteattr
 from zope.component import queryMultiAdapter
 from zope.i18n import translate
-from zope.i18n.interfaces.locales import ICollator
 from zope.interface import implements
 from zope.intid.interfaces import IIntIds
 from zope.traversing.browser.absoluteurl import absoluteURL
@@ -65,7 +74,6 @@ from schooltool.app.browser.cal import month_names
 from schooltool.app.interfaces import IApplicationPreferences
 from schooltool.app.interfaces import ISchoolToolApplication
 from schooltool.app.interfaces import ISchoolToolCalendar
-from schooltool.app.relationships import Instruction
 from schooltool.app.interfaces import IRelationshipStateContainer
 from schooltool.app.membership import Membership
 from schooltool.app.states import ACTIVE
@@ -78,13 +86,11 @@ from schooltool.course.interfaces import ISectionContainer
 from schooltool.report.browser.report import RequestRemoteReportDialog
 from schooltool.requirement.scoresystem import ScoreValidationError
 from schooltool.requirement.scoresystem import UNSCORED
-from schooltool.requirement.interfaces import IEvaluations
 from schooltool.term.interfaces import ITerm
 from schooltool.term.interfaces import ITermContainer
 from schooltool.term.interfaces import IDateManager
 from schooltool.table.interfaces import ITableFormatter, IIndexedTableFormatter
 from schooltool.timetable.interfaces import IScheduleContainer
-from schooltool.timetable.calendar import ScheduleCalendarEvent
 from schooltool.resource.interfaces import ILocation
 from schooltool.schoolyear.interfaces import ISchoolYearContainer
 from schooltool.schoolyear.interfaces import ISchoolYear
@@ -98,10 +104,26 @@ from schooltool.lyceum.journal.journal import getCurrentEnrollmentMode
 from schooltool.lyceum.journal.journal import setCurrentEnrollmentMode
 from schooltool.lyceum.journal.journal import JournalPDFReportTask
 from schooltool.lyceum.journal.journal import JournalXLSReportTask
+from schooltool.lyceum.journal.journal import JournalXLSXReportTask
+from schooltool.lyceum.journal.journal import XLSXReportTask
 from schooltool.lyceum.journal.journal import PersistentAttendanceScoreSystem
 from schooltool.lyceum.journal.journal import GradeRequirement
 from schooltool.lyceum.journal.journal import AttendanceRequirement
 from schooltool.lyceum.journal.journal import HomeroomRequirement
+from schooltool.lyceum.journal.journal import countScores
+from schooltool.lyceum.journal.journal import getMeetingIndex
+from schooltool.lyceum.journal.journal import getSectionMemberNames
+from schooltool.lyceum.journal.journal import getStudentIndex
+from schooltool.lyceum.journal.journal import ATTENDANCE_TAGS
+from schooltool.lyceum.journal.journal import ATTENDANCE_TYPES
+from schooltool.lyceum.journal.journal import getSchoolDayCalendar
+from schooltool.lyceum.journal.journal import makeSchoolAttendanceMeeting
+from schooltool.lyceum.journal.dataexport import CLEARED
+from schooltool.lyceum.journal.dataexport import JournalExportEngine
+from schooltool.lyceum.journal.dataexport import RECORD_FIELDS
+from schooltool.lyceum.journal.dataexport import ParallelJournalExport
+from schooltool.lyceum.journal.xlsx import XLSXWorkbook
+from schooltool.lyceum.journal.xlsx import XLSXWorksheet
 from schooltool.lyceum.journal.interfaces import IAttendanceScoreSystem
 from schooltool.lyceum.journal.interfaces import IEvaluateRequirement
 from schooltool.lyceum.journal.interfaces import ISectionJournal
@@ -109,6 +131,7 @@ from schooltool.lyceum.journal.interfaces import ISectionJournalData
 from schooltool.lyceum.journal.interfaces import IJournalScoreSystemPreferences
 from schooltool.lyceum.journal.browser.interfaces import IIndependentColumn
 from schooltool.lyceum.journal.browser.interfaces import ISelectableColumn
+from schooltool.lyceum.journal.browser.collation import getCollator
 from schooltool.lyceum.journal.browser.table import SelectStudentCellFormatter
 from schooltool.lyceum.journal.browser.table import SelectableRowTableFormatter
 from schooltool.lyceum.journal import LyceumMessage as _
@@ -124,13 +147,6 @@ def getEvaluator(request):
     return user.__name__
 
 
-def makeSchoolAttendanceMeeting(date):
-    uid = '%s' % date.isoformat()
-    dt = datetime.datetime(date.year, date.month, date.day)
-    meeting = ScheduleCalendarEvent(dt, datetime.timedelta(1), '', unique_id=uid)
-    return meeting
-
-
 class SectionFinder(object):
 
     def getFromYear(self, sections, active):
@@ -216,6 +232,26 @@ class GradesColumn(object):
                 grades.append(score)
         return grades
 
+    def getGradeCounts(self, person):
+        """Get (score, count) of grades of the person in the term."""
+        counts = None
+        if ISectionJournal.providedBy(self.journal):
+            counts = self.journal.getScoreCounts(
+                person, GradeRequirement, term=self.term)
+        if counts is None:
+            counts = countScores(self.getGrades(person))
+        return counts
+
+    def getAbsenceCounts(self, person):
+        """Get (score, count) of absences of the person in the term."""
+        counts = None
+        if ISectionJournal.providedBy(self.journal):
+            counts = self.journal.getScoreCounts(
+                person, AttendanceRequirement, term=self.term)
+        if counts is None:
+            counts = countScores(self.getAbsences(person))
+        return counts
+
 
 class PersonGradesColumn(GradesColumn):
     implements(ISelectableColumn, IIndependentColumn)
@@ -346,20 +382,19 @@ class SectionTermAverageGradesColumn(GradesColumn):
         self.journal = journal
 
     def renderCell(self, person, formatter):
-        grades = []
-        for score in self.getGrades(person):
-            grade = score.value
-            if grade is UNSCORED:
-                continue
+        total = 0
+        count = 0
+        for score, score_count in self.getGradeCounts(person):
             try:
-                grade = score.scoreSystem.getNumericalValue(grade)
+                grade = score.scoreSystem.getNumericalValue(score.value)
             except KeyError:
                 continue
-            grades.append(grade)
-        if not grades:
+            total += grade * score_count
+            count += score_count
+        if not count:
             return ""
         else:
-            return "%.3f" % (float(sum(grades)) / float(len(grades)))
+            return "%.3f" % (float(total) / float(count))
 
     def renderHeader(self, formatter):
         return '<span>%s</span>' % translate(_("Average"),
@@ -376,10 +411,10 @@ class SectionTermAttendanceColumn(GradesColumn):
 
     def renderCell(self, person, formatter):
         absences = 0
-        for score in self.getAbsences(person):
+        for score, count in self.getAbsenceCounts(person):
             if (IAttendanceScoreSystem.providedBy(score.scoreSystem) and
                 score.scoreSystem.isAbsent(score)):
-                absences += 1
+                absences += count
         if absences == 0:
             return ""
         else:
@@ -400,10 +435,10 @@ class SectionTermTardiesColumn(GradesColumn):
 
     def renderCell(self, person, formatter):
         tardies = 0
-        for score in self.getAbsences(person):
+        for score, count in self.getAbsenceCounts(person):
             if (IAttendanceScoreSystem.providedBy(score.scoreSystem) and
                 score.scoreSystem.isTardy(score)):
-                tardies += 1
+                tardies += count
         if tardies == 0:
             return ""
         else:
@@ -424,17 +459,16 @@ class SectionTermExcusedColumn(GradesColumn):
     def renderCell(self, person, formatter):
         excusable = 0
         excused = 0
-        for score in self.getAbsences(person):
-            if (score.value is UNSCORED or
-                not IAttendanceScoreSystem.providedBy(score.scoreSystem)):
+        for score, count in self.getAbsenceCounts(person):
+            if not IAttendanceScoreSystem.providedBy(score.scoreSystem):
                 continue
             ss = score.scoreSystem
             if (ss.isAbsent(score) or
                 ss.isTardy(score) or
                 ss.isExcused(score)):
-                excusable += 1
+                excusable += count
             if ss.isExcused(score):
-                excused += 1
+                excused += count
         if excusable == 0:
             return ""
         else:
@@ -514,25 +548,24 @@ class LyceumSectionJournalView(StudentSelectionMixin):
         kwargs['selected_items'] = self.selected_students
         return SelectableRowTableFormatter(*args, **kwargs)
 
+    @Lazy
+    def meeting_index(self):
+        return getMeetingIndex(self.context.section, self.timezone)
+
+    def meetingStart(self, meeting):
+        """Start of a meeting in the application timezone."""
+        return self.meeting_index.localStart(removeSecurityProxy(meeting))
+
     def isJournalMeeting(self, term, meeting):
-        starts = meeting.dtstart.astimezone(self.timezone)
-        return starts.date() in term
+        return self.meetingStart(meeting).date() in term
 
     def allMeetings(self):
         term = removeSecurityProxy(self.selected_term)
         if not term:
             return ()
-
-        # maybe expand would be better in here
-        by_uid = dict([(removeSecurityProxy(e).unique_id, e)
-                       for e in self.context.meetings])
-
-        insecure_events = [removeSecurityProxy(e)
-                           for e in by_uid.values()]
-        insecure_events[:] = filter(lambda e: self.isJournalMeeting(term, e),
-                                    insecure_events)
-        meetings = [by_uid[e.unique_id] for e in sorted(insecure_events)]
-        return meetings
+        return [meeting
+                for meeting in self.meeting_index.getTermMeetings(term)
+                if self.isJournalMeeting(term, meeting)]
 
     @Lazy
     def all_meetings(self):
@@ -540,9 +573,7 @@ class LyceumSectionJournalView(StudentSelectionMixin):
 
     def meetings(self):
         for event in self.all_meetings:
-            insecure_event = removeSecurityProxy(event)
-            meeting_start = insecure_event.dtstart.astimezone(self.timezone)
-            if meeting_start.month == self.active_month:
+            if self.meetingStart(event).month == self.active_month:
                 yield event
 
     def members(self):
@@ -635,8 +666,7 @@ class LyceumSectionJournalView(StudentSelectionMixin):
     def monthsInSelectedTerm(self):
         month = -1
         for meeting in self.all_meetings:
-            insecure_meeting = removeSecurityProxy(meeting)
-            meeting_start = insecure_meeting.dtstart.astimezone(self.timezone)
+            meeting_start = self.meetingStart(meeting)
             if meeting_start.month != month:
                 yield meeting_start.month
                 month = meeting_start.month
@@ -676,8 +706,7 @@ class LyceumSectionJournalView(StudentSelectionMixin):
             selected_month = available_months[0]
 
         for meeting in self.all_meetings:
-            insecure_meeting = removeSecurityProxy(meeting)
-            meeting_start = insecure_meeting.dtstart.astimezone(self.timezone)
+            meeting_start = self.meetingStart(meeting)
             if meeting_start.month == selected_month:
                 return meeting_start.year
 
@@ -747,7 +776,7 @@ class SectionListView(BrowserView):
                 results.append({'title': removeSecurityProxy(section).title,
                                 'url': url})
 
-        collator = ICollator(self.request.locale)
+        collator = getCollator(self.request.locale)
         results.sort(key=lambda s: collator.key(s['title']))
         return results
 
@@ -812,8 +841,96 @@ class StudentGradebookTabViewlet(object):
         return bool(list(ILearner(person).sections()))
 
 
+def getTodayMembershipStates(section):
+    """Today's (meaning, code) membership states of all section members.
+
+    Returns a dict keyed by members, built from a single relationship
+    query of the section.
+    """
+    states = {}
+    relationships = Membership.bind(group=section).all().relationships
+    for link_info in relationships:
+        states[removeSecurityProxy(link_info.target)] = link_info.state.today
+    return states
+
+
+class JournalGrid(object):
+    """Students, meetings, values, hints and score counts of a journal.
+
+    Everything is gathered in batches when the grid is built, rows are
+    emitted from the gathered data afterwards.
+    """
+
+    def __init__(self, students, active, meetings, values, hints, counts):
+        self.students = students
+        self.active = active
+        self.meetings = meetings
+        self.values = values
+        self.hints = hints
+        self.counts = counts
+
+    def isActive(self, student):
+        return self.active is None or student in self.active
+
+    def __iter__(self):
+        return iter(zip(self.students, self.values, self.hints, self.counts))
+
+
+class ConditionalGetMixin(object):
+    """Answers conditional GET requests with 304 Not Modified.
+
+    The ETag is a hash of a stamp of everything the view shows.
+    If-Modified-Since is only checked for requests without
+    If-None-Match.
+    """
+
+    def getCacheStamp(self):
+        """Return a stamp of the view contents, or None to not cache."""
+        return None
+
+    def getLastModified(self):
+        return None
+
+    def isNotModified(self):
+        """Set validators of the response, check those of the request."""
+        if self.request.method not in ('GET', 'HEAD'):
+            return False
+        stamp = self.getCacheStamp()
+        if stamp is None:
+            return False
+        etag = '"%s"' % hashlib.md5(repr(stamp)).hexdigest()
+        response = self.request.response
+        response.setHeader('ETag', etag)
+        response.setHeader('Cache-Control', 'private, no-cache')
+        last_modified = self.getLastModified()
+        if last_modified is not None:
+            response.setHeader(
+                'Last-Modified',
+                formatdate(calendar.timegm(last_modified.utctimetuple()),
+                           usegmt=True))
+        if_none_match = self.request.getHeader('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            if etag not in tags and '*' not in tags:
+                return False
+        else:
+            if_modified_since = self.request.getHeader('If-Modified-Since')
+            if not if_modified_since or last_modified is None:
+                return False
+            since = parsedate_tz(if_modified_since)
+            if since is None:
+                return False
+            modified = calendar.timegm(last_modified.utctimetuple())
+            if modified > mktime_tz(since):
+                return False
+        response.setStatus(304)
+        return True
+
+
 class FlourishLyceumSectionJournalBase(flourish.page.WideContainerPage,
-                                       LyceumSectionJournalView):
+                                       LyceumSectionJournalView,
+                                       ConditionalGetMixin):
     no_timetable = False
     no_periods = False
     render_journal = True
@@ -821,10 +938,55 @@ class FlourishLyceumSectionJournalBase(flourish.page.WideContainerPage,
 
     no_periods_text = _("No periods have been assigned in timetables of this section.")
 
+    requirement_factory = None
+
     def __init__(self, *args, **kw):
         self._grade_cache = {}
+        self._score_system_cache = {}
         super(FlourishLyceumSectionJournalBase, self).__init__(*args, **kw)
 
+    def __call__(self, *args, **kw):
+        if self.isNotModified():
+            return ''
+        self.updateCurrentJournal()
+        return super(FlourishLyceumSectionJournalBase, self).__call__(
+            *args, **kw)
+
+    @Lazy
+    def change_stamps(self):
+        """Stamps of changes of evaluations, members and meetings."""
+        jc = ISchoolToolApplication(None)['schooltool.lyceum.journal']
+        section = removeSecurityProxy(self.context.section)
+        int_id = getUtility(IIntIds).getId(section)
+        return (self.journal_data.getChangeStamp(),
+                jc.getChangeStamp(),
+                jc.getMembersStamp(int_id),
+                jc.getSectionMeetingsStamp(section))
+
+    def getCacheStamp(self):
+        person = IPerson(self.request.principal, None)
+        enrollment_mode = None
+        if person is not None:
+            enrollment_mode = getCurrentEnrollmentMode(person)
+        prefs = IJournalScoreSystemPreferences(self.context)
+        ss = self.getDefaultScoreSystem()
+        return (self.journal_mode,
+                self.change_stamps,
+                self.request.principal.id,
+                self.request.get('QUERY_STRING', ''),
+                str(self.request.locale.id.language),
+                getUtility(IDateManager).today,
+                enrollment_mode,
+                getattr(prefs, '_p_serial', None),
+                getattr(ss, '_p_serial', None))
+
+    def getLastModified(self):
+        journal, school, members, meetings = self.change_stamps
+        times = [time for count, time in (journal, school, members)
+                 if time is not None]
+        if times:
+            return max(times)
+
     @property
     def page_class(self):
         if self.render_journal:
@@ -857,32 +1019,37 @@ class FlourishLyceumSectionJournalBase(flourish.page.WideContainerPage,
             self.render_journal = False
             return
 
-        person = IPerson(self.request.principal, None)
-        if person is not None:
-            setCurrentSectionTaught(person, self.context.section)
-
-        self.updateJournalMode()
         if 'UPDATE_SUBMIT' in self.request:
             self.updateGradebook()
 
         app = ISchoolToolApplication(None)
         self.tzinfo = pytz.timezone(IApplicationPreferences(app).timezone)
 
+    def updateCurrentJournal(self):
+        """Remember the section and the journal mode the user is in.
+
+        Not done when answering with 304 Not Modified, the page was
+        shown and remembered before.
+        """
+        if (not IScheduleContainer(self.context.section) or
+            not self.all_meetings):
+            return
+        person = IPerson(self.request.principal, None)
+        if person is not None:
+            setCurrentSectionTaught(person, self.context.section)
+        self.updateJournalMode()
+
     @Lazy
     def activities(self):
         result = []
-        scores = None
-        ss = self.getDefaultScoreSystem()
-        if ss is not None:
-            scores = self.getJSONScores(ss)
+        scores = self.json_scores
         for meeting in self.meetings:
             info = {
                 'hash': meeting.__name__,
                 'cssClass': 'scorable',
                 'scores': scores,
                 }
-            insecure_meeting = removeSecurityProxy(meeting)
-            meetingDate = insecure_meeting.dtstart.astimezone(self.tzinfo).date()
+            meetingDate = self.meetingStart(meeting).date()
             info['shortTitle'] = meetingDate.strftime("%d")
             info['longTitle'] = meetingDate.strftime("%Y-%m-%d")
             try:
@@ -902,6 +1069,20 @@ class FlourishLyceumSectionJournalBase(flourish.page.WideContainerPage,
     def getDefaultScoreSystem(self):
         return None
 
+    def getScoreOptions(self, scoresystem):
+        return []
+
+    def getJSONScores(self, scoresystem):
+        encoder = flourish.tal.JSONEncoder()
+        return encoder.encode(self.getScoreOptions(scoresystem))
+
+    @Lazy
+    def json_scores(self):
+        """Score options of the columns of the grid, encoded once."""
+        ss = self.getDefaultScoreSystem()
+        if ss is not None:
+            return self.getJSONScores(ss)
+
     def makeRequirement(self, meeting):
         return None
 
@@ -929,41 +1110,99 @@ class FlourishLyceumSectionJournalBase(flourish.page.WideContainerPage,
     def meetings(self):
         result = []
         for event in self.all_meetings:
-            insecure_event = removeSecurityProxy(event)
-            meeting_start = insecure_event.dtstart.astimezone(self.timezone)
-            if meeting_start.month == self.active_month:
+            if self.meetingStart(event).month == self.active_month:
                 result.append(event)
         return result
 
+    def getActivityScoreSystem(self, activity_id):
+        """Score system of a meeting column or None if not known."""
+        cache = self._score_system_cache
+        if activity_id not in cache:
+            score_system = None
+            meeting = None
+            if activity_id is not None:
+                meeting = self.meeting_index.getMeeting(activity_id)
+            if meeting is not None:
+                requirement = self.makeRequirement(meeting)
+                if requirement is not None:
+                    score_system = requirement.score_system
+            cache[activity_id] = score_system
+        return cache[activity_id]
+
+    def isValidScore(self, activity_id, score):
+        score_system = self.getActivityScoreSystem(activity_id)
+        if (score_system is None or
+            not score or not score.strip()):
+            return True
+        return score_system.isValidScore(score)
+
     def validate_score(self, activity_id=None, score=None):
         """Intended to be used from AJAX calls."""
         if score is None:
             score = self.request.get('score')
         if activity_id is None:
             activity_id = self.request.get('activity_id')
-        result = {'is_valid': True,
+        result = {'is_valid': self.isValidScore(activity_id, score),
                   'is_extracredit': False}
 
-        meeting = None
-        meetings = dict([(meeting.__name__, meeting)
-                         for meeting in self.context.meetings])
-        if activity_id is not None and activity_id in meetings:
-            meeting = meetings[activity_id]
-        if (meeting is not None and
-            score and score.strip()):
-            requirement = self.makeRequirement(meeting)
-            if requirement is not None:
-                result['is_valid'] = requirement.score_system.isValidScore(score)
-
         response = self.request.response
         response.setHeader('Content-Type', 'application/json')
         encoder = flourish.tal.JSONEncoder()
         json = encoder.encode(result)
         return json
 
+    @Lazy
+    def journal_data(self):
+        section = removeSecurityProxy(self.context.section)
+        return ISectionJournalData(section)
+
+    @Lazy
+    def member_usernames(self):
+        return getSectionMemberNames(self.context.section)
+
+    @Lazy
+    def calendar_meetings(self):
+        return self.journal_data.getCalendarMeetings()
+
+    @property
+    def requirements(self):
+        return self.journal_data.requirements
+
     def getScores(self, person):
         if person in self._grade_cache:
             return list(self._grade_cache[person])
+        factory = self.requirement_factory
+        if (factory is None or
+            not self.journal_data.isIndexed(factory)):
+            return self.scanScores(person)
+        self._grade_cache[person] = result = []
+        term = self.selected_term
+        evaluations = self.journal_data.getStudentEvaluations(
+            removeSecurityProxy(person), factory,
+            first=term.first, last=term.last)
+        for requirement, score in evaluations:
+            key = (requirement.date, requirement.meeting_id)
+            if key in self.calendar_meetings:
+                result.append(score)
+        return result
+
+    def getScoreCounts(self, person):
+        """Return a list of (score, count) of scores in the selected term.
+
+        Scores are counted in the journal as they are evaluated, or
+        else come from the student index of the journal, so only
+        meetings of the term still in the calendar are counted.
+        """
+        factory = self.requirement_factory
+        if factory is not None and self.journal_data.isIndexed(factory):
+            term = self.selected_term
+            counts = self.journal_data.getTermScoreCounts(
+                removeSecurityProxy(person), factory, term.first, term.last)
+            if counts is not None:
+                return counts
+        return countScores(self.getScores(person))
+
+    def scanScores(self, person):
         self._grade_cache[person] = result = []
         unique_meetings = set()
         term = self.selected_term
@@ -997,7 +1236,7 @@ class FlourishLyceumSectionJournalBase(flourish.page.WideContainerPage,
 
     def getHint(self, person, meeting):
         # grade hint is homeroom attendance by default
-        requirement = HomeroomRequirement(meeting)
+        requirement = self.requirements(HomeroomRequirement, meeting)
         score = IEvaluateRequirement(requirement).getEvaluation(
             person, requirement, default=UNSCORED)
         if (score is UNSCORED or
@@ -1005,6 +1244,220 @@ class FlourishLyceumSectionJournalBase(flourish.page.WideContainerPage,
             return None
         return score.value
 
+    def getSubmittedChanges(self):
+        """Return (person, requirement, grade) of submitted cells."""
+        changes = []
+        members = self.members()
+        for meeting in self.meetings:
+            requirement = None
+            for person in members:
+                cell_id = "%s_%s" % (meeting.__name__, person.__name__)
+                cell_value = self.request.get(cell_id, None)
+                if cell_value is None:
+                    continue
+                if requirement is None:
+                    requirement = self.makeRequirement(
+                        removeSecurityProxy(meeting))
+                changes.append((person, requirement, cell_value))
+        return changes
+
+    def evaluateChanges(self, changes, evaluator):
+        """Store changes in batches, one batch per grading target.
+
+        Invalid grades are ignored.  A batch that runs into a conflict
+        is rolled back and stored once more, batches stored before it
+        are kept.
+        """
+        targets = {}
+        for change in changes:
+            requirement = change[1]
+            targets.setdefault(requirement[3], []).append(change)
+        for target_changes in targets.values():
+            requirement = target_changes[0][1]
+            evaluate = IEvaluateRequirement(requirement)
+            savepoint = transaction.savepoint(optimistic=True)
+            try:
+                evaluate.evaluateMany(target_changes, evaluator=evaluator)
+            except ConflictError:
+                savepoint.rollback()
+                evaluate.evaluateMany(target_changes, evaluator=evaluator)
+
+    def scoreValue(self, score):
+        if (score is UNSCORED or
+            score.value is UNSCORED):
+            return None
+        return score.value
+
+    def getGradeMatrix(self, persons, meetings):
+        """Grade values of persons, in rows aligned with meetings."""
+        matrix = self.journal_data.getEvaluationMatrix(
+            persons, meetings, self.requirement_factory,
+            score_system=self.getDefaultScoreSystem(), default=UNSCORED)
+        return [[self.scoreValue(score) for score in row]
+                for row in matrix]
+
+    def getHintMatrix(self, persons, meetings):
+        """Grade hints of persons, in rows aligned with meetings."""
+        matrix = self.journal_data.getEvaluationMatrix(
+            persons, meetings, HomeroomRequirement, default=UNSCORED)
+        return [[self.scoreValue(score) for score in row]
+                for row in matrix]
+
+    def countScoreMatrix(self, persons, meetings):
+        """Score counts of persons evaluated in the meetings."""
+        matrix = self.journal_data.getEvaluationMatrix(
+            persons, meetings, self.requirement_factory,
+            score_system=self.getDefaultScoreSystem(), default=UNSCORED)
+        return [countScores([score for score in row if score is not UNSCORED])
+                for row in matrix]
+
+    def getScoreCountsMatrix(self, persons):
+        """Score counts of persons in the selected term, one per person."""
+        factory = self.requirement_factory
+        if (factory is not None and
+            self.journal_data.isIndexed(factory)):
+            return [self.getScoreCounts(person) for person in persons]
+        term = removeSecurityProxy(self.selected_term)
+        if not term:
+            return [[] for person in persons]
+        meetings = self.meeting_index.getTermMeetings(term)
+        return self.countScoreMatrix(persons, meetings)
+
+    def getStudentSortingKey(self):
+        collator = getCollator(self.request.locale)
+        sort_by = None
+        if self.sortBy in ('last_name', 'first_name'):
+            sort_by = self.sortBy
+        return lambda x: collator.personKey(x, sort_by)
+
+    def getGridStudents(self):
+        """Return students shown in the journal and the active ones.
+
+        Active students are None if all shown students are active.
+        """
+        students = [removeSecurityProxy(person) for person in self.members()]
+        active = None
+        if not IPersonContainer.providedBy(self.context):
+            active = set([person
+                          for person, state in self.membership_states.items()
+                          if state is not None and ACTIVE in state[0]])
+            current_mode = getCurrentEnrollmentMode(
+                IPerson(self.request.principal, None))
+            if current_mode in (None, 'gradebook-enrollment-mode-enrolled'):
+                students = [person for person in students
+                            if person in active]
+        return students, active
+
+    def buildGrid(self):
+        students, active = self.getGridStudents()
+        meetings = self.meetings
+        return JournalGrid(students, active, meetings,
+                           self.getGradeMatrix(students, meetings),
+                           self.getHintMatrix(students, meetings),
+                           self.getScoreCountsMatrix(students))
+
+    def gridRow(self, grid, person, values, hints, counts, sorting_key):
+        css_class = ['popup_link']
+        title = person.title
+        if not grid.isActive(person):
+            css_class.append('inactive-student')
+            today_state = self.membership_states.get(person)
+            if today_state is not None:
+                meaning, code = today_state
+                state = self.app_states.states.get(code)
+                if state is not None:
+                    title = '%s (%s)' % (title, state.title)
+        grades = []
+        for meeting, value, hint in zip(grid.meetings, values, hints):
+            grades.append({
+                'id': '%s_%s' % (meeting.__name__, person.__name__),
+                'sortKey': meeting.__name__,
+                'value': value or '',
+                'hint': hint or '',
+                'editable': True,
+                })
+        row = {'student': {'title': title,
+                           'css_class': ' '.join(css_class),
+                           'first_name': person.first_name,
+                           'last_name': person.last_name,
+                           'id': person.username,
+                           'sortKey': sorting_key(person),
+                           'url': absoluteURL(person, self.request)},
+               'grades': grades,
+               'has_hints': any([g['hint'] for g in grades]),
+               }
+        row.update(self.gridTotals(person, counts))
+        return row
+
+    def gridTotals(self, person, counts):
+        """Extra columns of a row computed from score counts."""
+        return {}
+
+    def table(self):
+        self.sortBy = self.request.get('sort_by')
+        sorting_key = self.getStudentSortingKey()
+        grid = self.buildGrid()
+        result = [self.gridRow(grid, person, values, hints, counts,
+                               sorting_key)
+                  for person, values, hints, counts in grid]
+        return sorted(result, key=self.sortKey)
+
+    def gridPayload(self):
+        """The journal grid of the active month for client side rendering.
+
+        Students, meetings and score options are listed once.  Cell
+        values and hints are dense row-major lists of codes of a shared
+        palette, code 0 standing for an empty cell.
+        """
+        payload = {
+            'students': [],
+            'meetings': [],
+            'scores': [],
+            'palette': [''],
+            'values': [],
+            'hints': None,
+            }
+        if not self.render_journal:
+            return payload
+        payload['month'] = self.active_month
+        payload['year'] = self.active_year
+        ss = self.getDefaultScoreSystem()
+        if ss is not None:
+            payload['scores'] = self.getScoreOptions(ss)
+        for activity in self.activities:
+            payload['meetings'].append({
+                'id': activity['hash'],
+                'date': activity['longTitle'],
+                'day': activity['shortTitle'],
+                'period': activity['period'],
+                })
+        palette = payload['palette']
+        codes = {'': 0}
+        def encode(value):
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(palette)
+                palette.append(value)
+            return code
+        hints = []
+        has_hints = False
+        for row in self.table():
+            student = dict(row['student'])
+            del student['sortKey']
+            student['totals'] = dict([
+                (key, translate(value, context=self.request)
+                      if isinstance(value, basestring) else value)
+                for key, value in row.items()
+                if key not in ('student', 'grades', 'has_hints')])
+            payload['students'].append(student)
+            for grade in row['grades']:
+                payload['values'].append(encode(grade['value']))
+                hints.append(encode(grade['hint']))
+            has_hints = has_hints or row['has_hints']
+        if has_hints:
+            payload['hints'] = hints
+        return payload
+
     def updateJournalMode(self):
         if self.journal_mode is None:
             return
@@ -1020,7 +1473,15 @@ class FlourishLyceumSectionJournalBase(flourish.page.WideContainerPage,
     def name_sorting_columns(self):
         return getUtility(IPersonFactory).columns()
 
+    @Lazy
+    def membership_states(self):
+        section = removeSecurityProxy(self.context.section)
+        return getTodayMembershipStates(section)
+
     def getTodayState(self, student, section):
+        student = removeSecurityProxy(student)
+        if section is removeSecurityProxy(self.context.section):
+            return self.membership_states.get(student)
         relationships = Membership.bind(member=student).all().relationships
         for link_info in relationships:
             if link_info.target is section:
@@ -1032,9 +1493,24 @@ class FlourishLyceumSectionJournalBase(flourish.page.WideContainerPage,
         return IRelationshipStateContainer(app)['section-membership']
 
 
+class FlourishJournalGridJSONView(BrowserView):
+    """Compact JSON encoded grid of a journal view."""
+
+    def __call__(self):
+        response = self.request.response
+        response.setHeader('Content-Type', 'application/json')
+        if self.context.isNotModified():
+            return ''
+        self.context.updateCurrentJournal()
+        self.context.update()
+        encoder = flourish.tal.JSONEncoder()
+        return encoder.encode(self.context.gridPayload())
+
+
 class FlourishLyceumSectionJournalGrades(FlourishLyceumSectionJournalBase):
 
     journal_mode = 'journal-mode-grades'
+    requirement_factory = GradeRequirement
 
     @property
     def title(self):
@@ -1055,87 +1531,15 @@ class FlourishLyceumSectionJournalGrades(FlourishLyceumSectionJournalBase):
 
     def makeRequirement(self, meeting):
         ss = self.getDefaultScoreSystem()
-        return GradeRequirement(meeting, ss)
+        return self.requirements(GradeRequirement, meeting, ss)
 
     def updateGradebook(self):
         evaluator = getEvaluator(self.request)
-        members = self.members()
-        for meeting in self.meetings:
-            for person in members:
-                cell_id = "%s_%s" % (meeting.__name__, person.__name__)
-                cell_value = self.request.get(cell_id, None)
-                if cell_value is not None:
-                    requirement = self.makeRequirement(removeSecurityProxy(meeting))
-                    try:
-                        IEvaluateRequirement(requirement).evaluate(
-                            person, requirement, cell_value,
-                            evaluator=evaluator)
-                    except ScoreValidationError:
-                        pass
-                    except:
-                        IEvaluateRequirement(requirement).evaluate(
-                            person, requirement, cell_value,
-                            evaluator=evaluator)
+        changes = self.getSubmittedChanges()
+        self.evaluateChanges(changes, evaluator)
 
-    def table(self):
-        result = []
-        collator = ICollator(self.request.locale)
-        factory = getUtility(IPersonFactory)
-        self.sortBy = self.request.get('sort_by')
-        if self.sortBy == 'last_name':
-            sorting_key = lambda x: (collator.key(x.last_name),
-                                     collator.key(x.first_name))
-        elif self.sortBy == 'first_name':
-            sorting_key = lambda x: (collator.key(x.first_name),
-                                     collator.key(x.last_name))
-        else:
-            sorting_key = lambda x: factory.getSortingKey(x, collator)
-        students = self.members()
-        section = removeSecurityProxy(self.context.section)
-        today = getUtility(IDateManager).today
-        active_students = students.on(today).any(ACTIVE)
-        current_mode = getCurrentEnrollmentMode(
-            IPerson(self.request.principal, None))
-        if current_mode == 'gradebook-enrollment-mode-enrolled':
-            students = active_students
-        for person in students:
-            css_class = ['popup_link']
-            person = removeSecurityProxy(person)
-            title = person.title
-            if person not in active_students:
-                css_class.append('inactive-student')
-                meaning, code = self.getTodayState(person, section)
-                state = self.app_states.states.get(code)
-                if state is not None:
-                    title = '%s (%s)' % (title, state.title)
-            grades = []
-            for meeting in self.meetings:
-                insecure_meeting = removeSecurityProxy(meeting)
-                grade = self.getGrade(person, insecure_meeting) or ''
-                hint = self.getHint(person, insecure_meeting) or ''
-                grade_data = {
-                    'id': '%s_%s' % (meeting.__name__, person.__name__),
-                    'sortKey': meeting.__name__,
-                    'value': grade,
-                    'hint': hint,
-                    'editable': True,
-                    }
-                grades.append(grade_data)
-            if flourish.canView(person):
-                person = removeSecurityProxy(person)
-            result.append(
-                {'student': {'title': title,
-                             'css_class': ' '.join(css_class),
-                             'first_name': person.first_name,
-                             'last_name': person.last_name,
-                             'id': person.username,
-                             'sortKey': sorting_key(person),
-                             'url': absoluteURL(person, self.request)},
-                 'grades': grades,
-                 'has_hints': any([g['hint'] for g in grades]),
-                 'average': self.average(person),
-                })
-        return sorted(result, key=self.sortKey)
+    def gridTotals(self, person, counts):
+        return {'average': self.average(person, counts)}
 
     def sortKey(self, row):
         if self.sortBy in ('student', 'first_name', 'last_name'):
@@ -1154,24 +1558,24 @@ class FlourishLyceumSectionJournalGrades(FlourishLyceumSectionJournalBase):
                     return (0, grade, row['student']['sortKey'])
         return (1, row['student']['sortKey'])
 
-    def average(self, person):
-        grades = []
-        scores = self.getScores(person)
-        for score in scores:
-            if score.value is UNSCORED:
-                continue
+    def average(self, person, counts=None):
+        if counts is None:
+            counts = self.getScoreCounts(person)
+        total = 0
+        count = 0
+        for score, score_count in counts:
             try:
                 grade = score.scoreSystem.getNumericalValue(score.value)
             except KeyError:
                 continue
-            grades.append(grade)
-        if not grades:
+            total += grade * score_count
+            count += score_count
+        if not count:
             return _('N/A')
         else:
-            return "%.1f" % (float(sum(grades)) / float(len(grades)))
+            return "%.1f" % (float(total) / float(count))
 
-    def getJSONScores(self, scoresystem):
-        encoder = flourish.tal.JSONEncoder()
+    def getScoreOptions(self, scoresystem):
         result = []
         for label, abbr, value, percent in scoresystem.scores:
             title = label
@@ -1181,13 +1585,13 @@ class FlourishLyceumSectionJournalGrades(FlourishLyceumSectionJournalBase):
                 'label': title,
                 'value': label,
             })
-        json = encoder.encode(result)
-        return json
+        return result
 
 
 class FlourishLyceumSectionJournalAttendance(FlourishLyceumSectionJournalBase):
 
     journal_mode = 'journal-mode-attendance'
+    requirement_factory = AttendanceRequirement
 
     @property
     def title(self):
@@ -1208,10 +1612,9 @@ class FlourishLyceumSectionJournalAttendance(FlourishLyceumSectionJournalBase):
 
     def makeRequirement(self, meeting):
         ss = self.getDefaultScoreSystem()
-        return AttendanceRequirement(meeting, ss)
+        return self.requirements(AttendanceRequirement, meeting, ss)
 
-    def getJSONScores(self, scoresystem):
-        encoder = flourish.tal.JSONEncoder()
+    def getScoreOptions(self, scoresystem):
         result = []
         for label, abbr in scoresystem.scores:
             title = label
@@ -1221,81 +1624,18 @@ class FlourishLyceumSectionJournalAttendance(FlourishLyceumSectionJournalBase):
                 'label': title,
                 'value': label,
             })
-        json = encoder.encode(result)
-        return json
+        return result
 
-    def table(self):
-        result = []
-        collator = ICollator(self.request.locale)
-        factory = getUtility(IPersonFactory)
-        self.sortBy = self.request.get('sort_by')
-        if self.sortBy == 'last_name':
-            sorting_key = lambda x: (collator.key(x.last_name),
-                                     collator.key(x.first_name))
-        elif self.sortBy == 'first_name':
-            sorting_key = lambda x: (collator.key(x.first_name),
-                                     collator.key(x.last_name))
-        else:
-            sorting_key = lambda x: factory.getSortingKey(x, collator)
-        students = self.members()
-        section = None
-        active_students = ()
-        current_mode = None
-        is_persons_view = IPersonContainer.providedBy(self.context)
-        if not is_persons_view:
-            section = removeSecurityProxy(self.context.section)
-            today = getUtility(IDateManager).today
-            active_students = students.on(today).any(ACTIVE)
-            current_mode = getCurrentEnrollmentMode(
-                IPerson(self.request.principal, None))
-            if current_mode == 'gradebook-enrollment-mode-enrolled':
-                students = active_students
-        for person in students:
-            css_class = ['popup_link']
-            person = removeSecurityProxy(person)
-            title = person.title
-            if not is_persons_view:
-                if person not in active_students:
-                    css_class.append('inactive-student')
-                    meaning, code = self.getTodayState(person, section)
-                    state = self.app_states.states.get(code)
-                    if state is not None:
-                        title = '%s (%s)' % (title, state.title)
-            grades = []
-            for meeting in self.meetings:
-                insecure_meeting = removeSecurityProxy(meeting)
-                attendance = self.getGrade(person, insecure_meeting) or ''
-                hint = self.getHint(person, insecure_meeting) or ''
-                grade_data = {
-                    'id': '%s_%s' % (meeting.__name__, person.__name__),
-                    'sortKey': meeting.__name__,
-                    'value': attendance,
-                    'hint': hint,
-                    'editable': True,
-                    }
-                grades.append(grade_data)
-            if flourish.canView(person):
-                person = removeSecurityProxy(person)
-            excused, excusable = self.excused(person)
-            result.append(
-                {'student': {'title': title,
-                             'css_class': ' '.join(css_class),
-                             'first_name': person.first_name,
-                             'last_name': person.last_name,
-                             'id': person.username,
-                             'sortKey': sorting_key(person),
-                             'url': absoluteURL(person, self.request)},
-                 'grades': grades,
-                 'absences': self.absences(person),
-                 'tardies': self.tardies(person),
-                 'excused': (
-                        '%s / %s' % (excused, excusable)
-                        if excusable
-                        else ''),
-                 'unexcused': excused - excusable if excusable else 1,
-                 'has_hints': any([g['hint'] for g in grades]),
-                })
-        return sorted(result, key=self.sortKey)
+    def gridTotals(self, person, counts):
+        excused, excusable = self.excused(person, counts)
+        return {'absences': self.absences(person, counts),
+                'tardies': self.tardies(person, counts),
+                'excused': (
+                    '%s / %s' % (excused, excusable)
+                    if excusable
+                    else ''),
+                'unexcused': excused - excusable if excusable else 1,
+                }
 
     def sortKey(self, row):
         if self.sortBy in ('student', 'first_name', 'last_name'):
@@ -1315,63 +1655,55 @@ class FlourishLyceumSectionJournalAttendance(FlourishLyceumSectionJournalBase):
                     return (0, grade, row['student']['sortKey'])
         return (1, row['student']['sortKey'])
 
-    def absences(self, person):
+    def absences(self, person, counts=None):
+        if counts is None:
+            counts = self.getScoreCounts(person)
         absences = 0
-        for score in self.getScores(person):
-            if (score.value is not UNSCORED and
-                IAttendanceScoreSystem.providedBy(score.scoreSystem) and
+        for score, count in counts:
+            if (IAttendanceScoreSystem.providedBy(score.scoreSystem) and
                 score.scoreSystem.isAbsent(score)):
-                absences += 1
+                absences += count
         if absences == 0:
             return "0"
         else:
             return str(absences)
 
-    def tardies(self, person):
+    def tardies(self, person, counts=None):
+        if counts is None:
+            counts = self.getScoreCounts(person)
         tardies = 0
-        for score in self.getScores(person):
-            if (score.value is not UNSCORED and
-                IAttendanceScoreSystem.providedBy(score.scoreSystem) and
+        for score, count in counts:
+            if (IAttendanceScoreSystem.providedBy(score.scoreSystem) and
                 score.scoreSystem.isTardy(score)):
-                tardies += 1
+                tardies += count
         if tardies == 0:
             return "0"
         else:
             return str(tardies)
 
-    def excused(self, person):
+    def excused(self, person, counts=None):
+        if counts is None:
+            counts = self.getScoreCounts(person)
         excusable = 0
         excused = 0
-        for score in self.getScores(person):
-            if (score.value is UNSCORED or
-                not IAttendanceScoreSystem.providedBy(score.scoreSystem)):
+        for score, count in counts:
+            if not IAttendanceScoreSystem.providedBy(score.scoreSystem):
                 continue
             ss = score.scoreSystem
             if (ss.isAbsent(score) or
                 ss.isTardy(score) or
                 ss.isExcused(score)):
-                excusable += 1
+                excusable += count
             if ss.isExcused(score):
-                excused += 1
+                excused += count
         if not excusable:
             return 0, 0
         return excused, excusable
 
     def updateGradebook(self):
         evaluator = getEvaluator(self.request)
-        members = self.members()
-        for meeting in self.meetings:
-            for person in members:
-                cell_id = "%s_%s" % (meeting.__name__, person.__name__)
-                cell_value = self.request.get(cell_id, None)
-                if cell_value is not None:
-                    requirement = self.makeRequirement(removeSecurityProxy(meeting))
-                    try:
-                        IEvaluateRequirement(requirement).evaluate(
-                            person, requirement, cell_value,
-                            evaluator=evaluator)
-                    except ScoreValidationError:
-                        pass
+        changes = self.getSubmittedChanges()
+        self.evaluateChanges(changes, evaluator)
 
     def validate_score(self, activity_id=None, score=None):
         if score is None:
@@ -1383,12 +1715,16 @@ class FlourishLyceumSectionJournalAttendance(FlourishLyceumSectionJournalBase):
 class FlourishSectionHomeroomAttendance(FlourishLyceumSectionJournalAttendance):
 
     journal_mode = 'journal-mode-homeroom'
+    requirement_factory = HomeroomRequirement
 
     no_periods_text = _("This section is not scheduled for any homeroom periods.")
 
     def getHint(self, person, meeting):
         return None
 
+    def getHintMatrix(self, persons, meetings):
+        return [[None] * len(meetings) for person in persons]
+
     def isJournalMeeting(self, term, meeting):
         if not FlourishLyceumSectionJournalAttendance.isJournalMeeting(self, term, meeting):
             return False
@@ -1408,7 +1744,7 @@ class FlourishSectionHomeroomAttendance(FlourishLyceumSectionJournalAttendance):
 
     def makeRequirement(self, meeting):
         ss = self.getDefaultScoreSystem()
-        return HomeroomRequirement(meeting, ss)
+        return self.requirements(HomeroomRequirement, meeting, ss)
 
 
 class JournalTertiaryNavigationManager(flourish.page.TertiaryNavigationManager):
@@ -1738,7 +2074,15 @@ class SectionJournalLinkViewlet(flourish.page.LinkViewlet):
         return can_view
 
 
-class FlourishActivityPopupMenuView(flourish.content.ContentProvider):
+class FlourishPopupMenuBase(flourish.content.ContentProvider,
+                            ConditionalGetMixin):
+    """JSON encoded popup menu of a journal item.
+
+    Menus only change with the journal, so they are answered with 304
+    while the journal page would be.
+    """
+
+    item_parameter = None
 
     def __init__(self, view, request):
         flourish.content.ContentProvider.__init__(self, view.context, request, view)
@@ -1746,23 +2090,42 @@ class FlourishActivityPopupMenuView(flourish.content.ContentProvider):
     def translate(self, message):
         return translate(message, context=self.request)
 
+    @Lazy
+    def view_url(self):
+        return absoluteURL(self.view, self.request)
+
+    def getCacheStamp(self):
+        stamp = self.view.getCacheStamp()
+        if stamp is None:
+            return None
+        return (self.item_parameter, stamp)
+
+    def getMenu(self, item_id):
+        return {}
+
     def __call__(self):
-        result = {}
-        app = ISchoolToolApplication(None)
-        tzinfo = pytz.timezone(IApplicationPreferences(app).timezone)
-        activity_id = self.request.get('activity_id')
-        meetings = dict([(meeting.__name__, meeting)
-                         for meeting in self.context.meetings])
+        response = self.request.response
+        response.setHeader('Content-Type', 'application/json')
+        if self.isNotModified():
+            return ''
+        result = self.getMenu(self.request.get(self.item_parameter))
+        encoder = flourish.tal.JSONEncoder()
+        json = encoder.encode(result)
+        return json
 
-        if activity_id is not None and activity_id in meetings:
-            meeting = meetings[activity_id]
-            meetingDate = meeting.dtstart.astimezone(tzinfo).date()
-            info = {
-                'longTitle': meetingDate.strftime("%Y-%m-%d"),
-                'hash': activity_id,
-                }
-            url = absoluteURL(self.view, self.request)
-            result['header'] = info['longTitle']
+
+class FlourishActivityPopupMenuView(FlourishPopupMenuBase):
+
+    item_parameter = 'activity_id'
+
+    def getMenu(self, activity_id):
+        result = {}
+        meeting = None
+        if activity_id is not None:
+            meeting = self.view.meeting_index.getMeeting(activity_id)
+        if meeting is not None:
+            meetingDate = self.view.meetingStart(meeting).date()
+            result['header'] = meetingDate.strftime("%Y-%m-%d")
             result['options'] = [
                 {
                     'label': self.translate(_('Fill down')),
@@ -1772,32 +2135,26 @@ class FlourishActivityPopupMenuView(flourish.content.ContentProvider):
                 {
                     'label': self.translate(_('Sort by')),
                     'url': '%s?sort_by=%s&month=%s' % (
-                        url, info['hash'], meetingDate.month),
+                        self.view_url, activity_id, meetingDate.month),
                     }
                 ]
-        response = self.request.response
-        response.setHeader('Content-Type', 'application/json')
-        encoder = flourish.tal.JSONEncoder()
-        json = encoder.encode(result)
-        return json
+        return result
 
 
-class FlourishStudentPopupMenuView(flourish.content.ContentProvider):
+class FlourishStudentPopupMenuView(FlourishPopupMenuBase):
 
-    def __init__(self, view, request):
-        flourish.content.ContentProvider.__init__(self, view.context, request, view)
+    item_parameter = 'student_id'
 
-    def translate(self, message):
-        return translate(message, context=self.request)
+    @Lazy
+    def persons(self):
+        return ISchoolToolApplication(None)['persons']
 
-    def __call__(self):
+    def getMenu(self, student_id):
         result = {}
-        student_id = self.request.get('student_id')
-        if student_id is not None:
-            app = ISchoolToolApplication(None)
-            student = app['persons'].get(student_id)
-            if student is not None and student in self.context.members:
-                journal_url = absoluteURL(self.view, self.request)
+        if (student_id is not None and
+            student_id in self.view.member_usernames):
+            student = self.persons.get(student_id)
+            if student is not None:
                 student_url = absoluteURL(student, self.request)
                 result['header'] = student.title
                 result['options'] = [
@@ -1808,30 +2165,21 @@ class FlourishStudentPopupMenuView(flourish.content.ContentProvider):
                     {
                         'label': self.translate(_('History')),
                         'url': '%s/score_history?student_id=%s&month=%s' % (
-                            journal_url, student_id, self.view.active_month),
+                            self.view_url, student_id, self.view.active_month),
                         },
                     ]
-        response = self.request.response
-        response.setHeader('Content-Type', 'application/json')
-        encoder = flourish.tal.JSONEncoder()
-        json = encoder.encode(result)
-        return json
-
+        return result
 
-class FlourishNamePopupMenuView(flourish.content.ContentProvider):
 
-    def __init__(self, view, request):
-        flourish.content.ContentProvider.__init__(self, view.context, request, view)
+class FlourishNamePopupMenuView(FlourishPopupMenuBase):
 
-    def translate(self, message):
-        return translate(message, context=self.request)
+    item_parameter = 'column_id'
 
     @Lazy
     def name_sorting_columns(self):
         return getUtility(IPersonFactory).columns()
 
-    def __call__(self):
-        column_id = self.request.get('column_id')
+    def getMenu(self, column_id):
         for column in self.name_sorting_columns:
             if column.name == column_id:
                 break
@@ -1844,17 +2192,12 @@ class FlourishNamePopupMenuView(flourish.content.ContentProvider):
                     }
                 ],
             }
-        response = self.request.response
-        response.setHeader('Content-Type', 'application/json')
-        encoder = flourish.tal.JSONEncoder()
-        json = encoder.encode(result)
-        return json
+        return result
 
 
-class FlourishTotalPopupMenuView(flourish.content.ContentProvider):
+class FlourishTotalPopupMenuView(FlourishPopupMenuBase):
 
-    def __init__(self, view, request):
-        flourish.content.ContentProvider.__init__(self, view.context, request, view)
+    item_parameter = 'column_id'
 
     titles = {
         'total': _('Total'),
@@ -1864,12 +2207,8 @@ class FlourishTotalPopupMenuView(flourish.content.ContentProvider):
         'excused': _('Exc.'),
         }
 
-    def translate(self, message):
-        return translate(message, context=self.request)
-
-    def __call__(self):
+    def getMenu(self, column_id):
         result = {}
-        column_id = self.request.get('column_id')
         if column_id in self.titles:
             result['header'] = self.translate(self.titles[column_id])
             result['options'] = [
@@ -1878,23 +2217,54 @@ class FlourishTotalPopupMenuView(flourish.content.ContentProvider):
                     'url': '?sort_by=%s' % column_id,
                     },
                 ]
-        response = self.request.response
-        response.setHeader('Content-Type', 'application/json')
-        encoder = flourish.tal.JSONEncoder()
-        json = encoder.encode(result)
-        return json
+        return result
+
+
+class FlourishRequestJournalExportBase(RequestXLSReportDialog):
+    """Journal export dialog with a choice of XLS or XLSX workbooks."""
+
+    template = ViewPageTemplateFile('templates/f_journal_export_dialog.pt')
+
+    builder_name = None
+    formats = (
+        ('xls', _('Excel 97-2003 (.xls)')),
+        ('xlsx', _('Excel (.xlsx), without row and column limits')),
+        )
+    task_factories = {
+        'xls': JournalXLSReportTask,
+        'xlsx': JournalXLSXReportTask,
+        }
+
+    @property
+    def format(self):
+        format = self.request.get('format')
+        if format not in self.task_factories:
+            format = self.formats[0][0]
+        return format
+
+    @property
+    def report_builder(self):
+        return '%s.%s' % (self.builder_name, self.format)
 
+    @property
+    def task_factory(self):
+        return self.task_factories[self.format]
 
-class FlourishRequestJournalExportGrades(RequestXLSReportDialog):
+    def format_options(self):
+        return [{'value': value,
+                 'title': title,
+                 'selected': value == self.format}
+                for value, title in self.formats]
 
-    report_builder = 'grades.xls'
-    task_factory = JournalXLSReportTask
 
+class FlourishRequestJournalExportGrades(FlourishRequestJournalExportBase):
 
-class FlourishRequestJournalExportAttendance(RequestXLSReportDialog):
+    builder_name = 'grades'
 
-    report_builder = 'attendance.xls'
-    task_factory = JournalXLSReportTask
+
+class FlourishRequestJournalExportAttendance(FlourishRequestJournalExportBase):
+
+    builder_name = 'attendance'
 
 
 class DateHeader(export.Header):
@@ -1906,7 +2276,30 @@ class DateHeader(export.Header):
         return result
 
 
-class FlourishJournalExportBase(export.ExcelExportView):
+class JournalWorkbookMixin(object):
+    """Builds XLS workbooks with xlwt, or streamed XLSX workbooks."""
+
+    workbook_factory = xlwt.Workbook
+
+    def makeWorkbook(self):
+        return self.workbook_factory()
+
+    def discardWorkbook(self, workbook):
+        """Remove temporary files of a workbook that will not be saved."""
+        remove = getattr(workbook, 'remove', None)
+        if remove is not None:
+            remove()
+
+    def write(self, ws, row, col, data, **style):
+        if isinstance(ws, XLSXWorksheet):
+            ws.write(row, col, data, bold=style.get('bold', False),
+                     format_str=style.get('format_str'))
+            return
+        super(JournalWorkbookMixin, self).write(ws, row, col, data, **style)
+
+
+class FlourishJournalExportBase(JournalWorkbookMixin,
+                                export.ExcelExportView):
 
     def print_headers(self, ws):
         row_1_headers = [export.Header(label)
@@ -1967,8 +2360,12 @@ class FlourishJournalExportBase(export.ExcelExportView):
         app = ISchoolToolApplication(None)
         self.persons = app['persons']
         self.tzinfo = pytz.timezone(IApplicationPreferences(app).timezone)
-        workbook = xlwt.Workbook()
-        self.export_month_worksheets(workbook)
+        workbook = self.makeWorkbook()
+        try:
+            self.export_month_worksheets(workbook)
+        except:
+            self.discardWorkbook(workbook)
+            raise
         return workbook
 
     @property
@@ -1979,9 +2376,7 @@ class FlourishJournalExportBase(export.ExcelExportView):
     def meetings(self):
         result = []
         for event in self.all_meetings:
-            insecure_event = removeSecurityProxy(event)
-            meeting_start = insecure_event.dtstart.astimezone(self.tzinfo)
-            if meeting_start.month == self.active_month:
+            if self.meetingStart(event).month == self.active_month:
                 result.append(event)
         return result
 
@@ -1990,8 +2385,7 @@ class FlourishJournalExportBase(export.ExcelExportView):
         result = []
         for meeting in self.meetings:
             info = {}
-            insecure_meeting = removeSecurityProxy(meeting)
-            meetingDate = insecure_meeting.dtstart.astimezone(self.tzinfo).date()
+            meetingDate = self.meetingStart(meeting).date()
             info['date'] = meetingDate
             try:
                 if meeting.period is not None:
@@ -2031,6 +2425,16 @@ class FlourishJournalExportAttendance(FlourishJournalExportBase,
         return filename
 
 
+class FlourishJournalExportGradesXLSX(FlourishJournalExportGrades):
+
+    workbook_factory = XLSXWorkbook
+
+
+class FlourishJournalExportAttendanceXLSX(FlourishJournalExportAttendance):
+
+    workbook_factory = XLSXWorkbook
+
+
 class JournalModes(flourish.page.RefineLinksViewlet):
     pass
 
@@ -2218,7 +2622,6 @@ class SectionJournalGradeHistory(SubPage):
             return []
 
         persons = ISchoolToolApplication(None)['persons']
-        evaluations = removeSecurityProxy(IEvaluations(self.student))
         result = []
 
         meetings = self.meetings
@@ -2227,8 +2630,9 @@ class SectionJournalGradeHistory(SubPage):
 
         for meeting in meetings:
             requirement = self.view.makeRequirement(removeSecurityProxy(meeting))
-            scores = list(evaluations.getHistory(requirement))
-            current = evaluations.get(requirement)
+            evaluate = IEvaluateRequirement(requirement)
+            scores = evaluate.getHistory(self.student, requirement)
+            current = evaluate.getEvaluation(self.student, requirement)
             if (scores or current is not None):
                 scores.append(current)
             if not scores:
@@ -2334,10 +2738,11 @@ class FlourishSchoolYearMyJournalView(flourish.page.Page):
         person = self.person
         if person is None:
             return
-        evaluations = removeSecurityProxy(IEvaluations(person))
+        section_journal_data = ISectionJournalData(section)
         for event in ISchoolToolCalendar(section):
-            requirement = AttendanceRequirement(removeSecurityProxy(event))
-            score = evaluations.get(requirement)
+            requirement = section_journal_data.requirements(
+                AttendanceRequirement, removeSecurityProxy(event))
+            score = section_journal_data.getEvaluation(person, requirement)
             if not score:
                 continue
             yield event, score
@@ -2490,76 +2895,143 @@ class FlourishSchoolAttendanceView(flourish.page.Page):
         return getUtility(IPersonFactory).columns()
 
 
-class AttendanceFilter(table.ajax.IndexedTableFilter):
+class FlourishAttendanceDashboardView(flourish.page.Page):
+    """Daily attendance counts of the school, its groups and periods."""
 
-    def instructorSections(self, instructor, terms):
-        sections = set()
-        for section in Instruction.query(instructor=self.view.instructor):
-            term = ITerm(section)
-            if term not in terms:
-                continue
-            sections.add(section)
-        return sections
-
-    def termSections(self, terms):
-        sections = set()
-        for term in self.view.terms:
-            container = ISectionContainer(term)
-            for section in container.values():
-                if section not in sections:
-                    sections.add(section)
-        return sections
-
-    def availableSections(self):
-        instructor = self.view.instructor
-        terms = set([removeSecurityProxy(term) for term in self.view.terms])
-        if instructor:
-            sections = self.instructorSections(instructor, terms)
-            return sections
-        if terms:
-            sections = self.termSections(terms)
-            return sections
+    days = 7
+
+    @Lazy
+    def date(self):
+        date = self.request.get('date', '').strip()
+        if date:
+            try:
+                return parse(date).date()
+            except ValueError:
+                pass
+        return getUtility(IDateManager).today
+
+    @Lazy
+    def journal_container(self):
+        app = ISchoolToolApplication(None)
+        return app['schooltool.lyceum.journal']
+
+    @Lazy
+    def rollups(self):
+        first = self.date - datetime.timedelta(self.days - 1)
+        return self.journal_container.getAttendanceRollups(first, self.date)
+
+    def getCounts(self, rollup, student_ids=None):
+        """Numbers of students with marks, optionally of some students."""
+        counts = {}
+        for requirement_type in ATTENDANCE_TYPES:
+            for tag, flag in ATTENDANCE_TAGS:
+                if student_ids is None:
+                    count = rollup.count(requirement_type, tag)
+                else:
+                    count = len(intersection(
+                        rollup.getStudentIds(requirement_type, tag),
+                        student_ids))
+                counts['%s_%s' % (requirement_type, tag)] = count
+        return counts
+
+    def days_table(self):
+        result = []
+        for date, rollup in reversed(self.rollups):
+            row = self.getCounts(rollup)
+            row['date'] = date
+            result.append(row)
+        return result
+
+    @Lazy
+    def rollup(self):
+        for date, rollup in self.rollups:
+            if date == self.date:
+                return rollup
         return None
 
+    def groups_table(self):
+        """Numbers of students with marks of the day, per group."""
+        rollup = self.rollup
+        if rollup is None:
+            return []
+        schoolyears = ISchoolYearContainer(ISchoolToolApplication(None))
+        year = schoolyears.getActiveSchoolYear()
+        if year is None:
+            return []
+        affected = rollup.getStudentIds()
+        index = getStudentIndex()
+        collator = getCollator(self.request.locale)
+        result = []
+        for group in IGroupContainer(year).values():
+            student_ids = index.groupStudents(group)
+            if not intersection(affected, student_ids):
+                continue
+            row = self.getCounts(rollup, student_ids)
+            row['group'] = group
+            result.append(row)
+        return sorted(result, key=lambda row: collator.key(row['group'].title))
+
+    def periods_table(self):
+        """Numbers of students with section marks of the day, per period."""
+        rollup = self.rollup
+        if rollup is None:
+            return []
+        result = []
+        requirement_type = AttendanceRequirement.requirement_type
+        for period in rollup.getPeriods(requirement_type):
+            row = {}
+            for tag, flag in ATTENDANCE_TAGS:
+                row[tag] = rollup.count(requirement_type, tag, period)
+            if period is None:
+                row['time'] = ''
+                row['title'] = _('Other meetings')
+            else:
+                time, title = period
+                row['time'] = time.strftime('%H:%M')
+                row['title'] = title
+            result.append(row)
+        return result
+
+
+class AttendanceFilter(table.ajax.IndexedTableFilter):
+
+    @Lazy
+    def student_index(self):
+        return getStudentIndex()
+
     @Lazy
     def section_student_ids(self):
-        sections = self.availableSections()
-        if sections is None:
+        terms = self.view.terms
+        instructor = self.view.instructor
+        if not instructor and not terms:
             return None
-        int_ids = getUtility(IIntIds)
-        ids = {}
-        for section in sections:
-            unsecure_section = removeSecurityProxy(section)
-            for person in unsecure_section.members.all():
-                if person in ids:
-                    continue
-                intid = int_ids.queryId(person, None)
-                if intid is None:
-                    continue
-                ids[person] = intid
-        return set(ids.values())
+        index = self.student_index
+        if instructor:
+            sets = [index.instructorStudents(instructor, term)
+                    for term in terms]
+        else:
+            sets = [index.termStudents(term) for term in terms]
+        return multiunion(sets)
+
+    @Lazy
+    def available_student_ids(self):
+        ids = self.section_student_ids
+        if self.view.group:
+            group_ids = self.student_index.groupStudents(self.view.group)
+            if ids is None:
+                ids = group_ids
+            else:
+                ids = intersection(ids, group_ids)
+        return ids
 
     def filterBySection(self, items):
-        available_ids = self.section_student_ids
+        available_ids = self.available_student_ids
         if available_ids is None:
             return items
         return [item for item in items if item['id'] in available_ids]
 
-    def filterByGroup(self, items):
-        if not self.view.group:
-            return items
-        int_ids = getUtility(IIntIds)
-        group_person_ids = set([
-                int_ids.queryId(person)
-                for person in self.view.group.members.all()
-                ])
-        items = [item for item in items
-                 if item['id'] in group_person_ids]
-        return items
-
     def filter(self, items):
         items = self.filterBySection(items)
-        items = self.filterByGroup(items)
         if self.ignoreRequest:
             return items
         return table.ajax.IndexedTableFilter.filter(self, items)
@@ -2632,6 +3104,24 @@ class FlourishSchoolAttendanceGradebook(flourish.content.ContentProvider,
     def getSelectedTerm(self):
         return None
 
+    @Lazy
+    def journal_data(self):
+        journal_data = IEvaluateRequirement(ISchoolToolApplication(None))
+        # Share requirements of the school days between requests
+        journal_data.requirements = self.school_days.requirements
+        return journal_data
+
+    @Lazy
+    def school_days(self):
+        return getSchoolDayCalendar(self.selected_terms, self.selected_year,
+                                    self.selected_month, self.tzinfo)
+
+    def getScoreCountsMatrix(self, persons):
+        return self.countScoreMatrix(persons, self.all_meetings)
+
+    def getCacheStamp(self):
+        return None
+
     @Lazy
     def selected_terms(self):
         table = self.view
@@ -2650,41 +3140,22 @@ class FlourishSchoolAttendanceGradebook(flourish.content.ContentProvider,
     def members(self):
         return self.view.persons
 
+    def meetingStart(self, meeting):
+        return removeSecurityProxy(meeting).dtstart.astimezone(self.timezone)
+
     def allMeetings(self):
-        terms = removeSecurityProxy(self.selected_terms)
-        if not terms:
+        if not self.selected_terms:
             return ()
-
-        year = self.selected_year
-        month = self.selected_month
-
-        dates = [self.tzinfo.localize(datetime.datetime(year, month, day))
-                 for day in calendar.Calendar().itermonthdays(year, month)
-                 if day]
-
-        meetings = []
-
-        for dt in dates:
-            date = dt.date()
-            for term in terms:
-                if date in term and term.isSchoolday(date):
-                    # meeting duration is not precise - some days are not 24 hours long
-                    meetings.append(makeSchoolAttendanceMeeting(dt))
-        return meetings
+        return list(self.school_days.meetings)
 
     def getScores(self, person):
         if person in self._grade_cache:
             return list(self._grade_cache[person])
         self._grade_cache[person] = result = []
         unique_meetings = set()
-        terms = self.selected_terms
-        events = list(self.all_meetings)
-        sorted_events = sorted(events, key=lambda e: e.dtstart)
         unproxied_person = removeSecurityProxy(person)
-        for event in sorted_events:
-            date = event.dtstart.date()
-            if not any([date in term for term in terms]):
-                continue
+        # School days are ordered and all of them are in selected terms
+        for event in self.all_meetings:
             unproxied_event = removeSecurityProxy(event)
             requirement = self.makeRequirement(unproxied_event)
             score = IEvaluateRequirement(requirement).getEvaluation(
@@ -2705,30 +3176,39 @@ class FlourishAttendanceValidateScoreView(flourish.ajax.AJAXPart):
         json = self.setJSONResponse(data)
         return json
 
-    @property
-    def requirement(self):
-        activity_id = self.request.get('activity_id')
+    def isValidActivity(self, activity_id):
         if activity_id is None:
-            return None
+            return False
         dts = base64.decodestring(activity_id.strip())
         try:
-            dt = parse(dts)
+            parse(dts)
         except ValueError:
-            return None
-        meeting = makeSchoolAttendanceMeeting(dt)
-        requirement = HomeroomRequirement(meeting)
-        return requirement
+            return False
+        return True
 
     def validate_score(self):
-        score = self.request.get('score')
-        result = {'is_valid': True,
-                  'is_extracredit': False}
-        requirement = self.requirement
-        if requirement is None:
-            result['is_valid'] = False
-        else:
-            result['is_valid'] = requirement.score_system.isValidScore(score)
-        return result
+        """Validate a score, or lists of activity ids and scores."""
+        activity_ids = self.request.get('activity_id')
+        scores = self.request.get('score')
+        # All school attendance meetings share the homeroom score system
+        score_system = HomeroomRequirement.score_system
+        if not isinstance(scores, list):
+            result = {'is_valid': (self.isValidActivity(activity_ids) and
+                                   score_system.isValidScore(scores)),
+                      'is_extracredit': False}
+            return result
+        if not isinstance(activity_ids, list):
+            activity_ids = [activity_ids] * len(scores)
+        results = []
+        for activity_id, score in zip(activity_ids, scores):
+            results.append({
+                'activity_id': activity_id,
+                'score': score,
+                'is_valid': (self.isValidActivity(activity_id) and
+                             score_system.isValidScore(score)),
+                'is_extracredit': False,
+                })
+        return {'results': results}
 
 
 class RefineFormManager(flourish.page.ContentViewletManager):
@@ -2839,7 +3319,7 @@ class FlourishSchoolAttendanceGroupPicker(OptionalViewlet):
                 ISchoolYear(selected_group.__parent__).__name__,
                 selected_group.__name__)
 
-        collator = ICollator(self.request.locale)
+        collator = getCollator(self.request.locale)
         for year in self.view.schoolyears:
             key = lambda g: '%s.%s' % (year.__name__, g.__name__)
             groups = sorted(IGroupContainer(year).values(),
@@ -2867,20 +3347,19 @@ class FlourishSchoolAttendanceInstructorPicker(OptionalViewlet):
 
     @Lazy
     def instructors(self):
-        instructors = set()
         selected_instructor = self.view.instructor
         selected_username = selected_instructor and selected_instructor.__name__
 
-        for term in self.view.terms:
-            sections = ISectionContainer(term)
-            for section in sections.values():
-                if len(section.members.all()):
-                    instructors.update(section.instructors)
-
-        collator = ICollator(self.request.locale)
-        factory = getUtility(IPersonFactory)
-        sorting_key = lambda x: factory.getSortingKey(x, collator)
-        instructors = sorted(instructors, key=sorting_key)
+        index = getStudentIndex()
+        collator = getCollator(self.request.locale)
+        terms = self.view.terms
+        if len(terms) == 1:
+            instructors = index.termInstructors(terms[0], collator)
+        else:
+            instructors = set()
+            for term in terms:
+                instructors.update(index.termInstructors(term, collator))
+            instructors = sorted(instructors, key=collator.personKey)
 
         result = [
             {'title': instructor.title,
@@ -3187,7 +3666,6 @@ class EnrollmentModesSelector(flourish.viewlet.Viewlet):
         mode = getCurrentEnrollmentMode(self.person)
         if mode is None:
             mode = self.content.default_mode
-            setCurrentEnrollmentMode(self.person, mode)
         return mode
 
     def update(self):
@@ -3204,12 +3682,36 @@ class EnrollmentModesSelector(flourish.viewlet.Viewlet):
         return self.template(*args, **kw)
 
 
+def getExportSince(request):
+    """Parse the since parameter of a journal export as naive UTC.
+
+    Timestamps without a time zone are taken to be in UTC.
+    """
+    since = request.get('since', '').strip()
+    if not since:
+        return None
+    try:
+        since = parse(since)
+    except (ValueError, OverflowError):
+        raise UserError(_('Invalid timestamp: ${since}',
+                          mapping={'since': since}))
+    if since.tzinfo is not None:
+        since = since.astimezone(pytz.utc).replace(tzinfo=None)
+    app = ISchoolToolApplication(None)
+    pruned = app['schooltool.lyceum.journal'].changes_pruned
+    if pruned is not None and since < pruned:
+        raise UserError(_('Changes before ${date} are not kept',
+                          mapping={'date': pruned.date().isoformat()}))
+    return since
+
+
 class JournalDataExportRequestView(RequestXLSReportDialog):
 
-    report_builder = 'journal_data_export.xls'
+    report_builder = 'journal_data_export.xlsx'
+    task_factory = XLSXReportTask
 
 
-class JournalDataExportView(export.ExcelExportView):
+class JournalDataExportView(JournalWorkbookMixin, export.ExcelExportView):
 
     @property
     def base_filename(self):
@@ -3219,10 +3721,6 @@ class JournalDataExportView(export.ExcelExportView):
         filename = filename.replace(' ', '_')
         return filename
 
-    def studentSortKey(self, value):
-        student = self.persons[value['student']['id']]
-        return IDemographics(student).get('ID', '')
-
     def addImporters(self, progress):
         self.task_progress.add('journal', title=_('Journal'), progress=0.0)
 
@@ -3233,85 +3731,39 @@ class JournalDataExportView(export.ExcelExportView):
         self.makeProgress()
         self.task_progress.title = _("Exporting")
         self.addImporters(self.task_progress)
-        workbook = xlwt.Workbook()
-        self.export_data(workbook)
+        workbook = self.makeWorkbook()
+        try:
+            self.export_data(workbook)
+        except:
+            self.discardWorkbook(workbook)
+            raise
         return workbook
 
+    # Number of export processes, all processors if None
+    export_workers = None
+
     def export_data(self, wb):
-        sections = sorted(ISectionContainer(self.context).values(),
-                          key=lambda s: s.title)
-        count = len(sections)
-        for i, section in enumerate(sections):
-            schedules = IScheduleContainer(section)
-            if not schedules:
-                continue
-            self.add_attendance_worksheet(wb, section)
-            self.add_homeroom_worksheet(wb, section)
-            self.add_scores_worksheet(wb, section)
+        engine = JournalExportEngine(self.context, self.tzinfo,
+                                     since=getExportSince(self.request))
+        count = len(engine.sections)
+        sheets_by_section = ParallelJournalExport(engine, self.export_workers)
+        for i, (section, sheets) in enumerate(sheets_by_section):
+            for sheet in sheets:
+                self.add_worksheet(wb, sheet)
             self.progress('journal', normalized_progress(i, count))
         self.finish('journal')
-
-    def add_attendance_worksheet(self, wb, section):
-        journal = ISectionJournal(section)
-        view = queryMultiAdapter(
-            (journal, self.request), name='index.html')
-        title = '%s-%s' % (translate(_('Attendance'), context=self.request),
-                           section.__name__)
-        ws = wb.add_sheet(title[:31])
-        self.print_section_details(ws, section, _('Attendance'))
-        activities = self.getActivities(view)
-        self.print_headers(ws, activities)
-        self.print_grades(ws, view.table())
-
-    def add_homeroom_worksheet(self, wb, section):
-        takes_day_attendance = True
-        journal = ISectionJournal(section)
-        view = queryMultiAdapter(
-            (journal, self.request), name='homeroom.html')
-        if (view is None or
-            not view.all_meetings):
-            takes_day_attendance = False
-        if takes_day_attendance:
-            title = '%s-%s' % (translate(_('Homeroom'), context=self.request),
-                               section.__name__)
-            ws = wb.add_sheet(title[:31])
-            self.print_section_details(ws, section, _('Homeroom'))
-            activities = self.getActivities(view)
-            self.print_headers(ws, activities)
-            self.print_grades(ws, view.table())
-
-    def add_scores_worksheet(self, wb, section):
-        journal = ISectionJournal(section)
-        view = queryMultiAdapter(
-            (journal, self.request), name='grades.html')
-        title = '%s-%s' % (translate(_('Scores'), context=self.request),
-                           section.__name__)
+        if sheets_by_section.fallback is not None:
+            self.task_progress.add('journal_workers',
+                                   title=sheets_by_section.fallback,
+                                   progress=1.0)
+
+    def add_worksheet(self, wb, sheet):
+        title = '%s-%s' % (translate(sheet.title, context=self.request),
+                           sheet.section.__name__)
         ws = wb.add_sheet(title[:31])
-        self.print_section_details(ws, section, _('Scores'))
-        activities = self.getActivities(view)
-        self.print_headers(ws, activities)
-        self.print_grades(ws, view.table())
-
-    def getActivities(self, view):
-        activities = []
-        for meeting in view.all_meetings:
-            info = {}
-            insecure_meeting = removeSecurityProxy(meeting)
-            meetingDate = insecure_meeting.dtstart.astimezone(self.tzinfo).date()
-            info['date'] = meetingDate
-            try:
-                if meeting.period is not None:
-                    short_title = meeting.period.title
-                else:
-                    short_title = ''
-                period = short_title
-                if period[-1] == ':':
-                    period = period[:-1]
-            except:
-                period = ''
-            info['period'] = period
-            activities.append(info)
-        return activities
+        self.print_section_details(ws, sheet.section, sheet.title)
+        self.print_headers(ws, sheet.activities)
+        self.print_grades(ws, sheet.rows())
 
     def print_section_details(self, ws, section, title):
         starting_row = 0
@@ -3328,16 +3780,18 @@ class JournalDataExportView(export.ExcelExportView):
         header = export.Text(title)
         self.write(ws, starting_row+2, 1, header.data, **header.style)
 
-    def print_grades(self, ws, table):
+    def print_grades(self, ws, rows):
         starting_row = 6
-        table = sorted(table, key=lambda x:self.studentSortKey)
-        for i, row in enumerate(table):
-            student = self.persons[row['student']['id']]
-            cells = [export.Text(IDemographics(student).get('ID', '')),
-                     export.Text(student.first_name),
-                     export.Text(student.last_name)]
-            for grade in row['grades']:
-                value = grade['value']
+        cleared = translate(_('(cleared)'), context=self.request)
+        for i, (student_id, first_name, last_name, values) in enumerate(rows):
+            cells = [export.Text(student_id),
+                     export.Text(first_name),
+                     export.Text(last_name)]
+            for value in values:
+                if value is None:
+                    value = ''
+                elif value is CLEARED:
+                    value = cleared
                 cells.append(export.Text(value))
             for col, cell in enumerate(cells):
                 self.write(ws, starting_row+i, col, cell.data, **cell.style)
@@ -3356,6 +3810,124 @@ class JournalDataExportView(export.ExcelExportView):
             self.write(ws, starting_row+1, col, header.data, **header.style)
 
 
+class JournalDataExportXLSXView(JournalDataExportView):
+
+    workbook_factory = XLSXWorkbook
+
+
+class JournalRecordsResult(object):
+    """Lines of a records export, sent in chunks as they are built.
+
+    The publisher closes the database connection of the request before
+    the response is sent, so records are read through a connection of
+    their own, as of the last transaction when the export started.
+    """
+    implements(IResult)
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, view, target, since):
+        self.view = view
+        self.db = target._p_jar.db()
+        self.tid = self.db.lastTransaction()
+        self.oid = target._p_oid
+        self.since = since
+
+    def __iter__(self):
+        connection = self.db.open(at=self.tid)
+        old_site = getSite()
+        try:
+            app = connection.root()[ZopePublication.root_name]
+            setSite(app)
+            engine = self.view.getEngine(connection.get(self.oid), self.since)
+            chunk = []
+            size = 0
+            for line in self.view.iterLines(engine.iterRecords()):
+                chunk.append(line)
+                size += len(line)
+                if size >= self.chunk_size:
+                    yield ''.join(chunk)
+                    chunk = []
+                    size = 0
+            if chunk:
+                yield ''.join(chunk)
+        finally:
+            setSite(old_site)
+            transaction.abort()
+            connection.close()
+
+
+class JournalRecordsExportBase(BrowserView):
+    """Evaluations of a term or a section journal, one record per line.
+
+    The response is a JournalRecordsResult that walks sections one at a
+    time and sends the lines of iterLines(records) of subclasses in
+    chunks, nothing is built before the response starts.  With a since
+    parameter only evaluations changed after it are exported.
+    """
+
+    content_type = None
+    extension = None
+
+    def getEngine(self, target, since):
+        if ISection.providedBy(target):
+            return JournalExportEngine(ITerm(target), sections=[target],
+                                       since=since)
+        return JournalExportEngine(target, since=since)
+
+    @property
+    def filename(self):
+        if ISectionJournal.providedBy(self.context):
+            name = self.context.section.__name__
+        else:
+            name = self.context.__name__
+        return 'journal_%s.%s' % (name, self.extension)
+
+    def __call__(self):
+        since = getExportSince(self.request)
+        if ISectionJournal.providedBy(self.context):
+            target = self.context.section
+        else:
+            target = self.context
+        result = JournalRecordsResult(self, removeSecurityProxy(target), since)
+        response = self.request.response
+        response.setHeader('Content-Type', self.content_type)
+        response.setHeader('Content-Disposition',
+                           'attachment; filename="%s"' % self.filename)
+        return result
+
+
+class JournalCSVExportView(JournalRecordsExportBase):
+
+    content_type = 'text/csv; charset=utf-8'
+    extension = 'csv'
+
+    def iterLines(self, records):
+        line = StringIO()
+        writer = csv.writer(line)
+        writer.writerow(RECORD_FIELDS)
+        yield line.getvalue()
+        for record in records:
+            line.seek(0)
+            line.truncate()
+            writer.writerow([
+                    unicode(record[field]).encode('UTF-8')
+                    if record[field] is not None else ''
+                    for field in RECORD_FIELDS])
+            yield line.getvalue()
+
+
+class JournalNDJSONExportView(JournalRecordsExportBase):
+
+    content_type = 'application/x-ndjson'
+    extension = 'ndjson'
+
+    def iterLines(self, records):
+        encoder = flourish.tal.JSONEncoder()
+        for record in records:
+            yield encoder.encode(record) + '\n'
+
+
 class AttendanceSummaryRequestView(RequestRemoteReportDialog):
 
     report_builder = 'attendance_summary.pdf'
@@ -3418,17 +3990,21 @@ class AttendanceSummaryPDFView(flourish.report.PlainPDFPage):
     @Lazy
     def scores(self):
         result = {}
-        factory = AttendanceRequirement
-        for person in self.members:
+        members = [removeSecurityProxy(person) for person in self.members]
+        matrix = None
+        for n, person in enumerate(members):
             result[person] = {}
-            for meeting, score in self.context.gradedMeetings(person, factory):
-                if (score is not None and
-                    score is not UNSCORED and
-                    score.value is not UNSCORED):
-                    tag = score.value.lower()
-                    if tag not in result[person]:
-                        result[person][tag] = []
-                    result[person][tag].append(1)
+            counts = self.context.getScoreCounts(
+                person, AttendanceRequirement, term=ITerm(self.section))
+            if counts is None:
+                if matrix is None:
+                    matrix = self.context.getEvaluationMatrix(
+                        members, self.context.meetings, AttendanceRequirement)
+                counts = countScores([score for score in matrix[n]
+                                      if score is not None])
+            for score, count in counts:
+                tag = score.value.lower()
+                result[person][tag] = result[person].get(tag, 0) + count
         return result
 
     def score_column(self, tag):
@@ -3436,7 +4012,7 @@ class AttendanceSummaryPDFView(flourish.report.PlainPDFPage):
             person = removeSecurityProxy(i)
             scores = self.scores[person]
             if tag in scores:
-                return len(scores[tag])
+                return scores[tag]
         return getter
 
 
@@ -3446,8 +4022,8 @@ class AttendanceSummaryPDFView(flourish.report.PlainPDFPage):
         result = []
         absent_excused = []
         absent = []
-        collator = ICollator(self.request.locale)
-        sorting_key = lambda tag: collator.key(tag)
+        collator = getCollator(self.request.locale)
+        sorting_key = collator.key
         for tag in ss.tag_absent:
             if tag in ss.tag_excused:
                 absent_excused.append(tag)
@@ -3468,8 +4044,8 @@ class AttendanceSummaryPDFView(flourish.report.PlainPDFPage):
         result = []
         tardy_excused = []
         tardy = []
-        collator = ICollator(self.request.locale)
-        sorting_key = lambda tag: collator.key(tag)
+        collator = getCollator(self.request.locale)
+        sorting_key = collator.key
         for tag in ss.tag_tardy:
             if tag in ss.tag_excused:
                 tardy_excused.append(tag)
@@ -573,9 +573,842 @@ def doctest_SectionListView():
     """
 
 
+def doctest_JournalGrid():
+    """Tests for JournalGrid.
+
+        >>> from schooltool.lyceum.journal.browser.journal import JournalGrid
+
+    A grid holds batched rows of values, hints and score counts aligned
+    with its students:
+
+        >>> grid = JournalGrid(['john', 'pete'], set(['john']),
+        ...                    ['m1', 'm2'],
+        ...                    [['5', None], [None, '4']],
+        ...                    [[None, 'a'], [None, None]],
+        ...                    [[('5', 1)], [('4', 1)]])
+
+        >>> for student, values, hints, counts in grid:
+        ...     print student, values, hints, counts
+        john ['5', None] [None, 'a'] [('5', 1)]
+        pete [None, '4'] [None, None] [('4', 1)]
+
+        >>> grid.isActive('john'), grid.isActive('pete')
+        (True, False)
+
+    If active students are not known, all students are active:
+
+        >>> grid.active = None
+        >>> grid.isActive('pete')
+        True
+
+    """
+
+
+def doctest_FlourishLyceumSectionJournalGrades_table():
+    """Tests for batched rows of FlourishLyceumSectionJournalGrades.
+
+        >>> from decimal import Decimal
+        >>> from zope.component import provideUtility
+        >>> from zope.intid.interfaces import IIntIds
+        >>> from zope.keyreference.interfaces import IKeyReference
+        >>> from schooltool.app.interfaces import ISchoolToolApplication
+        >>> from schooltool.app.interfaces import ISchoolToolCalendar
+        >>> from schooltool.course.interfaces import ISection
+        >>> from schooltool.requirement.evaluation import Evaluations
+        >>> from schooltool.requirement.interfaces import IEvaluations
+        >>> from schooltool.requirement.testing import KeyReferenceStub
+        >>> from schooltool.lyceum.journal.interfaces import ISectionJournalData
+        >>> from schooltool.lyceum.journal.interfaces import IEvaluateRequirement
+        >>> from schooltool.lyceum.journal.journal import GradeRequirement
+        >>> from schooltool.lyceum.journal.journal import LyceumJournalContainer
+        >>> from schooltool.lyceum.journal.journal import SectionJournalData
+        >>> from schooltool.lyceum.journal.journal import countScores
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     FlourishLyceumSectionJournalGrades
+
+        >>> journal_container = LyceumJournalContainer()
+        >>> class STAppStub(dict):
+        ...     def __init__(self, context):
+        ...         self['schooltool.lyceum.journal'] = journal_container
+        >>> provideAdapter(STAppStub, adapts=[None],
+        ...                provides=ISchoolToolApplication)
+
+        >>> class IntIdsStub(object):
+        ...     implements(IIntIds)
+        ...     def getId(self, obj):
+        ...         return obj.intid
+        ...     def queryId(self, obj, default=None):
+        ...         return getattr(obj, 'intid', default)
+        >>> provideUtility(IntIdsStub())
+
+    A section with a calendar of three meetings, two of them in May:
+
+        >>> class SectionStub(object):
+        ...     def __conform__(self, iface):
+        ...         if iface == ISchoolToolCalendar:
+        ...             return calendar
+        >>> section = SectionStub()
+        >>> journal = SectionJournalData()
+        >>> provideAdapter(lambda jd: section,
+        ...                adapts=(ISectionJournalData, ), provides=ISection)
+        >>> provideAdapter(KeyReferenceStub,
+        ...                adapts=(SectionStub, ), provides=IKeyReference)
+        >>> provideAdapter(lambda requirement: journal,
+        ...                adapts=(GradeRequirement, ),
+        ...                provides=IEvaluateRequirement)
+
+        >>> class CalendarStub(list):
+        ...     __parent__ = section
+        >>> calendar = CalendarStub()
+
+        >>> class MeetingStub(object):
+        ...     __parent__ = calendar
+        ...     meeting_id = None
+        ...     def __init__(self, uid, date):
+        ...         self.__name__ = self.unique_id = uid
+        ...         self.dtstart = datetime(date.year, date.month, date.day,
+        ...                                 tzinfo=utc)
+
+        >>> m1 = MeetingStub('m1', date(2011, 5, 5))
+        >>> m2 = MeetingStub('m2', date(2011, 5, 6))
+        >>> m3 = MeetingStub('m3', date(2011, 6, 1))
+        >>> calendar.extend([m1, m2, m3])
+
+        >>> class RootStub(object):
+        ...     implements(IContainmentRoot)
+        >>> root = RootStub()
+
+        >>> class PersonStub(object):
+        ...     __parent__ = root
+        ...     def __init__(self, username, intid):
+        ...         self.__name__ = self.username = username
+        ...         self.title = self.first_name = username.title()
+        ...         self.last_name = 'Smith'
+        ...         self.intid = intid
+        ...         self._evaluations = Evaluations()
+        >>> provideAdapter(lambda person: person._evaluations,
+        ...                adapts=(PersonStub, ), provides=IEvaluations)
+
+        >>> john = PersonStub('john', 1)
+        >>> pete = PersonStub('pete', 2)
+        >>> ann = PersonStub('ann', 3)
+
+        >>> journal.setGrade(john, m1, '5')
+        >>> journal.setGrade(john, m3, '7')
+        >>> journal.setGrade(pete, m2, '3')
+
+        >>> class TermStub(object):
+        ...     first = date(2011, 5, 1)
+        ...     last = date(2011, 6, 30)
+        ...     def __contains__(self, day):
+        ...         return self.first <= day <= self.last
+
+        >>> class JournalStub(object):
+        ...     pass
+        >>> context = JournalStub()
+        >>> context.section = section
+
+        >>> class ViewStub(FlourishLyceumSectionJournalGrades):
+        ...     def __init__(self, context, request):
+        ...         self.context = context
+        ...         self.request = request
+        ...         self._grade_cache = {}
+        ...         self._score_system_cache = {}
+        ...     meetings = [m1, m2]
+        ...     selected_term = TermStub()
+        ...     journal_data = journal
+        ...     def getDefaultScoreSystem(self):
+        ...         return GradeRequirement.score_system
+        ...     def getGridStudents(self):
+        ...         return [john, pete, ann], None
+        ...     def getStudentSortingKey(self):
+        ...         return lambda person: person.__name__
+        ...     def getHintMatrix(self, persons, meetings):
+        ...         return [[None] * len(meetings) for person in persons]
+
+    Rows of the grid are built from evaluations gathered in batches:
+
+        >>> view = ViewStub(context, TestRequest())
+        >>> rows = view.table()
+        >>> for row in rows:
+        ...     print row['student']['id'], row['student']['url'],
+        ...     print [grade['value'] for grade in row['grades']],
+        ...     print row['average']
+        ann http://127.0.0.1/ann ['', ''] N/A
+        john http://127.0.0.1/john [Decimal('5'), ''] 6.0
+        pete http://127.0.0.1/pete ['', Decimal('3')] 3.0
+
+    They hold the same values and averages as looking up every cell and
+    scanning the calendar of the term for each student:
+
+        >>> old_view = ViewStub(context, TestRequest())
+        >>> old_rows = []
+        >>> for person in sorted([john, pete, ann],
+        ...                      key=lambda person: person.__name__):
+        ...     values = [old_view.getGrade(person, meeting) or ''
+        ...               for meeting in old_view.meetings]
+        ...     counts = countScores(old_view.scanScores(person))
+        ...     old_rows.append((person.username, values,
+        ...                      old_view.average(person, counts)))
+
+        >>> [(row['student']['id'],
+        ...   [grade['value'] for grade in row['grades']],
+        ...   row['average']) for row in rows] == old_rows
+        True
+
+    """
+
+
+def doctest_FlourishLyceumSectionJournalBase_activities():
+    """Tests for FlourishLyceumSectionJournalBase.activities.
+
+        >>> import datetime
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     FlourishLyceumSectionJournalBase
+
+        >>> class PeriodStub(object):
+        ...     def __init__(self, title):
+        ...         self.title = title
+
+        >>> class MeetingStub(object):
+        ...     def __init__(self, name, day, period):
+        ...         self.__name__ = name
+        ...         self.dtstart = datetime.datetime(2011, 5, day, 9)
+        ...         self.period = PeriodStub(period)
+
+        >>> class ViewStub(FlourishLyceumSectionJournalBase):
+        ...     def __init__(self):
+        ...         pass
+        ...     meetings = [MeetingStub('m1', 5, 'A:'),
+        ...                 MeetingStub('m2', 6, 'Block B')]
+        ...     def meetingStart(self, meeting):
+        ...         return meeting.dtstart
+        ...     def getDefaultScoreSystem(self):
+        ...         return 'ss'
+        ...     def getScoreOptions(self, ss):
+        ...         print 'Listing scores of', ss
+        ...         return [{'value': 'p'}]
+
+    Every column header carries the score options the gradebook script
+    shows in its popups, they are encoded once for all columns:
+
+        >>> view = ViewStub()
+        >>> for info in view.activities:
+        ...     print sorted(info.items())
+        Listing scores of ss
+        [('cssClass', 'scorable'), ('hash', 'm1'), ('longTitle', '2011-05-05'),
+         ('period', 'A'), ('scores', '[{"value": "p"}]'),
+         ('shortTitle', '05')]
+        [('cssClass', 'scorable'), ('hash', 'm2'), ('longTitle', '2011-05-06'),
+         ('period', 'Blo'), ('scores', '[{"value": "p"}]'),
+         ('shortTitle', '06')]
+
+    """
+
+
+def doctest_FlourishLyceumSectionJournalBase_gridPayload():
+    """Tests for FlourishLyceumSectionJournalBase.gridPayload.
+
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     FlourishLyceumSectionJournalBase
+
+        >>> class JournalStub(object):
+        ...     pass
+
+        >>> class ViewStub(FlourishLyceumSectionJournalBase):
+        ...     def __init__(self, context, request):
+        ...         self.context = context
+        ...         self.request = request
+        ...     all_meetings = ['m1', 'm2']
+        ...     meetings = []
+        ...     active_month = 5
+        ...     active_year = 2011
+        ...     activities = [
+        ...         {'hash': 'm1', 'longTitle': '2011-05-05',
+        ...          'shortTitle': '05', 'period': 'A'},
+        ...         {'hash': 'm2', 'longTitle': '2011-05-06',
+        ...          'shortTitle': '06', 'period': 'B'}]
+        ...     def getDefaultScoreSystem(self):
+        ...         return 'ss'
+        ...     def getScoreOptions(self, ss):
+        ...         return [{'label': 'p: Present', 'value': 'p'}]
+        ...     def table(self):
+        ...         return [
+        ...             {'student': {'id': 'john', 'sortKey': 'j'},
+        ...              'grades': [{'value': 'p', 'hint': ''},
+        ...                         {'value': '', 'hint': ''}],
+        ...              'has_hints': False,
+        ...              'absences': '0'},
+        ...             {'student': {'id': 'pete', 'sortKey': 'p'},
+        ...              'grades': [{'value': 'n', 'hint': ''},
+        ...                         {'value': 'p', 'hint': ''}],
+        ...              'has_hints': False,
+        ...              'absences': '1'}]
+
+        >>> view = ViewStub(JournalStub(), TestRequest())
+
+    Students, meetings and score options are listed once, cells are
+    encoded as codes of a palette:
+
+        >>> payload = view.gridPayload()
+        >>> for student in payload['students']:
+        ...     print student['id'], student['totals']['absences']
+        john 0
+        pete 1
+        >>> [meeting['id'] for meeting in payload['meetings']]
+        ['m1', 'm2']
+        >>> [option['label'] for option in payload['scores']]
+        ['p: Present']
+        >>> payload['palette']
+        ['', 'p', 'n']
+        >>> payload['values']
+        [1, 0, 2, 1]
+
+    Hints are left out if no cell has them:
+
+        >>> print payload['hints']
+        None
+
+    A section without meetings has an empty grid:
+
+        >>> view.render_journal = False
+        >>> payload = view.gridPayload()
+        >>> payload['students'], payload['values']
+        ([], [])
+
+    """
+
+
+def doctest_FlourishJournalGridJSONView():
+    """Tests for FlourishJournalGridJSONView.
+
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     FlourishJournalGridJSONView
+
+        >>> class JournalViewStub(object):
+        ...     modified = True
+        ...     def updateCurrentJournal(self):
+        ...         print 'Remembering the current journal'
+        ...     def update(self):
+        ...         print 'Updating the journal view'
+        ...     def isNotModified(self):
+        ...         return not self.modified
+        ...     def gridPayload(self):
+        ...         return {'values': [1, 0]}
+
+    The journal view is updated before its grid is encoded:
+
+        >>> journal_view = JournalViewStub()
+        >>> request = TestRequest()
+        >>> view = FlourishJournalGridJSONView(journal_view, request)
+        >>> import json
+        >>> json.loads(view())
+        Remembering the current journal
+        Updating the journal view
+        {u'values': [1, 0]}
+        >>> request.response.getHeader('Content-Type')
+        'application/json'
+
+    Nothing is encoded or written if the grid did not change:
+
+        >>> journal_view.modified = False
+        >>> view()
+        ''
+
+    """
+
+
+def doctest_getPersonSerial():
+    """Tests for getPersonSerial.
+
+        >>> from schooltool.lyceum.journal.browser.collation import \\
+        ...     getPersonSerial
+
+    Ghosts are loaded before their serial is read:
+
+        >>> class PersonStub(object):
+        ...     _p_serial = '\\0' * 8
+        ...     def _p_activate(self):
+        ...         print 'Loading'
+        ...         self._p_serial = 'serial-1'
+
+        >>> getPersonSerial(PersonStub())
+        Loading
+        'serial-1'
+
+    Objects that are not persistent have no serial:
+
+        >>> print getPersonSerial(object())
+        None
+
+    """
+
+
+def doctest_ConditionalGetMixin():
+    """Tests for ConditionalGetMixin.
+
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     ConditionalGetMixin
+
+        >>> class ViewStub(ConditionalGetMixin):
+        ...     stamp = (1, 'john')
+        ...     def __init__(self, request):
+        ...         self.request = request
+        ...     def getCacheStamp(self):
+        ...         return self.stamp
+        ...     def getLastModified(self):
+        ...         return datetime(2011, 5, 5, 10, 30)
+
+    The first request gets validators of the response:
+
+        >>> request = TestRequest()
+        >>> view = ViewStub(request)
+        >>> view.isNotModified()
+        False
+        >>> etag = request.response.getHeader('ETag')
+        >>> request.response.getHeader('Last-Modified')
+        'Thu, 05 May 2011 10:30:00 GMT'
+
+    A request with a matching ETag is answered with 304:
+
+        >>> request = TestRequest(HTTP_IF_NONE_MATCH=etag)
+        >>> view = ViewStub(request)
+        >>> view.isNotModified()
+        True
+        >>> request.response.getStatus()
+        304
+
+    Once the stamp changes, the page is sent again:
+
+        >>> request = TestRequest(HTTP_IF_NONE_MATCH=etag)
+        >>> view = ViewStub(request)
+        >>> view.stamp = (2, 'john')
+        >>> view.isNotModified()
+        False
+
+    Clients that only know the modification time get 304 while nothing
+    changed after it:
+
+        >>> request = TestRequest(
+        ...     HTTP_IF_MODIFIED_SINCE='Thu, 05 May 2011 10:30:00 GMT')
+        >>> ViewStub(request).isNotModified()
+        True
+        >>> request.response.getStatus()
+        304
+
+        >>> request = TestRequest(
+        ...     HTTP_IF_MODIFIED_SINCE='Thu, 05 May 2011 10:29:59 GMT')
+        >>> ViewStub(request).isNotModified()
+        False
+
+        >>> request = TestRequest(HTTP_IF_MODIFIED_SINCE='garbage')
+        >>> ViewStub(request).isNotModified()
+        False
+
+    The ETag wins if the request has both:
+
+        >>> request = TestRequest(
+        ...     HTTP_IF_NONE_MATCH='"other"',
+        ...     HTTP_IF_MODIFIED_SINCE='Thu, 05 May 2011 10:30:00 GMT')
+        >>> ViewStub(request).isNotModified()
+        False
+
+    POST requests are never answered from the cache:
+
+        >>> request = TestRequest(HTTP_IF_NONE_MATCH=etag,
+        ...                       REQUEST_METHOD='POST')
+        >>> ViewStub(request).isNotModified()
+        False
+
+    """
+
+
+def doctest_FlourishLyceumSectionJournalBase_validate_score():
+    """Tests for score validation of journals.
+
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     FlourishLyceumSectionJournalBase
+        >>> from schooltool.lyceum.journal.journal import AbsenceScoreSystem
+
+        >>> class MeetingStub(object):
+        ...     def __init__(self, name):
+        ...         self.__name__ = name
+
+        >>> class MeetingIndexStub(object):
+        ...     meetings = {'m1': MeetingStub('m1'), 'm2': MeetingStub('m2')}
+        ...     def getMeeting(self, name):
+        ...         print 'Looking up', name
+        ...         return self.meetings.get(name)
+
+        >>> class RequirementStub(object):
+        ...     score_system = AbsenceScoreSystem
+
+        >>> class ViewStub(FlourishLyceumSectionJournalBase):
+        ...     def __init__(self, request):
+        ...         self.request = request
+        ...         self._score_system_cache = {}
+        ...     meeting_index = MeetingIndexStub()
+        ...     meetings = [MeetingIndexStub.meetings['m1']]
+        ...     def makeRequirement(self, meeting):
+        ...         return RequirementStub()
+
+    Scores are validated against the score system of their meeting,
+    each meeting is looked up once per request:
+
+        >>> import json
+        >>> view = ViewStub(TestRequest())
+        >>> json.loads(view.validate_score('m1', 'a'))
+        Looking up m1
+        {u'is_valid': True, u'is_extracredit': False}
+        >>> json.loads(view.validate_score('m1', 'x'))
+        {u'is_valid': False, u'is_extracredit': False}
+
+        >>> [view.isValidScore(activity_id, score)
+        ...  for activity_id, score in [('m1', 'a'), ('m1', 'x'),
+        ...                             ('m1', ''), ('m3', 'x')]]
+        Looking up m3
+        [True, False, True, True]
+
+    The score and the meeting can come from the request:
+
+        >>> request = TestRequest(form={'activity_id': 'm1', 'score': 'x'})
+        >>> json.loads(ViewStub(request).validate_score())
+        Looking up m1
+        {u'is_valid': False, u'is_extracredit': False}
+
+    """
+
+
+def doctest_FlourishLyceumSectionJournalBase_evaluateChanges():
+    """Tests for FlourishLyceumSectionJournalBase.evaluateChanges.
+
+        >>> from zope.interface import implements
+        >>> from ZODB.POSException import ConflictError
+        >>> from schooltool.lyceum.journal.interfaces import \\
+        ...     IEvaluateRequirement
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     FlourishLyceumSectionJournalBase
+
+        >>> conflicts = ['s2']
+        >>> class EvaluateStub(object):
+        ...     implements(IEvaluateRequirement)
+        ...     def __init__(self, requirement):
+        ...         self.target = requirement[3]
+        ...     def evaluateMany(self, changes, evaluator=None):
+        ...         print 'Storing', self.target, [c[2] for c in changes]
+        ...         if self.target in conflicts:
+        ...             conflicts.remove(self.target)
+        ...             raise ConflictError
+
+        >>> from zope.component import provideAdapter
+        >>> provideAdapter(EvaluateStub, adapts=[tuple],
+        ...                provides=IEvaluateRequirement)
+
+    Changes are stored in one batch per target, a batch that runs into
+    a conflict is stored once more, the other batches are not repeated:
+
+        >>> changes = [('p1', ('grade', 'd1', 'm1', 's1'), '5'),
+        ...            ('p2', ('grade', 'd1', 'm1', 's2'), '4'),
+        ...            ('p2', ('grade', 'd2', 'm2', 's1'), '3')]
+        >>> view = FlourishLyceumSectionJournalBase(None, None)
+        >>> view.evaluateChanges(sorted(changes), 'teacher')
+        Storing s2 ['4']
+        Storing s2 ['4']
+        Storing s1 ['5', '3']
+
+    A batch is retried once, conflicts of the retry and other errors
+    are raised:
+
+        >>> conflicts.extend(['s1', 's1'])
+        >>> view.evaluateChanges(changes[:1], 'teacher')
+        Traceback (most recent call last):
+          ...
+        ConflictError: database conflict error
+
+        >>> class BrokenEvaluateStub(EvaluateStub):
+        ...     def evaluateMany(self, changes, evaluator=None):
+        ...         print 'Storing', self.target
+        ...         raise ValueError(self.target)
+        >>> provideAdapter(BrokenEvaluateStub, adapts=[tuple],
+        ...                provides=IEvaluateRequirement)
+        >>> del conflicts[:]
+        >>> view.evaluateChanges(changes[:1], 'teacher')
+        Traceback (most recent call last):
+          ...
+        ValueError: s1
+
+    """
+
+
+def doctest_FlourishLyceumSectionJournalBase_getGridStudents():
+    """Tests for FlourishLyceumSectionJournalBase.getGridStudents.
+
+        >>> from schooltool.app.states import ACTIVE
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     FlourishLyceumSectionJournalBase
+
+        >>> class JournalStub(object):
+        ...     pass
+
+        >>> class ViewStub(FlourishLyceumSectionJournalBase):
+        ...     def __init__(self, context, request):
+        ...         self.context = context
+        ...         self.request = request
+        ...     def members(self):
+        ...         return ['john', 'pete', 'ann']
+        ...     membership_states = {
+        ...         'john': (ACTIVE, 'a'),
+        ...         'pete': ('i', 'w'),
+        ...         'ann': (ACTIVE, 'a'),
+        ...         }
+
+    Active members are found from today's membership states of the
+    section, only they are shown by default:
+
+        >>> view = ViewStub(JournalStub(), TestRequest())
+        >>> students, active = view.getGridStudents()
+        >>> students
+        ['john', 'ann']
+        >>> sorted(active)
+        ['ann', 'john']
+
+    """
+
+
+def doctest_JournalDataExportView_print_grades():
+    """Tests for JournalDataExportView.print_grades.
+
+        >>> from decimal import Decimal
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     JournalDataExportView
+        >>> from schooltool.lyceum.journal.dataexport import CLEARED
+
+        >>> class ViewStub(JournalDataExportView):
+        ...     def __init__(self):
+        ...         self.request = None
+        ...     def write(self, ws, row, col, data, **style):
+        ...         print row, col, repr(data)
+
+    Cells without scores are left empty, zero scores are kept:
+
+        >>> rows = [('001', 'John', 'Smith', [Decimal('5'), None]),
+        ...         ('002', 'Pete', 'Brown', [Decimal('0'), 'a'])]
+        >>> ViewStub().print_grades(None, rows)
+        6 0 '001'
+        6 1 'John'
+        6 2 'Smith'
+        6 3 Decimal('5')
+        6 4 ''
+        7 0 '002'
+        7 1 'Pete'
+        7 2 'Brown'
+        7 3 Decimal('0')
+        7 4 'a'
+
+    Evaluations cleared since the time of the export are marked:
+
+        >>> rows = [('001', 'John', 'Smith', [CLEARED, None])]
+        >>> ViewStub().print_grades(None, rows)
+        6 0 '001'
+        6 1 'John'
+        6 2 'Smith'
+        6 3 u'(cleared)'
+        6 4 ''
+
+    """
+
+
+def doctest_FlourishRequestJournalExportBase():
+    """Tests for FlourishRequestJournalExportBase.
+
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     FlourishRequestJournalExportGrades
+        >>> from schooltool.lyceum.journal.journal import \\
+        ...     JournalXLSReportTask, JournalXLSXReportTask
+
+        >>> def makeView(**form):
+        ...     view = FlourishRequestJournalExportGrades.__new__(
+        ...         FlourishRequestJournalExportGrades)
+        ...     view.request = TestRequest(form=form)
+        ...     return view
+
+    Grades are exported as XLS workbooks unless XLSX is chosen:
+
+        >>> view = makeView()
+        >>> view.report_builder, view.task_factory is JournalXLSReportTask
+        ('grades.xls', True)
+
+        >>> view = makeView(format='xlsx')
+        >>> view.report_builder, view.task_factory is JournalXLSXReportTask
+        ('grades.xlsx', True)
+        >>> [(option['value'], option['selected'])
+        ...  for option in view.format_options()]
+        [('xls', False), ('xlsx', True)]
+
+        >>> makeView(format='../secret').report_builder
+        'grades.xls'
+
+    XLSX report tasks keep the section journal context of XLS ones:
+
+        >>> JournalXLSXReportTask.default_filename
+        'report.xlsx'
+        >>> JournalXLSXReportTask.default_mimetype
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        >>> JournalXLSXReportTask.context is JournalXLSReportTask.context
+        True
+
+    """
+
+
+def doctest_JournalRecordsResult():
+    """Tests for JournalRecordsResult.
+
+        >>> from zope.app.publication.zopepublication import ZopePublication
+        >>> from zope.component import getGlobalSiteManager
+        >>> from zope.component.hooks import getSite
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     JournalRecordsResult, JournalCSVExportView
+        >>> from schooltool.lyceum.journal.dataexport import RECORD_FIELDS
+
+        >>> class AppStub(object):
+        ...     def getSiteManager(self):
+        ...         return getGlobalSiteManager()
+        ...     def __repr__(self):
+        ...         return '<app>'
+
+        >>> class ConnectionStub(object):
+        ...     def __init__(self, at):
+        ...         print 'Opened at', at
+        ...     def root(self):
+        ...         return {ZopePublication.root_name: AppStub()}
+        ...     def get(self, oid):
+        ...         return 'term %s' % oid
+        ...     def close(self):
+        ...         print 'Closed'
+
+        >>> class DBStub(object):
+        ...     open = ConnectionStub
+        ...     def lastTransaction(self):
+        ...         return 'tid-1'
+
+        >>> class TermStub(object):
+        ...     _p_oid = 'oid-1'
+        ...     _p_jar = ConnectionStub.__new__(ConnectionStub)
+        ...     _p_jar.db = DBStub
+
+        >>> class EngineStub(object):
+        ...     def __init__(self, target, since):
+        ...         print 'Exporting %s since %s in %s' % (target, since,
+        ...                                                getSite())
+        ...     def iterRecords(self):
+        ...         for n in range(5):
+        ...             yield dict.fromkeys(RECORD_FIELDS, 'v%d' % n)
+
+        >>> class ViewStub(JournalCSVExportView):
+        ...     def __init__(self):
+        ...         pass
+        ...     getEngine = EngineStub
+
+    Nothing is read until the response is sent, then records are read
+    through a connection of their own and sent in chunks:
+
+        >>> result = JournalRecordsResult(ViewStub(), TermStub(), 'since')
+        >>> result.chunk_size = 100
+        >>> chunks = iter(result)
+        >>> chunks.next().splitlines()
+        Opened at tid-1
+        Exporting term oid-1 since since in <app>
+        ['term,section_id,section,...', 'v0,v0,v0,...']
+        >>> [chunk.count('\\n') for chunk in chunks]
+        Closed
+        [3, 1]
+        >>> print getSite()
+        None
+
+    """
+
+
+def doctest_JournalNDJSONExportView_iterLines():
+    """Tests for JournalNDJSONExportView.iterLines.
+
+        >>> from schooltool.lyceum.journal.browser.journal import \\
+        ...     JournalNDJSONExportView
+
+        >>> view = JournalNDJSONExportView(None, TestRequest())
+        >>> list(view.iterLines([{'student': 'john', 'value': None}]))
+        ['{"student": "john", "value": null}\\n']
+
+    """
+
+
+def doctest_CachingCollator():
+    """Tests for CachingCollator.
+
+        >>> from schooltool.lyceum.journal.browser.collation import \\
+        ...     CachingCollator
+
+        >>> class CollatorStub(object):
+        ...     def key(self, text):
+        ...         print 'Collating', text
+        ...         return text.lower()
+
+        >>> collator = CachingCollator(CollatorStub())
+        >>> collator.key('Smith')
+        Collating Smith
+        'smith'
+        >>> collator.key('Smith')
+        'smith'
+
+    Sorting keys of persons are cached until the person changes:
+
+        >>> class PersonStub(object):
+        ...     __name__ = 'john'
+        ...     first_name = 'John'
+        ...     last_name = 'Smith'
+        ...     _p_serial = 'serial-1'
+        >>> john = PersonStub()
+
+        >>> collator.personKey(john, 'first_name')
+        Collating John
+        ('john', 'smith')
+        >>> collator.personKey(john, 'first_name')
+        ('john', 'smith')
+
+        >>> john.first_name = 'Jon'
+        >>> john._p_serial = 'serial-2'
+        >>> collator.personKey(john, 'first_name')
+        Collating Jon
+        ('jon', 'smith')
+
+    Ghosts are loaded to get their serial, they all look unchanged
+    before that:
+
+        >>> class GhostStub(PersonStub):
+        ...     _p_serial = '\\0' * 8
+        ...     def __init__(self, name, first_name, serial):
+        ...         self.__name__ = name
+        ...         self.first_name = first_name
+        ...         self.serial = serial
+        ...     def _p_activate(self):
+        ...         self._p_serial = self.serial
+
+        >>> collator.personKey(GhostStub('pete', 'Pete', 'serial-1'),
+        ...                    'first_name')
+        Collating Pete
+        ('pete', 'smith')
+        >>> collator.personKey(GhostStub('pete', 'Peter', 'serial-2'),
+        ...                    'first_name')
+        Collating Peter
+        ('peter', 'smith')
+
+    """
+
+
 def setUp(test):
     setup.placelessSetUp()
     setup.setUpTraversal()
+    from schooltool.lyceum.journal.browser import collation
+    collation._collators.clear()
 
 
 def tearDown(test):
@@ -0,0 +1,519 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Term-wide export of journal data.
+"""
+import itertools
+import logging
+import multiprocessing
+import pytz
+import threading
+import transaction
+from ZODB.DB import DB
+
+from zope.app.publication.zopepublication import ZopePublication
+from zope.cachedescriptors.property import Lazy
+from zope.component import getUtility
+from zope.component.hooks import getSite, setSite
+from zope.intid.interfaces import IIntIds
+from zope.security.proxy import removeSecurityProxy
+
+from schooltool.app.interfaces import ISchoolToolApplication
+from schooltool.app.interfaces import IApplicationPreferences
+from schooltool.basicperson.interfaces import IDemographics
+from schooltool.course.interfaces import ISectionContainer
+from schooltool.requirement.scoresystem import UNSCORED
+from schooltool.term.interfaces import ITerm
+from schooltool.timetable.interfaces import IScheduleContainer
+
+from schooltool.lyceum.journal.interfaces import IJournalScoreSystemPreferences
+from schooltool.lyceum.journal.interfaces import ISectionJournalData
+from schooltool.lyceum.journal.journal import AttendanceRequirement
+from schooltool.lyceum.journal.journal import GradeRequirement
+from schooltool.lyceum.journal.journal import HomeroomRequirement
+from schooltool.lyceum.journal.journal import RequirementCache
+from schooltool.lyceum.journal.journal import getMeetingIndex
+from schooltool.lyceum.journal.journal import getPeriodTitle
+from schooltool.lyceum.journal import LyceumMessage as _
+
+
+def isHomeroomMeeting(meeting):
+    period = getattr(meeting, 'period', None)
+    return period is not None and period.activity_type == 'homeroom'
+
+
+RECORD_FIELDS = ('term', 'section_id', 'section', 'kind', 'student',
+                 'student_id', 'date', 'period', 'meeting_id', 'value',
+                 'evaluator', 'time')
+
+
+class ClearedValue(object):
+    """Value of a cell whose evaluation was cleared since a time."""
+
+    def __repr__(self):
+        return 'CLEARED'
+
+    def __reduce__(self):
+        return 'CLEARED'
+
+
+CLEARED = ClearedValue()
+
+
+SHEET_TITLES = {
+    'attendance': _('Attendance'),
+    'homeroom': _('Homeroom'),
+    'scores': _('Scores'),
+    }
+
+
+def getRequirementKey(requirement):
+    """Key of a meeting requirement that can be sent to other processes.
+
+    The grading target is identified by its oid.
+    """
+    target = requirement.target
+    return (requirement.requirement_type, requirement.date,
+            requirement.meeting_id, getattr(target, '_p_oid', None))
+
+
+class JournalSheet(object):
+    """Evaluations of one kind of the students of a section.
+
+    Rows are produced one student at a time, evaluations of the whole
+    section are fetched in one go.  Exports of changes since a time
+    only include students that have changed evaluations.
+    """
+
+    def __init__(self, engine, section, name, title, requirement_factory,
+                 score_system, meetings):
+        self.engine = engine
+        self.section = section
+        self.name = name
+        self.title = title
+        self.requirement_factory = requirement_factory
+        self.score_system = score_system
+        self.meetings = meetings
+
+    @Lazy
+    def activities(self):
+        index = getMeetingIndex(self.section, self.engine.tzinfo)
+        return [{'date': index.localDate(meeting),
+                 'period': getPeriodTitle(meeting)}
+                for meeting in self.meetings]
+
+    @Lazy
+    def requirements(self):
+        return [self.engine.requirements(self.requirement_factory, meeting,
+                                         self.score_system)
+                for meeting in self.meetings]
+
+    @Lazy
+    def requirement_keys(self):
+        return map(getRequirementKey, self.requirements)
+
+    def isChanged(self, student, n):
+        """Was the evaluation of a student for the nth meeting changed?"""
+        key = ((self.engine.getStudentIntId(student), ) +
+               self.requirement_keys[n])
+        return key in self.engine.changes
+
+    @Lazy
+    def students(self):
+        students = self.engine.getStudents(self.section)
+        if self.engine.since is not None:
+            students = [student for student in students
+                        if any(self.isChanged(student, n)
+                               for n in range(len(self.meetings)))]
+        return students
+
+    def getEvaluationMatrix(self, students):
+        journal_data = ISectionJournalData(self.section)
+        return journal_data.getEvaluationMatrix(
+            students, self.meetings, self.requirement_factory,
+            score_system=self.score_system, default=UNSCORED)
+
+    def rows(self):
+        """Yield (ID, first name, last name, values) of every student.
+
+        Values are aligned with the meetings, None for empty cells.
+        Exports of changes since a time have current values of the
+        changed meetings for students with changed evaluations, CLEARED
+        for evaluations that were cleared.
+        """
+        since = self.engine.since
+        students = self.students
+        matrix = self.getEvaluationMatrix(students)
+        for student, scores in zip(students, matrix):
+            values = []
+            for n, score in enumerate(scores):
+                if score is not UNSCORED and score.value is not UNSCORED:
+                    values.append(score.value)
+                elif since is not None and self.isChanged(student, n):
+                    values.append(CLEARED)
+                else:
+                    values.append(None)
+            yield (self.engine.getStudentID(student),
+                   student.first_name, student.last_name, values)
+
+    def records(self):
+        """Yield a dict with RECORD_FIELDS for every evaluation.
+
+        Exports of changes since a time include evaluations that were
+        cleared, with None values.
+        """
+        since = self.engine.since
+        students = self.students
+        matrix = self.getEvaluationMatrix(students)
+        meeting_ids = [meeting.meeting_id or meeting.unique_id
+                       for meeting in self.meetings]
+        dates = [activity['date'].isoformat()
+                 for activity in self.activities]
+        periods = [activity['period'] for activity in self.activities]
+        common = {
+            'term': self.engine.term.__name__,
+            'section_id': self.section.__name__,
+            'section': self.section.title,
+            'kind': self.name,
+            }
+        for student, scores in zip(students, matrix):
+            for n, score in enumerate(scores):
+                if score is UNSCORED:
+                    continue
+                if since is None:
+                    if score.value is UNSCORED:
+                        continue
+                elif not self.isChanged(student, n):
+                    continue
+                value = None
+                if score.value is not UNSCORED:
+                    value = unicode(score.value)
+                record = dict(common)
+                record.update({
+                    'student': student.__name__,
+                    'student_id': self.engine.getStudentID(student),
+                    'date': dates[n],
+                    'period': periods[n],
+                    'meeting_id': meeting_ids[n],
+                    'value': value,
+                    'evaluator': score.evaluator,
+                    'time': score.time and score.time.isoformat(),
+                    })
+                yield record
+
+
+class JournalExportEngine(object):
+    """Walks the sections of a term and the journal sheets of each.
+
+    If since (a naive UTC datetime) is given, sheets only have meetings
+    with evaluations changed after that time, as logged in journals of
+    the sections and in homeroom logs, unless changes are given.
+    """
+
+    sheet_factory = JournalSheet
+
+    def __init__(self, term, tzinfo=None, sections=None, since=None,
+                 changes=None):
+        self.term = removeSecurityProxy(term)
+        self._sections = sections
+        self.since = since
+        if changes is not None:
+            self.changes = changes
+        self.requirements = RequirementCache()
+        if tzinfo is None:
+            app = ISchoolToolApplication(None)
+            tzinfo = pytz.timezone(IApplicationPreferences(app).timezone)
+        self.tzinfo = tzinfo
+        self._student_ids = {}
+
+    @Lazy
+    def sections(self):
+        """Sections of the term that have schedules, ordered by title."""
+        sections = self._sections
+        if sections is None:
+            sections = ISectionContainer(self.term).values()
+        sections = [removeSecurityProxy(section) for section in sections]
+        return sorted([section for section in sections
+                       if IScheduleContainer(section)],
+                      key=lambda section: section.title)
+
+    @Lazy
+    def score_systems(self):
+        prefs = IJournalScoreSystemPreferences(self.term)
+        grading = prefs.grading_scoresystem
+        attendance = prefs.attendance_scoresystem
+        return {
+            'attendance': attendance or AttendanceRequirement.score_system,
+            'homeroom': attendance or HomeroomRequirement.score_system,
+            'scores': grading or GradeRequirement.score_system,
+            }
+
+    @Lazy
+    def changes(self):
+        """Student int ids and requirement keys of changed evaluations.
+
+        See getRequirementKey.
+        """
+        app = ISchoolToolApplication(None)
+        changes = app['schooltool.lyceum.journal'].getChanges(
+            self.since, sections=self.sections)
+        return set((student_id, ) + getRequirementKey(requirement)
+                   for student_id, requirement in changes)
+
+    @Lazy
+    def changed_requirements(self):
+        return set(key[1:] for key in self.changes)
+
+    @Lazy
+    def int_ids(self):
+        return getUtility(IIntIds)
+
+    def getStudentIntId(self, student):
+        return self.int_ids.queryId(student)
+
+    def getStudentID(self, student):
+        """ID of a student from demographics, looked up once."""
+        student_id = self._student_ids.get(student.__name__)
+        if student_id is None:
+            student_id = IDemographics(student).get('ID', '') or ''
+            self._student_ids[student.__name__] = student_id
+        return student_id
+
+    def getStudents(self, section):
+        """Members of the section ordered by ID."""
+        students = [removeSecurityProxy(student)
+                    for student in section.members.all()]
+        return sorted(students, key=lambda student: (
+                self.getStudentID(student), student.__name__))
+
+    def getSheets(self, section):
+        """Attendance, homeroom (if there are homeroom periods) and scores."""
+        index = getMeetingIndex(section, self.tzinfo)
+        meetings = index.getTermMeetings(ITerm(section))
+        homeroom_meetings = filter(isHomeroomMeeting, meetings)
+        sheets = [
+            ('attendance', AttendanceRequirement, meetings),
+            ('homeroom', HomeroomRequirement, homeroom_meetings),
+            ('scores', GradeRequirement, meetings),
+            ]
+        if self.since is not None:
+            sheets = [(name, factory,
+                       self.getChangedMeetings(factory, sheet_meetings,
+                                               self.score_systems[name]))
+                      for name, factory, sheet_meetings in sheets]
+        return [self.sheet_factory(self, section, name, SHEET_TITLES[name],
+                                   factory, self.score_systems[name],
+                                   sheet_meetings)
+                for name, factory, sheet_meetings in sheets
+                if sheet_meetings or (name != 'homeroom' and
+                                      self.since is None)]
+
+    def getChangedMeetings(self, requirement_factory, meetings,
+                           score_system=None):
+        changed = self.changed_requirements
+        return [meeting for meeting in meetings
+                if getRequirementKey(self.requirements(
+                    requirement_factory, meeting, score_system)) in changed]
+
+    def __iter__(self):
+        """Yield sheets of all sections."""
+        for section in self.sections:
+            for sheet in self.getSheets(section):
+                yield sheet
+
+    def iterRecords(self):
+        """Yield records of all evaluations, a section at a time."""
+        for sheet in self:
+            for record in sheet.records():
+                yield record
+
+
+class ExportedSheet(object):
+    """A journal sheet built in a worker process."""
+
+    def __init__(self, section, name, activities, rows):
+        self.section = section
+        self.name = name
+        self.title = SHEET_TITLES[name]
+        self.activities = activities
+        self._rows = rows
+
+    def rows(self):
+        return iter(self._rows)
+
+
+log = logging.getLogger(__name__)
+
+
+def getStorageOpener(storage):
+    """Return (factory, args, kw) that open a ZEO storage read-only.
+
+    Returns None if the storage is not a ZEO client storage: a
+    FileStorage the server writes to is not to be opened by other
+    processes.
+    """
+    try:
+        from ZEO.ClientStorage import ClientStorage
+    except ImportError:
+        return None
+    if isinstance(storage, ClientStorage):
+        return (ClientStorage, (storage._addr, ),
+                {'storage': storage._storage, 'read_only': True})
+    return None
+
+
+_worker_db = None
+
+
+def initExportWorker(opener):
+    global _worker_db
+    factory, args, kw = opener
+    _worker_db = DB(factory(*args, **kw))
+
+
+def exportShard(task):
+    """Build sheets of some sections of a term in a worker process.
+
+    The database is read as of the given transaction.  Returns a list of
+    (sheet name, activities, rows) for every section, sections that do
+    not exist any more have no sheets.
+    """
+    term_id, zone, since, changes, tid, section_ids = task
+    connection = _worker_db.open(at=tid)
+    old_site = getSite()
+    try:
+        app = connection.root()[ZopePublication.root_name]
+        setSite(app)
+        int_ids = getUtility(IIntIds)
+        engine = JournalExportEngine(int_ids.getObject(term_id),
+                                     pytz.timezone(zone), since=since,
+                                     changes=changes)
+        result = []
+        for section_id in section_ids:
+            section = int_ids.queryObject(section_id)
+            if section is None:
+                result.append([])
+                continue
+            result.append([(sheet.name, sheet.activities, list(sheet.rows()))
+                           for sheet in engine.getSheets(section)])
+        return result
+    finally:
+        setSite(old_site)
+        transaction.abort()
+        connection.close()
+
+
+class ParallelJournalExport(object):
+    """Sheets of the sections of an export engine, built in parallel.
+
+    If the database is served by ZEO, sections are split into shards
+    that worker processes export through their own read-only ZEO client
+    connections, reading the database as of the last transaction when
+    the export started.  Evaluations changed since a time are looked up
+    once and sent to the workers.
+
+    Sheets are built in this process if there are few sections.  They
+    are also built here, and the reason is logged and kept in fallback,
+    if the database is not served by ZEO, if this is a daemonic process
+    (like a task worker) that can not have children or if other threads
+    run in this process (like in the web server), as forking then may
+    copy locks held by those threads.
+    """
+
+    min_sections = 20
+    shards_per_worker = 4
+
+    def __init__(self, engine, workers=None):
+        self.engine = engine
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.fallback = None
+
+    def getOpener(self):
+        jar = getattr(self.engine.term, '_p_jar', None)
+        if jar is None:
+            return None
+        return getStorageOpener(jar.db().storage)
+
+    def getShards(self, sections):
+        size = max(1, len(sections) // (self.workers * self.shards_per_worker))
+        return [sections[n:n+size] for n in range(0, len(sections), size)]
+
+    def iterSequential(self, sections):
+        for section in sections:
+            yield section, self.engine.getSheets(section)
+
+    def startPool(self, opener):
+        return multiprocessing.Pool(self.workers,
+                                    initializer=initExportWorker,
+                                    initargs=(opener, ))
+
+    def getFallback(self, opener):
+        """Return why workers can not be started, None if they can."""
+        if opener is None:
+            return _('The database is not served by ZEO')
+        if multiprocessing.current_process().daemon:
+            return _('Daemonic processes can not start workers')
+        if threading.active_count() > 1:
+            return _('Processes with other threads can not start workers')
+        return None
+
+    def fallBack(self, reason):
+        self.fallback = reason
+        log.warning('Journal export of %d sections runs in one process: %s',
+                    len(self.engine.sections), reason)
+
+    def __iter__(self):
+        """Yield (section, sheets) in the order of sections."""
+        sections = self.engine.sections
+        pool = None
+        if self.workers > 1 and len(sections) >= self.min_sections:
+            opener = self.getOpener()
+            reason = self.getFallback(opener)
+            if reason is None:
+                try:
+                    pool = self.startPool(opener)
+                except OSError:
+                    reason = _('Workers could not be started')
+            if reason is not None:
+                self.fallBack(reason)
+        if pool is None:
+            for item in self.iterSequential(sections):
+                yield item
+            return
+        int_ids = getUtility(IIntIds)
+        term_id = int_ids.getId(self.engine.term)
+        tid = self.engine.term._p_jar.db().lastTransaction()
+        changes = None
+        if self.engine.since is not None:
+            changes = self.engine.changes
+        shards = self.getShards(sections)
+        tasks = [(term_id, self.engine.tzinfo.zone, self.engine.since,
+                  changes, tid, [int_ids.getId(section) for section in shard])
+                 for shard in shards]
+        try:
+            results = pool.imap(exportShard, tasks)
+            for shard, result in itertools.izip(shards, results):
+                for section, sheets in zip(shard, result):
+                    yield section, [ExportedSheet(section, *sheet)
+                                    for sheet in sheets]
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
@@ -23,6 +23,6 @@ from zope.app.generations.generations import SchemaManager
 
 
 schemaManager = SchemaManager(
-    minimum_generation=4,
-    generation=4,
+    minimum_generation=9,
+    generation=9,
     package_name='schooltool.lyceum.journal.generations')
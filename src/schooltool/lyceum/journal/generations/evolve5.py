@@ -0,0 +1,77 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Evolve database to generation 5.
+
+Build the evaluation index of section journals.
+"""
+from zope.app.generations.utility import findObjectsProviding
+from zope.app.publication.zopepublication import ZopePublication
+from zope.component import getUtility
+from zope.component.hooks import getSite, setSite
+from zope.intid.interfaces import IIntIds
+from zope.security.proxy import removeSecurityProxy
+
+from schooltool.app.interfaces import ISchoolToolApplication
+from schooltool.course.interfaces import ISection
+from schooltool.requirement.interfaces import IEvaluations
+from schooltool.lyceum.journal.interfaces import ISectionJournalData
+from schooltool.lyceum.journal.journal import AttendanceRequirement
+from schooltool.lyceum.journal.journal import GradeRequirement
+
+
+def indexEvaluations(app):
+    """Index evaluations of all persons in journals of their sections.
+
+    Students that left a section are indexed too, journals of sections
+    that were evaluated are stored.
+    """
+    int_ids = getUtility(IIntIds)
+    journals = {}
+    for person in app['persons'].values():
+        student_id = int_ids.queryId(person)
+        if student_id is None:
+            continue
+        evaluations = removeSecurityProxy(IEvaluations(person))
+        for score in evaluations.values():
+            requirement = score.requirement
+            if not isinstance(requirement, (GradeRequirement,
+                                            AttendanceRequirement)):
+                continue
+            target_ref = requirement[3]
+            if target_ref not in journals:
+                section = requirement.target
+                journal = None
+                if ISection.providedBy(section):
+                    journal = ISectionJournalData(section).getStoredJournal()
+                journals[target_ref] = journal
+            journal = journals[target_ref]
+            if journal is not None:
+                journal.indexEvaluation(student_id, requirement)
+
+
+def evolve(context):
+    root = context.connection.root().get(ZopePublication.root_name, None)
+
+    old_site = getSite()
+    apps = list(findObjectsProviding(root, ISchoolToolApplication))
+    for app in apps:
+        setSite(app)
+        indexEvaluations(app)
+
+    setSite(old_site)
@@ -0,0 +1,60 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Evolve database to generation 6.
+
+Move journal preferences of persons to JournalPreferences.
+"""
+from zope.annotation.interfaces import IAnnotations
+from zope.app.generations.utility import findObjectsProviding
+from zope.app.publication.zopepublication import ZopePublication
+from zope.component.hooks import getSite, setSite
+
+from schooltool.app.interfaces import ISchoolToolApplication
+from schooltool.lyceum.journal.journal import CURRENT_SECTION_TAUGHT_KEY
+from schooltool.lyceum.journal.journal import CURRENT_JOURNAL_MODE_KEY
+from schooltool.lyceum.journal.journal import CURRENT_ENROLLMENT_MODE_KEY
+from schooltool.lyceum.journal.journal import setJournalPreference
+
+
+PREFERENCE_KEYS = (CURRENT_SECTION_TAUGHT_KEY,
+                   CURRENT_JOURNAL_MODE_KEY,
+                   CURRENT_ENROLLMENT_MODE_KEY)
+
+
+def evolvePerson(person):
+    ann = IAnnotations(person)
+    for key in PREFERENCE_KEYS:
+        if key not in ann:
+            continue
+        value = ann[key]
+        del ann[key]
+        setJournalPreference(person, key, value)
+
+
+def evolve(context):
+    root = context.connection.root().get(ZopePublication.root_name, None)
+
+    old_site = getSite()
+    apps = list(findObjectsProviding(root, ISchoolToolApplication))
+    for app in apps:
+        setSite(app)
+        for person in app['persons'].values():
+            evolvePerson(person)
+
+    setSite(old_site)
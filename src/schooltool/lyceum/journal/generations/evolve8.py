@@ -0,0 +1,138 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Evolve database to generation 8.
+
+Count attendance marks of every day in journals of their sections and
+in homeroom logs of students.
+"""
+import datetime
+import pytz
+
+from zope.app.generations.utility import findObjectsProviding
+from zope.app.publication.zopepublication import ZopePublication
+from zope.component import getUtility
+from zope.component.hooks import getSite, setSite
+from zope.intid.interfaces import IIntIds
+from zope.keyreference.interfaces import IKeyReference
+from zope.security.proxy import removeSecurityProxy
+
+from schooltool.app.interfaces import ISchoolToolApplication
+from schooltool.course.interfaces import ISection
+from schooltool.requirement.interfaces import IEvaluations
+from schooltool.lyceum.journal.attendance import NO_MARK
+from schooltool.lyceum.journal.generations.evolve4 import iterJournals
+from schooltool.lyceum.journal.journal import AttendanceRequirement
+from schooltool.lyceum.journal.journal import HomeroomRequirement
+from schooltool.lyceum.journal.journal import MeetingRequirement
+from schooltool.lyceum.journal.journal import SchoolMeetingRequirement
+from schooltool.lyceum.journal.journal import getRequirementJournal
+
+
+def utcTime(time):
+    if time is None:
+        return datetime.datetime(1970, 1, 1)
+    if time.tzinfo is not None:
+        time = time.astimezone(pytz.utc).replace(tzinfo=None)
+    return time
+
+
+def iterCompactMarks(journal):
+    """Yield (student int id, requirement, score system, value, time)."""
+    target_ref = IKeyReference(ISection(journal))
+    for bucket in journal._attendance.buckets.values():
+        for student_id, row in bucket.students.items():
+            for (date, meeting_id), col in bucket.meetings.items():
+                code = bucket.codes[row][col]
+                if code == NO_MARK:
+                    continue
+                score_system, value = bucket.scores[code]
+                requirement = tuple.__new__(AttendanceRequirement, (
+                        AttendanceRequirement.requirement_type,
+                        date, meeting_id, target_ref))
+                time = datetime.datetime.utcfromtimestamp(
+                    bucket.times[row][col])
+                yield student_id, requirement, score_system, value, time
+
+
+def iterMarks(app):
+    """Yield (log, student int id, requirement, score system, value, time).
+
+    Evaluations of meetings are logged in journals of their sections
+    or, if they are not kept in journals, in homeroom logs of students.
+    Evaluations replaced by marks in compact storage are skipped.
+    """
+    jc = app['schooltool.lyceum.journal']
+    for journal in iterJournals(app):
+        if journal._attendance is None:
+            continue
+        for mark in iterCompactMarks(journal):
+            yield (journal, ) + mark
+    int_ids = getUtility(IIntIds)
+    journals = {}
+    for person in app['persons'].values():
+        student_id = int_ids.queryId(person)
+        if student_id is None:
+            continue
+        evaluations = removeSecurityProxy(IEvaluations(person))
+        for score in evaluations.values():
+            requirement = score.requirement
+            if not isinstance(requirement, MeetingRequirement):
+                continue
+            log = None
+            if not isinstance(requirement, SchoolMeetingRequirement):
+                target_ref = requirement[3]
+                if target_ref not in journals:
+                    journal = getRequirementJournal(requirement)
+                    if journal is not None:
+                        journal = journal.getStoredJournal()
+                    journals[target_ref] = journal
+                log = journals[target_ref]
+            if log is None:
+                log = jc.getHomeroomLog(student_id)
+            elif (isinstance(requirement, AttendanceRequirement) and
+                  log._attendance is not None and
+                  log._attendance.get(student_id, requirement) is not None):
+                # Replaced by a mark in compact storage
+                continue
+            yield (log, student_id, requirement, score.scoreSystem,
+                   score.value, utcTime(score.time))
+
+
+def countAttendance(app):
+    jc = app['schooltool.lyceum.journal']
+    for log in jc.iterLogs():
+        log._rollups = None
+    for (log, student_id, requirement, score_system, value,
+         time) in iterMarks(app):
+        if isinstance(requirement, (AttendanceRequirement,
+                                    HomeroomRequirement)):
+            log.countAttendance(requirement, student_id, None,
+                                score_system, value)
+
+
+def evolve(context):
+    root = context.connection.root().get(ZopePublication.root_name, None)
+
+    old_site = getSite()
+    apps = list(findObjectsProviding(root, ISchoolToolApplication))
+    for app in apps:
+        setSite(app)
+        countAttendance(app)
+
+    setSite(old_site)
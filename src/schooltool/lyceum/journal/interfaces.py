@@ -30,12 +30,39 @@ from schooltool.lyceum.journal import LyceumMessage as _
 
 class IEvaluateRequirement(Interface):
 
+    requirements = Attribute(
+        """Callable that returns a shared requirement of a meeting.
+
+        Called with the requirement factory, the meeting and optionally
+        the score system.
+        """)
+
     def evaluate(person, requirement, grade, evaluator=None, score_system=None):
         """Add evaluation of a requirement."""
 
+    def evaluateMany(changes, evaluator=None):
+        """Add evaluations of (person, requirement, grade) changes.
+
+        All grades are validated before anything is stored, cells that
+        would not change are skipped.  Returns a list of changes with
+        invalid grades.
+        """
+
     def getEvaluation(person, requirement, default=None):
         """Get evaluation of a requirement."""
 
+    def getHistory(person, requirement):
+        """Get previous evaluations of a requirement, oldest first."""
+
+    def getEvaluationMatrix(persons, meetings, requirement_factory,
+                            score_system=None, default=None):
+        """Returns evaluations of persons for meetings.
+
+        The result is a list of rows aligned with persons, each row
+        a list of evaluations aligned with meetings.  Missing
+        evaluations are returned as default.
+        """
+
 
 class ISectionJournalData(IEvaluateRequirement):
     """A journal for a section."""
@@ -66,6 +93,41 @@ class ISectionJournalData(IEvaluateRequirement):
     def absentMeetings(person):
         """Returns a list of (meeting, absence) for a person."""
 
+    def getChangeStamp():
+        """Returns (number of changes, time of the last change).
+
+        Any change of evaluations or enrollment of the section counts.
+        """
+
+    def hasEvaluation(person, requirement):
+        """Was the person ever evaluated for this requirement?"""
+
+    def getScoreCounts(person, requirement_factory, first=None, last=None,
+                       meetings=None):
+        """Returns a list of (score, count) of scored evaluations.
+
+        Only evaluations of meetings in the calendar of the section,
+        between first and last dates if given, are counted.  Returns
+        None if these evaluations are not indexed.
+        """
+
+    def getTermScoreCounts(person, requirement_factory, first, last):
+        """Returns a list of (score, count) kept up to date for a person.
+
+        Scores of meetings in the calendar of the section, between the
+        first and last dates of its term, are counted as they are
+        evaluated.  Returns None if first and last are not the dates of
+        the term or the counts are out of date.
+        """
+
+    def getStudentEvaluations(person, requirement_factory,
+                              first=None, last=None):
+        """Returns a list of (requirement, evaluation) for a person.
+
+        Evaluations are ordered by meeting date and can be limited to
+        meetings between first and last dates.
+        """
+
 
 class ISectionJournal(ILocation):
 
@@ -99,6 +161,20 @@ class ISectionJournal(ILocation):
     def absentMeetings(person):
         """Returns a list of (meeting, absence) for a person."""
 
+    def getEvaluationMatrix(persons, meetings, requirement_factory,
+                            score_system=None, default=None):
+        """Returns evaluations of persons for meetings.
+
+        See ISectionJournalData.getEvaluationMatrix.
+        """
+
+    def getScoreCounts(person, requirement_factory, term=None):
+        """Returns a list of (score, count) of scored evaluations.
+
+        Only evaluations of meetings in the term are counted, if given.
+        Returns None if these evaluations are not indexed.
+        """
+
     def hasMeeting(person, meeting):
         """Returns true if person should participate in a given meeting."""
 
@@ -142,6 +218,9 @@ class IAttendanceScoreSystem(IScoreSystem):
     def isExcused(score):
         pass
 
+    def classifyMany(values):
+        """Return absent, tardy and excused bitmasks of score values."""
+
 
 class IPersistentAttendanceScoreSystem(IAttendanceScoreSystem):
 
@@ -163,6 +242,15 @@ class IJournalScoreSystemPreferences(Interface):
         vocabulary="schooltool.lyceum.journal-attendance-scoresystems",
         required=True)
 
+    compact_attendance = zope.schema.Bool(
+        title=_("Compact attendance storage"),
+        description=_("Keep new attendance marks of sections in monthly "
+                      "tables of the section journal instead of evaluations "
+                      "of students.  Journals that stored marks this way "
+                      "keep doing so."),
+        required=False,
+        default=False)
+
 
 class IAvailableScoreSystems(Interface):
     """A marker interface to get a list of available scoresystems."""
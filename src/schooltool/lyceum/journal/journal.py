@@ -18,8 +18,16 @@
 """
 Lyceum journal content classes.
 """
+import datetime
+import pytz
+from calendar import monthrange
 from decimal import Decimal
 from persistent import Persistent
+from ZODB.POSException import ConflictError
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from BTrees.Length import Length
+from BTrees.IIBTree import IITreeSet, multiunion
+from BTrees.IOBTree import IOBTree
 
 import zope.schema
 import zope.schema.interfaces
@@ -43,16 +51,22 @@ from zope.location.interfaces import ILocation
 
 from schooltool.app.app import InitBase, StartUpBase
 from schooltool.app.interfaces import ISchoolToolApplication
+from schooltool.app.interfaces import IApplicationPreferences
+from schooltool.app.membership import URIMembership
+from schooltool.app.relationships import URIInstruction
 from schooltool.app.interfaces import ISchoolToolCalendar
 from schooltool.course.interfaces import ILearner
 from schooltool.course.interfaces import IInstructor
 from schooltool.course.interfaces import ISection
+from schooltool.course.interfaces import ISectionContainer
+from schooltool.schoolyear.interfaces import ISchoolYearContainer
 from schooltool.export.export import XLSReportTask
 from schooltool.person.interfaces import IPerson
 from schooltool.report.report import ReportTask
 from schooltool.requirement.interfaces import ICustomScoreSystem
 from schooltool.requirement.interfaces import IEvaluations
 from schooltool.requirement.evaluation import Evaluation
+from schooltool.requirement.evaluation import Score
 from schooltool.requirement.scoresystem import AbstractScoreSystem
 from schooltool.requirement.scoresystem import GlobalRangedValuesScoreSystem
 from schooltool.requirement.scoresystem import CustomScoreSystem
@@ -61,7 +75,11 @@ from schooltool.requirement.scoresystem import ScoreValidationError, UNSCORED
 from schooltool.requirement.interfaces import IScoreSystemContainer
 from schooltool.securitypolicy.crowds import ConfigurableCrowd
 from schooltool.securitypolicy.crowds import ClerksCrowd
+from schooltool.term.interfaces import ITerm
+from schooltool.term.interfaces import ITermContainer
+from schooltool.timetable.calendar import ScheduleCalendarEvent
 
+from schooltool.lyceum.journal.attendance import AttendanceStorage
 from schooltool.lyceum.journal.interfaces import IJournalScoreSystemPreferences
 from schooltool.lyceum.journal.interfaces import IAttendanceScoreSystem
 from schooltool.lyceum.journal.interfaces import IPersistentAttendanceScoreSystem
@@ -78,6 +96,47 @@ TARDY = 'p' #p means tardy in lithuanian
 CURRENT_SECTION_TAUGHT_KEY = 'schooltool.gradebook.currentsectiontaught'
 CURRENT_JOURNAL_MODE_KEY = 'schooltool.gradebook.currentjournalmode'
 CURRENT_ENROLLMENT_MODE_KEY = 'schooltool.gradebook.currentenrollmentmode'
+JOURNAL_PREFERENCES_KEY = 'schooltool.lyceum.journal.preferences'
+
+
+ABSENT_FLAG = 1
+TARDY_FLAG = 2
+EXCUSED_FLAG = 4
+
+
+class AttendanceLookup(object):
+    """Lookup tables of an attendance score system.
+
+    Maps case folded scores to scores and scores to a bitmask of
+    ABSENT_FLAG, TARDY_FLAG and EXCUSED_FLAG.  The stamp holds the
+    attributes the tables were built from, so they can be rebuilt
+    when any of them gets replaced.
+    """
+
+    def __init__(self, score_system):
+        self.stamp = self.getStamp(score_system)
+        scores, tag_absent, tag_tardy, tag_excused = self.stamp
+        self.labels = dict(scores)
+        self.folded = {}
+        for score in self.labels:
+            self.folded.setdefault(score.lower(), score)
+        self.flags = {}
+        for tags, flag in ((tag_absent, ABSENT_FLAG),
+                           (tag_tardy, TARDY_FLAG),
+                           (tag_excused, EXCUSED_FLAG)):
+            for tag in tags:
+                self.flags[tag] = self.flags.get(tag, 0) | flag
+
+    @staticmethod
+    def getStamp(score_system):
+        return (score_system.scores, score_system.tag_absent,
+                score_system.tag_tardy, score_system.tag_excused)
+
+    def isCurrent(self, score_system):
+        for built, current in zip(self.stamp, self.getStamp(score_system)):
+            if built is not current:
+                return False
+        return True
 
 
 class AttendanceScoreSystem(AbstractScoreSystem):
@@ -106,44 +165,58 @@ class AttendanceScoreSystem(AbstractScoreSystem):
             for attr in ('tag_absent', 'tag_tardy', 'tag_excused'):
                 setattr(self, attr, tuple(kw.get(attr, ())))
 
+    @property
+    def lookup(self):
+        # A volatile attribute, so that persistent score systems
+        # are not marked as changed when they are only read.
+        lookup = getattr(self, '_v_lookup', None)
+        if lookup is None or not lookup.isCurrent(self):
+            lookup = self._v_lookup = AttendanceLookup(self)
+        return lookup
+
     def isValidScore(self, score):
         """See interfaces.IScoreSystem"""
         if score is UNSCORED:
             return True
         if not isinstance(score, (str, unicode)):
             return False
-        for s in self.scoresDict.keys():
-            if s.lower() == score.lower():
-                return True
-        return False
+        return score.lower() in self.lookup.folded
 
     def fromUnicode(self, rawScore):
         """See interfaces.IScoreSystem"""
         if not rawScore:
             return UNSCORED
-        for score in self.scoresDict.keys():
-            if score.lower() == rawScore.lower():
-                return score
-        raise ScoreValidationError(rawScore)
+        score = self.lookup.folded.get(rawScore.lower())
+        if score is None:
+            raise ScoreValidationError(rawScore)
+        return score
+
+    def classify(self, value):
+        """Return a bitmask of ABSENT_FLAG, TARDY_FLAG and EXCUSED_FLAG."""
+        return self.lookup.flags.get(value, 0)
+
+    def classifyMany(self, values):
+        flags = self.lookup.flags
+        return [flags.get(value, 0) for value in values]
 
     def isTardy(self, score):
         if not score:
             return False
-        return score.value in self.tag_tardy
+        return bool(self.classify(score.value) & TARDY_FLAG)
 
     def isAbsent(self, score):
         if not score:
             return False
-        return score.value in self.tag_absent
+        return bool(self.classify(score.value) & ABSENT_FLAG)
 
     def isExcused(self, score):
         if not score:
             return False
-        return score.value in self.tag_excused
+        return bool(self.classify(score.value) & EXCUSED_FLAG)
 
-    @Lazy
+    @property
     def scoresDict(self):
-        return dict(self.scores)
+        return self.lookup.labels
 
 
 class PersistentAttendanceScoreSystem(AttendanceScoreSystem, Persistent):
@@ -194,54 +267,625 @@ def getInstructorSections(person):
     return list(IInstructor(person).sections())
 
 
-def getCurrentSectionTaught(person):
-    ann = IAnnotations(removeSecurityProxy(person))
-    if CURRENT_SECTION_TAUGHT_KEY not in ann:
-        ann[CURRENT_SECTION_TAUGHT_KEY] = None
-    else:
-        section = ann[CURRENT_SECTION_TAUGHT_KEY]
-        if section not in getInstructorSections(person):
-            return None
+class JournalPreferences(Persistent):
+    """Journal preferences of a person.
+
+    Changes of different preferences made in concurrent transactions
+    are merged instead of raising a ConflictError.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        if key in self.values and self.values[key] == value:
+            return
+        self.values[key] = value
+        self._p_changed = True
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        old = oldState.get('values', {})
+        values = dict(savedState.get('values', {}))
+        new = newState.get('values', {})
         try:
-            getSectionJournalData(section)
-        except:
-            ann[CURRENT_SECTION_TAUGHT_KEY] = None
-    return ann[CURRENT_SECTION_TAUGHT_KEY]
+            for key, value in new.items():
+                if key not in old or old[key] != value:
+                    values[key] = value
+        except ValueError:
+            # persistent references that can not be compared
+            raise ConflictError
+        state = dict(newState)
+        state['values'] = values
+        return state
+
+
+def getJournalPreference(person, key):
+    if person is None:
+        return None
+    ann = IAnnotations(removeSecurityProxy(person))
+    prefs = ann.get(JOURNAL_PREFERENCES_KEY)
+    if prefs is None:
+        return None
+    return prefs.get(key)
 
 
-def setCurrentSectionTaught(person, section):
+def setJournalPreference(person, key, value):
     ann = IAnnotations(removeSecurityProxy(person))
+    prefs = ann.get(JOURNAL_PREFERENCES_KEY)
+    if prefs is None:
+        if value is None:
+            return
+        ann[JOURNAL_PREFERENCES_KEY] = prefs = JournalPreferences()
+    prefs.set(key, value)
+
+
+def getCurrentSectionTaught(person):
+    section = getJournalPreference(person, CURRENT_SECTION_TAUGHT_KEY)
+    if section is None:
+        return None
+    if section not in getInstructorSections(person):
+        return None
+    int_ids = getUtility(IIntIds)
+    if int_ids.queryId(section) is None:
+        return None
+    return section
+
+
+def setCurrentSectionTaught(person, section):
     if section in getInstructorSections(person):
-        ann[CURRENT_SECTION_TAUGHT_KEY] = removeSecurityProxy(section)
+        setJournalPreference(person, CURRENT_SECTION_TAUGHT_KEY,
+                             removeSecurityProxy(section))
 
 
 def getCurrentJournalMode(person):
-    ann = IAnnotations(removeSecurityProxy(person))
-    if CURRENT_JOURNAL_MODE_KEY not in ann:
-        ann[CURRENT_JOURNAL_MODE_KEY] = None
-    return ann.get(CURRENT_JOURNAL_MODE_KEY, None)
+    return getJournalPreference(person, CURRENT_JOURNAL_MODE_KEY)
 
 
 def setCurrentJournalMode(person, mode):
-    ann = IAnnotations(removeSecurityProxy(person))
-    ann[CURRENT_JOURNAL_MODE_KEY] = mode
+    setJournalPreference(person, CURRENT_JOURNAL_MODE_KEY, mode)
 
 
 def getCurrentEnrollmentMode(person):
-    ann = IAnnotations(removeSecurityProxy(person))
-    if CURRENT_ENROLLMENT_MODE_KEY not in ann:
-        ann[CURRENT_ENROLLMENT_MODE_KEY] = None
-    return ann.get(CURRENT_ENROLLMENT_MODE_KEY, None)
+    return getJournalPreference(person, CURRENT_ENROLLMENT_MODE_KEY)
 
 
 def setCurrentEnrollmentMode(person, mode):
-    ann = IAnnotations(removeSecurityProxy(person))
-    ann[CURRENT_ENROLLMENT_MODE_KEY] = mode
+    setJournalPreference(person, CURRENT_ENROLLMENT_MODE_KEY, mode)
 
 
 class LyceumJournalContainer(BTreeContainer):
     """A container for all the journals in the system."""
 
+    meeting_versions = None
+
+    def getMeetingsStamp(self, int_ids):
+        """Return versions of meetings of sections or terms by int ids."""
+        if self.meeting_versions is None:
+            return (0, ) * len(int_ids)
+        stamp = []
+        for int_id in int_ids:
+            version = self.meeting_versions.get(int_id)
+            stamp.append(0 if version is None else version())
+        return tuple(stamp)
+
+    def getSectionMeetingsStamp(self, section):
+        """Return versions of meetings of a section and its term."""
+        int_ids = getUtility(IIntIds)
+        return self.getMeetingsStamp((int_ids.getId(section),
+                                      int_ids.getId(ITerm(section))))
+
+    def changedMeetings(self, int_id):
+        """Invalidate cached meetings of a section or a term."""
+        if self.meeting_versions is None:
+            self.meeting_versions = IOBTree()
+        version = self.meeting_versions.get(int_id)
+        if version is None:
+            version = self.meeting_versions[int_id] = Length()
+        version.change(1)
+
+    homeroom_logs = None
+
+    def getHomeroomLog(self, student_id):
+        """Return the log of evaluations of a student not kept in journals.
+
+        Students are spread over HOMEROOM_LOGS logs by int id, so that
+        marking homeroom attendance of many students does not write to
+        the same objects.
+        """
+        if self.homeroom_logs is None:
+            self.homeroom_logs = IOBTree()
+        shard = student_id % HOMEROOM_LOGS
+        log = self.homeroom_logs.get(shard)
+        if log is None:
+            log = self.homeroom_logs[shard] = HomeroomLog()
+        return log
+
+    def iterHomeroomLogs(self):
+        if self.homeroom_logs is None:
+            return []
+        return self.homeroom_logs.values()
+
+    def iterLogs(self, sections=None):
+        """Journals of sections (all of them if None), then homeroom logs."""
+        if sections is None:
+            journals = list(self.values())
+        else:
+            int_ids = getUtility(IIntIds)
+            journals = []
+            for section in sections:
+                int_id = int_ids.queryId(removeSecurityProxy(section))
+                journal = self.get(str(int_id), None)
+                if journal is not None:
+                    journals.append(journal)
+        return journals + list(self.iterHomeroomLogs())
+
+    def noteChange(self, student_id):
+        """Count a change of evaluations of a student not kept in journals."""
+        self.getHomeroomLog(student_id).noteChange()
+
+    def getChangeStamp(self):
+        """Return (number of changes, time of the last change).
+
+        Changes of evaluations not kept in journals, from all homeroom
+        logs, count.
+        """
+        count, time = getChangeStamp(None)
+        for log in self.iterHomeroomLogs():
+            log_count, log_time = log.getChangeStamp()
+            count += log_count
+            time = max(time, log_time)
+        return (count, time)
+
+    def getAttendanceRollups(self, first, last):
+        """Return a list of (date, DailyAttendance) between first and last.
+
+        Attendance is rolled up from journals of sections of terms
+        that overlap these days and from homeroom logs.
+        """
+        app = ISchoolToolApplication(None)
+        sections = []
+        for year in ISchoolYearContainer(app).values():
+            for term in ITermContainer(year).values():
+                if term.first <= last and first <= term.last:
+                    sections.extend(ISectionContainer(term).values())
+        days = {}
+        for log in self.iterLogs(sections):
+            for date, rollup in log.getAttendanceRollups(first, last):
+                day = days.get(date)
+                if day is None:
+                    day = days[date] = DailyAttendance()
+                day.add(rollup)
+        return sorted(days.items())
+
+    member_changes = None
+
+    def getMembersStamp(self, int_id):
+        """Return the stamp of changes of members of a section by int id.
+
+        Counts enrollment changes and changes of members, like their
+        names, as (count, time of the last change).
+        """
+        if self.member_changes is None:
+            return getChangeStamp(None)
+        return getChangeStamp(self.member_changes.get(int_id))
+
+    def noteMembersChange(self, int_id):
+        """Count a change of members of a section by int id."""
+        if self.member_changes is None:
+            self.member_changes = IOBTree()
+        changes = self.member_changes.get(int_id)
+        if changes is None:
+            changes = self.member_changes[int_id] = JournalChanges()
+        changes.note()
+
+    memberships_version = None
+
+    def getMembershipsVersion(self):
+        if self.memberships_version is None:
+            return 0
+        return self.memberships_version()
+
+    def changedMemberships(self):
+        """Invalidate cached student sets of terms, instructors and groups."""
+        if self.memberships_version is None:
+            self.memberships_version = Length()
+        self.memberships_version.change(1)
+
+    changes_pruned = None
+
+    def getChanges(self, since, sections=None):
+        """Return a set of (student int id, requirement) changed later.
+
+        Changes are looked up in journals of the sections (all of them
+        if None) and in homeroom logs.  Changes before changes_pruned
+        are not known any more.
+        """
+        changes = set()
+        for log in self.iterLogs(sections):
+            changes.update(log.getChanges(since))
+        return changes
+
+    def pruneChanges(self, before):
+        """Forget evaluations last changed on days before a time.
+
+        Meant to be run from time to time by the administrator, logs
+        otherwise keep every evaluation ever changed.  Exports of
+        changes since an earlier time can not be made after that.
+        """
+        for log in self.iterLogs():
+            log.pruneChanges(before)
+        pruned = datetime.datetime.combine(before.date(), datetime.time())
+        if self.changes_pruned is None or self.changes_pruned < pruned:
+            self.changes_pruned = pruned
+
+
+class MeetingIndex(object):
+    """Ordered unique meetings of a section.
+
+    Start times of the meetings are kept in the application timezone,
+    meetings of a term are bucketed on first use.  Keys maps the
+    (date, meeting id) of events in the calendar, as requirements of
+    the meetings are keyed, to the earliest of these events.
+    """
+
+    def __init__(self, section, tzinfo):
+        self.tzinfo = tzinfo
+        events = []
+        unique_meetings = set()
+        self.keys = {}
+        calendar = ISchoolToolCalendar(section)
+        sorted_events = sorted(calendar, key=lambda e: e.dtstart)
+        for event in sorted_events:
+            entry_id = event.meeting_id
+            if entry_id is None:
+                entry_id = event.unique_id
+            self.keys.setdefault((event.dtstart.date(), entry_id), event)
+            if event.meeting_id not in unique_meetings:
+                events.append(event)
+                unique_meetings.add(event.meeting_id)
+        self.meetings = sorted(events)
+        self.starts = dict([(event.unique_id, event.dtstart.astimezone(tzinfo))
+                            for event in self.meetings])
+        self._terms = {}
+        self._names = None
+
+    def localStart(self, meeting):
+        start = self.starts.get(meeting.unique_id)
+        if start is None:
+            start = meeting.dtstart.astimezone(self.tzinfo)
+        return start
+
+    def localDate(self, meeting):
+        return self.localStart(meeting).date()
+
+    def getMeeting(self, name, default=None):
+        """Find a meeting by its name."""
+        if self._names is None:
+            self._names = dict([(meeting.__name__, meeting)
+                                for meeting in self.meetings])
+        return self._names.get(name, default)
+
+    def getTermMeetings(self, term):
+        """Meetings that take place in the term, in local time."""
+        key = (term.first, term.last)
+        meetings = self._terms.get(key)
+        if meetings is None:
+            meetings = self._terms[key] = [
+                meeting for meeting in self.meetings
+                if term.first <= self.localDate(meeting) <= term.last]
+        return meetings
+
+    def getMonths(self, meetings):
+        """Ordered unique (year, month) of the meetings."""
+        months = []
+        for meeting in meetings:
+            start = self.localStart(meeting)
+            month = (start.year, start.month)
+            if not months or months[-1] != month:
+                months.append(month)
+        return months
+
+
+MAX_CACHED_MEETING_INDEXES = 500
+
+
+def getMeetingIndex(section, tzinfo=None):
+    """Get the cached meeting index of a section.
+
+    Indexes are cached per database connection until meetings of the
+    section or its term change.
+    """
+    section = removeSecurityProxy(section)
+    app = ISchoolToolApplication(None)
+    if tzinfo is None:
+        tzinfo = pytz.timezone(IApplicationPreferences(app).timezone)
+    jc = app['schooltool.lyceum.journal']
+    cache = getattr(jc, '_v_meeting_indexes', None)
+    if cache is None or cache[0] != tzinfo.zone:
+        cache = jc._v_meeting_indexes = (tzinfo.zone, {})
+    indexes = cache[1]
+    section_id = getUtility(IIntIds).getId(section)
+    stamp = jc.getSectionMeetingsStamp(section)
+    entry = indexes.get(section_id)
+    if entry is None or entry[0] != stamp:
+        if len(indexes) >= MAX_CACHED_MEETING_INDEXES:
+            indexes.clear()
+        entry = indexes[section_id] = (stamp, MeetingIndex(section, tzinfo))
+    return entry[1]
+
+
+def getPeriodTitle(meeting):
+    period = getattr(meeting, 'period', None)
+    if period is None or not period.title:
+        return ''
+    title = period.title
+    if title[-1] == ':':
+        title = title[:-1]
+    return title
+
+
+def makeSchoolAttendanceMeeting(date):
+    uid = '%s' % date.isoformat()
+    dt = datetime.datetime(date.year, date.month, date.day)
+    meeting = ScheduleCalendarEvent(dt, datetime.timedelta(1), '', unique_id=uid)
+    return meeting
+
+
+class SchoolDayCalendar(object):
+    """School days of a month in any of the terms.
+
+    Holds a synthetic school attendance meeting for each school day and
+    interns the requirements made for these meetings.
+    """
+
+    def __init__(self, terms, year, month, tzinfo):
+        self.days = []
+        self.meetings = []
+        for day in range(1, monthrange(year, month)[1] + 1):
+            date = datetime.date(year, month, day)
+            for term in terms:
+                if date in term and term.isSchoolday(date):
+                    # meeting duration is not precise - some days are
+                    # not 24 hours long
+                    dt = tzinfo.localize(datetime.datetime(year, month, day))
+                    self.days.append(date)
+                    self.meetings.append(makeSchoolAttendanceMeeting(dt))
+        self.requirements = RequirementCache()
+
+
+MAX_CACHED_SCHOOL_DAY_CALENDARS = 100
+
+
+def getSchoolDayCalendar(terms, year, month, tzinfo):
+    """Get the cached school day calendar of a month.
+
+    Calendars are cached per database connection until any of the
+    terms is changed.
+    """
+    terms = [removeSecurityProxy(term) for term in terms]
+    app = ISchoolToolApplication(None)
+    jc = app['schooltool.lyceum.journal']
+    cache = getattr(jc, '_v_school_days', None)
+    if cache is None or cache[0] != tzinfo.zone:
+        cache = jc._v_school_days = (tzinfo.zone, {})
+    calendars = cache[1]
+    int_ids = getUtility(IIntIds)
+    term_ids = tuple([int_ids.getId(term) for term in terms])
+    key = (term_ids, year, month)
+    stamp = jc.getMeetingsStamp(term_ids)
+    entry = calendars.get(key)
+    if entry is None or entry[0] != stamp:
+        if len(calendars) >= MAX_CACHED_SCHOOL_DAY_CALENDARS:
+            calendars.clear()
+        entry = calendars[key] = (
+            stamp, SchoolDayCalendar(terms, year, month, tzinfo))
+    return entry[1]
+
+
+def getSectionMemberNames(section):
+    """Get the cached set of usernames of all members of a section.
+
+    The set is cached per database connection until members of the
+    section change.
+    """
+    section = removeSecurityProxy(section)
+    int_id = getUtility(IIntIds).getId(section)
+    app = ISchoolToolApplication(None)
+    jc = app['schooltool.lyceum.journal']
+    stamp = jc.getMembersStamp(int_id)
+    cache = getattr(jc, '_v_member_names', None)
+    if cache is None:
+        cache = jc._v_member_names = {}
+    entry = cache.get(int_id)
+    if entry is None or entry[0] != stamp:
+        names = frozenset([member.username
+                           for member in section.members.all()])
+        entry = cache[int_id] = (stamp, names)
+    return entry[1]
+
+
+class StudentIndex(object):
+    """Int ids of students of terms, instructors and groups.
+
+    Also keeps instructors of the sections with members in each term.
+    Everything is built on first use, the index is replaced as a whole
+    when sections, memberships or instruction change.
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def _collect(self, groups):
+        int_ids = getUtility(IIntIds)
+        ids = IITreeSet()
+        for group in groups:
+            for person in removeSecurityProxy(group).members.all():
+                intid = int_ids.queryId(person, None)
+                if intid is not None:
+                    ids.insert(intid)
+        return ids
+
+    def _get(self, key, groups):
+        ids = self._cache.get(key)
+        if ids is None:
+            ids = self._cache[key] = self._collect(groups())
+        return ids
+
+    def _instructorSections(self, term):
+        """Sections of the term with members, by instructor int id."""
+        term = removeSecurityProxy(term)
+        int_ids = getUtility(IIntIds)
+        key = ('sections', int_ids.getId(term))
+        result = self._cache.get(key)
+        if result is None:
+            result = self._cache[key] = {}
+            for section in ISectionContainer(term).values():
+                section = removeSecurityProxy(section)
+                if not len(section.members.all()):
+                    continue
+                for instructor in section.instructors:
+                    instructor = removeSecurityProxy(instructor)
+                    entry = result.setdefault(int_ids.getId(instructor),
+                                              (instructor, []))
+                    entry[1].append(section)
+        return result
+
+    def termStudents(self, term):
+        """Students of all sections of the term."""
+        term = removeSecurityProxy(term)
+        key = ('term', getUtility(IIntIds).getId(term))
+        return self._get(key, lambda: ISectionContainer(term).values())
+
+    def instructorStudents(self, instructor, term):
+        """Students of the sections of the term taught by instructor."""
+        instructor = removeSecurityProxy(instructor)
+        int_ids = getUtility(IIntIds)
+        instructor_id = int_ids.getId(instructor)
+        key = ('instructor', instructor_id,
+               int_ids.getId(removeSecurityProxy(term)))
+        sections = self._instructorSections(term).get(instructor_id)
+        return self._get(key, lambda: sections and sections[1] or [])
+
+    def termInstructors(self, term, collator):
+        """Instructors of the sections of the term that have members.
+
+        Instructors are sorted with the collator, the order is kept
+        until any of them changes.
+        """
+        instructors = [instructor for instructor, sections
+                       in self._instructorSections(term).values()]
+        serials = tuple([getattr(instructor, '_p_serial', None)
+                         for instructor in instructors])
+        key = ('order', getUtility(IIntIds).getId(removeSecurityProxy(term)),
+               id(collator))
+        cached = self._cache.get(key)
+        if cached is None or cached[0] != serials:
+            cached = self._cache[key] = (
+                serials, sorted(instructors, key=collator.personKey))
+        return cached[1]
+
+    def groupStudents(self, group):
+        """Members of the group."""
+        group = removeSecurityProxy(group)
+        key = ('group', getUtility(IIntIds).getId(group))
+        return self._get(key, lambda: [group])
+
+
+def getStudentIndex():
+    """Get the student index cached per database connection."""
+    app = ISchoolToolApplication(None)
+    jc = app['schooltool.lyceum.journal']
+    version = jc.getMembershipsVersion()
+    cache = getattr(jc, '_v_student_index', None)
+    if cache is None or cache[0] != version:
+        cache = jc._v_student_index = (version, StudentIndex())
+    return cache[1]
+
+
+def invalidateStudentIndex(obj, event):
+    """Subscriber for additions and removals of sections."""
+    app = ISchoolToolApplication(None, None)
+    if app is None:
+        return
+    jc = app.get('schooltool.lyceum.journal')
+    if jc is not None:
+        jc.changedMemberships()
+
+
+def findMeetingsOwner(obj, event):
+    """Find the section or the term meetings of obj belong to.
+
+    Removed objects are looked up from their old parent.
+    """
+    for start in (obj, getattr(event, 'oldParent', None)):
+        while start is not None:
+            if ISection.providedBy(start) or ITerm.providedBy(start):
+                return start
+            start = getattr(start, '__parent__', None)
+    return None
+
+
+def invalidateMeetingIndexes(obj, event):
+    """Subscriber for changes of schedules, terms and calendars."""
+    owner = findMeetingsOwner(obj, event)
+    if owner is None:
+        return
+    app = ISchoolToolApplication(None, None)
+    if app is None:
+        return
+    jc = app.get('schooltool.lyceum.journal')
+    int_id = getUtility(IIntIds).queryId(owner)
+    if jc is not None and int_id is not None:
+        jc.changedMeetings(int_id)
+
+
+def invalidateSectionMeetingIndexes(calendar_event, event):
+    """Subscriber for changes of calendar events of sections."""
+    invalidateMeetingIndexes(calendar_event, event)
+
+
+def noteEnrollmentChange(event):
+    """Subscriber for changes of membership and instruction."""
+    if event.rel_type not in (URIMembership, URIInstruction):
+        return
+    invalidateStudentIndex(None, event)
+    if event.rel_type != URIMembership:
+        return
+    sections = [participant
+                for participant in (event.participant1, event.participant2)
+                if ISection.providedBy(participant)]
+    noteMembersChange(sections)
+
+
+def notePersonChange(person, event):
+    """Subscriber for modifications of persons, like their names."""
+    noteMembersChange([group for group in person.groups
+                       if ISection.providedBy(group)])
+
+
+def noteMembersChange(sections):
+    """Count changes of members of sections.
+
+    Journals of the sections are not touched, sections that were never
+    graded only get a counter of changes.
+    """
+    if not sections:
+        return
+    app = ISchoolToolApplication(None, None)
+    if app is None:
+        return
+    jc = app.get('schooltool.lyceum.journal')
+    if jc is None:
+        return
+    int_ids = getUtility(IIntIds)
+    for section in sections:
+        int_id = int_ids.queryId(removeSecurityProxy(section))
+        if int_id is not None:
+            jc.noteMembersChange(int_id)
+
 
 @adapter(ISectionJournalData)
 @implementer(ISection)
@@ -256,29 +900,470 @@ def getSectionForSectionJournal(sj):
     return sj.section
 
 
+def getEvaluationMatrix(persons, meetings, requirement_factory,
+                        score_system=None, default=None, requirements=None):
+    """Return a list of evaluation rows, one per person.
+
+    Each row is aligned with meetings; cells that were never evaluated
+    hold the default.  Requirements are built once per meeting and
+    evaluations are looked up once per person.
+    """
+    if requirements is None:
+        requirements = RequirementCache()
+    requirements = [requirements(requirement_factory,
+                                 removeSecurityProxy(meeting),
+                                 score_system)
+                    for meeting in meetings]
+    result = []
+    for person in persons:
+        evaluations = removeSecurityProxy(IEvaluations(person))
+        row = []
+        for requirement in requirements:
+            score = evaluations.get(requirement)
+            if score is None:
+                score = default
+            row.append(score)
+        result.append(row)
+    return result
+
+
+def parseChanges(changes):
+    """Parse grades of (person, requirement, grade) changes.
+
+    Returns a list of (person, requirement, score) and a list of
+    changes whose grades the requirement score system rejected.
+    """
+    parsed = []
+    rejected = []
+    for change in changes:
+        person, requirement, grade = change
+        try:
+            score = requirement.score_system.fromUnicode(grade)
+        except ScoreValidationError:
+            rejected.append(change)
+            continue
+        parsed.append((removeSecurityProxy(person), requirement, score))
+    return parsed, rejected
+
+
+def storeEvaluation(person, requirement, score_system, score,
+                    evaluator=None, evaluations=None, journal=None):
+    """Add an evaluation of a meeting requirement of a person.
+
+    All evaluations of meeting requirements are written here and noted
+    by noteEvaluation, whoever writes them.  Unchanged scores are not
+    written.  Returns a tuple of the previous evaluation (or None) and
+    the new one, or None if nothing was written.
+    """
+    person = removeSecurityProxy(person)
+    if evaluations is None:
+        evaluations = removeSecurityProxy(IEvaluations(person))
+    current = evaluations.get(requirement)
+    if current is not None:
+        if (current.value == score and
+            current.evaluator == evaluator):
+            return None
+    elif score is UNSCORED:
+        return None
+    evaluation = Evaluation(requirement, score_system, score,
+                            evaluator=evaluator)
+    evaluations.addEvaluation(evaluation)
+    noteEvaluation(person, requirement, current, score_system, score,
+                   journal=journal)
+    return current, evaluation
+
+
+def applyChanges(parsed, evaluator=None, journal=None):
+    """Add evaluations for parsed changes, skipping unchanged cells.
+
+    Evaluations of every person are looked up once.  Returns a list of
+    (person, requirement, previous evaluation, evaluation) that were
+    evaluated.
+    """
+    by_person = {}
+    persons = []
+    for person, requirement, score in parsed:
+        if person not in by_person:
+            by_person[person] = []
+            persons.append(person)
+        by_person[person].append((requirement, score))
+    result = []
+    for person in persons:
+        evaluations = removeSecurityProxy(IEvaluations(person))
+        for requirement, score in by_person[person]:
+            stored = storeEvaluation(person, requirement,
+                                     requirement.score_system, score,
+                                     evaluator=evaluator,
+                                     evaluations=evaluations,
+                                     journal=journal)
+            if stored is not None:
+                current, eval = stored
+                result.append((person, requirement, current, eval))
+    return result
+
+
+def countScores(scores):
+    """Return a list of (score, count) of scored evaluations."""
+    counts = {}
+    for score in scores:
+        if score.value is UNSCORED:
+            continue
+        key = (score.scoreSystem, score.value)
+        counts[key] = counts.get(key, 0) + 1
+    return [(Score(score_system, value), count)
+            for (score_system, value), count in counts.items()]
+
+
+ATTENDANCE_TAGS = (
+    ('absent', ABSENT_FLAG),
+    ('tardy', TARDY_FLAG),
+    ('excused', EXCUSED_FLAG),
+    )
+
+ATTENDANCE_TYPES = ('homeroom', 'attendance')
+
+HOMEROOM_LOGS = 32
+
+ANY = object()
+
+
+def getAttendanceFlags(score_system, value):
+    """Return the attendance bitmask of a score, 0 for other scores."""
+    if (value is UNSCORED or
+        not IAttendanceScoreSystem.providedBy(score_system)):
+        return 0
+    return score_system.classifyMany([value])[0]
+
+
+class AttendanceRollup(Persistent):
+    """Attendance marks of a journal on one day.
+
+    Marks are counted by requirement type, period, tag and student int
+    id.  The period is a (start time, title) of the meeting, or None.
+    Changes made in concurrent transactions are merged by adding up
+    their increments.
+    """
+
+    def __init__(self):
+        self.students = {}
+
+    def add(self, requirement_type, period, student_id, flags, delta):
+        if not flags:
+            return
+        for tag, flag in ATTENDANCE_TAGS:
+            if not flags & flag:
+                continue
+            key = (requirement_type, period, tag, student_id)
+            count = self.students.get(key, 0) + delta
+            if count > 0:
+                self.students[key] = count
+            else:
+                self.students.pop(key, None)
+        self._p_changed = True
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        old = oldState.get('students', {})
+        saved = savedState.get('students', {})
+        new = newState.get('students', {})
+        students = dict(saved)
+        for key in set(old) | set(new):
+            delta = new.get(key, 0) - old.get(key, 0)
+            if not delta:
+                continue
+            count = students.get(key, 0) + delta
+            if count > 0:
+                students[key] = count
+            else:
+                students.pop(key, None)
+        state = dict(newState)
+        state['students'] = students
+        return state
+
+
+class DailyAttendance(object):
+    """Attendance rollups of many journals for one day.
+
+    Keeps sets of int ids of students with marks by requirement type,
+    period and tag.
+    """
+
+    def __init__(self):
+        self.student_ids = {}
+
+    def add(self, rollup):
+        for (requirement_type, period, tag,
+             student_id) in rollup.students:
+            key = (requirement_type, period, tag)
+            student_ids = self.student_ids.get(key)
+            if student_ids is None:
+                student_ids = self.student_ids[key] = IITreeSet()
+            student_ids.insert(student_id)
+
+    def getPeriods(self, requirement_type=None):
+        """Periods marks were counted in, by start time, None last."""
+        periods = set(
+            period
+            for rtype, period, tag in self.student_ids
+            if requirement_type is None or rtype == requirement_type)
+        return sorted(periods, key=lambda period: (period is None, period))
+
+    def getStudentIds(self, requirement_type=None, tag=None, period=ANY):
+        """Int ids of students that have marks with the tag."""
+        return multiunion([
+            student_ids
+            for (rtype, rperiod, rtag), student_ids in self.student_ids.items()
+            if ((requirement_type is None or rtype == requirement_type) and
+                (tag is None or rtag == tag) and
+                (period is ANY or rperiod == period))])
+
+    def count(self, requirement_type, tag, period=ANY):
+        """Number of students with marks with the tag."""
+        return len(self.getStudentIds(requirement_type, tag, period))
+
+
+class EvaluationLog(object):
+    """Change times and attendance rollups of evaluations of a journal.
+
+    Evaluations, as (student int id, requirement), are kept in a set
+    for the day of their last change.  Attendance marks are counted in
+    a rollup per day.  Trees are created with the first evaluation.
+    """
+
+    _changes = None
+    _change_days = None
+    _change_times = None
+    _rollups = None
+
+    def getStoredJournal(self):
+        return self
+
+    def noteChange(self):
+        """Count a change of what this journal shows."""
+        journal = self.getStoredJournal()
+        if journal._changes is None:
+            journal._changes = JournalChanges()
+        journal._changes.note()
+
+    def getChangeStamp(self):
+        return getChangeStamp(self._changes)
+
+    def indexChange(self, requirement, student_id, time=None):
+        """Remember when an evaluation of a student was last changed.
+
+        Only the last change of every evaluation is kept.  Times are
+        naive UTC.
+        """
+        if time is None:
+            time = datetime.datetime.utcnow()
+        journal = self.getStoredJournal()
+        if journal._change_days is None:
+            journal._change_days = OOBTree()
+            journal._change_times = OOBTree()
+        key = (student_id, requirement)
+        day = time.date()
+        previous = journal._change_times.get(key)
+        if previous is not None:
+            if previous >= time:
+                return
+            if previous.date() != day:
+                journal._change_days[previous.date()].remove(key)
+        journal._change_times[key] = time
+        changes = journal._change_days.get(day)
+        if changes is None:
+            changes = journal._change_days[day] = OOTreeSet()
+        changes.insert(key)
+
+    def getChanges(self, since):
+        """Return a set of (student int id, requirement) changed later."""
+        if self._change_days is None:
+            return set()
+        changes = set()
+        for day, keys in self._change_days.items(since.date()):
+            if day > since.date():
+                changes.update(keys)
+            else:
+                changes.update(key for key in keys
+                               if self._change_times[key] > since)
+        return changes
+
+    def pruneChanges(self, before):
+        """Forget evaluations last changed on days before a time."""
+        if self._change_days is None:
+            return
+        for old_day in list(self._change_days.keys(max=before.date(),
+                                                   excludemax=True)):
+            for key in self._change_days[old_day]:
+                del self._change_times[key]
+            del self._change_days[old_day]
+
+    def getPeriod(self, requirement):
+        """Return the period of a requirement to count attendance in."""
+        return None
+
+    def countAttendance(self, requirement, student_id, previous,
+                        score_system, score):
+        """Update the attendance rollup of the day of a requirement."""
+        previous_flags = 0
+        if previous is not None:
+            previous_flags = getAttendanceFlags(previous.scoreSystem,
+                                                previous.value)
+        flags = getAttendanceFlags(score_system, score)
+        if flags == previous_flags:
+            return
+        self.countAttendanceFlags(requirement.date,
+                                  requirement.requirement_type,
+                                  self.getPeriod(requirement), student_id,
+                                  previous_flags, flags)
+
+    def countAttendanceFlags(self, date, requirement_type, period,
+                             student_id, previous_flags, flags):
+        if flags == previous_flags:
+            return
+        journal = self.getStoredJournal()
+        if journal._rollups is None:
+            journal._rollups = OOBTree()
+        rollup = journal._rollups.get(date)
+        if rollup is None:
+            rollup = journal._rollups[date] = AttendanceRollup()
+        rollup.add(requirement_type, period, student_id, previous_flags, -1)
+        rollup.add(requirement_type, period, student_id, flags, 1)
+
+    def getAttendanceRollups(self, first, last):
+        """Return a list of (date, rollup) of days between first and last."""
+        if self._rollups is None:
+            return []
+        return list(self._rollups.items(first, last))
+
+
+class HomeroomLog(EvaluationLog, Persistent):
+    """Log of evaluations of some students not kept in section journals.
+
+    Homeroom and school attendance marks are logged here.
+    """
+
+
+def getRequirementJournal(requirement):
+    """Return the journal of the section a requirement grades, if any."""
+    if isinstance(requirement, SchoolMeetingRequirement):
+        return None
+    target = requirement.target
+    if not ISection.providedBy(target):
+        return None
+    return ISectionJournalData(removeSecurityProxy(target))
+
+
+def noteEvaluation(person, requirement, previous, score_system, score,
+                   journal=None):
+    """Index a new evaluation in the journal of its section.
+
+    Also log its change time and count attendance, in the journal or,
+    for evaluations not kept in journals, in the homeroom log of the
+    student.  The journal is looked up from the requirement if not
+    given.
+    """
+    int_ids = getUtility(IIntIds)
+    student_id = int_ids.queryId(removeSecurityProxy(person))
+    if student_id is None:
+        return
+    if journal is None:
+        journal = getRequirementJournal(requirement)
+    if journal is not None:
+        journal.indexEvaluation(student_id, requirement)
+        journal.countEvaluation(student_id, requirement, previous,
+                                score_system, score)
+        log = journal
+    else:
+        app = ISchoolToolApplication(None, None)
+        if app is None:
+            return
+        jc = app.get('schooltool.lyceum.journal')
+        if jc is None:
+            return
+        log = jc.getHomeroomLog(student_id)
+    log.indexChange(requirement, student_id)
+    if isinstance(requirement, (AttendanceRequirement, HomeroomRequirement)):
+        log.countAttendance(requirement, student_id, previous,
+                            score_system, score)
+
+
+class JournalChanges(Persistent):
+    """Number of changes of a journal and the time of the last one.
+
+    Changes made in concurrent transactions are merged by adding up
+    their increments.
+    """
+
+    count = 0
+    time = None
+
+    def note(self):
+        self.count += 1
+        self.time = datetime.datetime.utcnow()
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        state = dict(newState)
+        state['count'] = (savedState.get('count', 0) +
+                          newState.get('count', 0) -
+                          oldState.get('count', 0))
+        state['time'] = max(savedState.get('time'), newState.get('time'))
+        return state
+
+
+class ScoreCounts(Persistent):
+    """Numbers of scores of a student in a section journal.
+
+    Counts are keyed by (score system, value).  Only evaluations of
+    the student change them, which conflict on their own anyway.
+    """
+
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, score_system, value, count):
+        key = (score_system, value)
+        count += self.counts.get(key, 0)
+        if count:
+            self.counts[key] = count
+        else:
+            self.counts.pop(key, None)
+        self._p_changed = True
+
+    def items(self):
+        return [(Score(score_system, value), count)
+                for (score_system, value), count in self.counts.items()]
+
+
+def getChangeStamp(changes):
+    if changes is None:
+        return (0, None)
+    return (changes.count, changes.time)
+
+
 class EvaluateGeneric(object):
     implements(IEvaluateRequirement)
 
     def __init__(self, target):
         self.context = target
+        self.requirements = RequirementCache()
 
     def evaluate(self, person, requirement, grade, evaluator=None, score_system=None):
         if score_system is None:
             score_system = requirement.score_system
         score = score_system.fromUnicode(grade)
-        evaluations = removeSecurityProxy(IEvaluations(person))
-
-        if requirement in evaluations:
-            current = evaluations[requirement]
-            if (current.value == score and
-                current.evaluator == evaluator):
-                return
-        else:
-            if score is UNSCORED:
-                return
-
-        eval = Evaluation(requirement, score_system, score, evaluator=evaluator)
-        evaluations.addEvaluation(eval)
+        if storeEvaluation(person, requirement, score_system, score,
+                           evaluator=evaluator) is not None:
+            self.noteChange([person])
+
+    def noteChange(self, persons):
+        """Count changes of evaluations of persons."""
+        app = ISchoolToolApplication(None)
+        jc = app['schooltool.lyceum.journal']
+        int_ids = getUtility(IIntIds)
+        student_ids = set(int_ids.queryId(removeSecurityProxy(person))
+                          for person in persons)
+        for student_id in student_ids:
+            if student_id is not None:
+                jc.noteChange(student_id)
 
     def getEvaluation(self, person, requirement, default=None):
         evaluations = removeSecurityProxy(IEvaluations(person))
@@ -287,6 +1372,24 @@ class EvaluateGeneric(object):
             return default
         return score
 
+    def getHistory(self, person, requirement):
+        evaluations = removeSecurityProxy(IEvaluations(person))
+        return list(evaluations.getHistory(requirement))
+
+    def evaluateMany(self, changes, evaluator=None):
+        parsed, rejected = parseChanges(changes)
+        applied = applyChanges(parsed, evaluator=evaluator)
+        if applied:
+            self.noteChange([person for person, r, p, e in applied])
+        return rejected
+
+    def getEvaluationMatrix(self, persons, meetings, requirement_factory,
+                            score_system=None, default=None):
+        return getEvaluationMatrix(persons, meetings, requirement_factory,
+                                   score_system=score_system,
+                                   default=default,
+                                   requirements=self.requirements)
+
 
 class MeetingRequirement(tuple):
     implements(IKeyReference)
@@ -367,10 +1470,51 @@ class HomeroomRequirement(SchoolMeetingRequirement):
     score_system = AbsenceScoreSystem
 
 
-class SectionJournalData(Persistent):
-    """A journal for a section."""
+class RequirementCache(object):
+    """Interns meeting requirements.
+
+    Building a requirement adapts the meeting target to IKeyReference,
+    so requirements of the same meeting and score system are built
+    once and shared.  The cache is emptied when it gets full.
+    """
+
+    max_size = 10000
+
+    def __init__(self):
+        self._requirements = {}
+
+    def __call__(self, requirement_factory, meeting, score_system=None):
+        key = (requirement_factory, meeting.unique_id, meeting.meeting_id,
+               meeting.dtstart, score_system)
+        requirement = self._requirements.get(key)
+        if requirement is None:
+            if len(self._requirements) >= self.max_size:
+                self._requirements.clear()
+            requirement = requirement_factory(meeting, score_system)
+            self._requirements[key] = requirement
+        return requirement
+
+
+class SectionJournalData(EvaluationLog, Persistent):
+    """A journal for a section.
+
+    Evaluations of the section are indexed twice, however they were
+    written (see storeEvaluation): by (requirement type, meeting id,
+    student int id) and by (requirement type, student int id, date,
+    meeting id).  The second index lets us find all meetings a student
+    was scored in (optionally within a date range) without walking the
+    calendar.  The indexes are created with the first evaluation.
+    Changes and attendance of the section are logged in the journal
+    too (see EvaluationLog).
+    """
     implements(ISectionJournalData, ILocation)
 
+    _meeting_index = None
+    _student_index = None
+    _attendance = None
+    _score_counts = None
+    _counts_stamp = None
+
     def __init__(self):
         self.__parent__ = None
         self.__name__ = None
@@ -386,64 +1530,451 @@ class SectionJournalData(Persistent):
             entry_id = meeting.unique_id
         return (key, entry_id)
 
-    def evaluate(self, person, requirement, grade, evaluator=None, score_system=None):
-        if score_system is None:
-            score_system = requirement.score_system
-        score = score_system.fromUnicode(grade)
-        evaluations = removeSecurityProxy(IEvaluations(person))
+    @property
+    def requirements(self):
+        cache = getattr(self, '_v_requirements', None)
+        if cache is None:
+            cache = self._v_requirements = RequirementCache()
+        return cache
+
+    def getStudentId(self, person):
+        int_ids = getUtility(IIntIds)
+        return int_ids.queryId(removeSecurityProxy(person))
+
+    def isIndexed(self, requirement_factory):
+        """Are evaluations of these requirements stored in this journal?"""
+        return not issubclass(requirement_factory, SchoolMeetingRequirement)
+
+    def enableCompactAttendance(self):
+        """Store attendance marks of this section in month buckets.
 
-        if requirement in evaluations:
-            current = evaluations[requirement]
+        Marks recorded before are still read from the evaluations of
+        students until they get changed.
+        """
+        journal = self.getStoredJournal()
+        if journal._attendance is None:
+            journal._attendance = AttendanceStorage()
+
+    def updateCompactAttendance(self, requirements):
+        """Enable compact storage before attendance marks are written.
+
+        Done if compact attendance is turned on in journal preferences.
+        Journals keep compact storage when it is turned off.
+        """
+        if self._attendance is not None:
+            return
+        for requirement in requirements:
+            if isinstance(requirement, AttendanceRequirement):
+                break
+        else:
+            return
+        app = ISchoolToolApplication(None, None)
+        if app is None:
+            return
+        prefs = app.get('schooltool.lyceum.journal-ss-prefs')
+        if getattr(prefs, 'compact_attendance', False):
+            self.enableCompactAttendance()
+
+    def isCompact(self, requirement_factory):
+        """Are these requirements stored in compact attendance storage?"""
+        return (self._attendance is not None and
+                issubclass(requirement_factory, AttendanceRequirement))
+
+    def getCompactEvaluation(self, person, requirement, evaluations=None):
+        student_id = self.getStudentId(person)
+        score = None
+        if student_id is not None:
+            score = self._attendance.get(student_id, requirement)
+        if score is None:
+            if evaluations is None:
+                evaluations = removeSecurityProxy(IEvaluations(person))
+            score = evaluations.get(requirement)
+        return score
+
+    def storeCompactEvaluation(self, person, requirement, score_system,
+                               score, evaluator=None):
+        """Store an attendance mark in compact storage.
+
+        Marks of persons without int ids go to their evaluations.
+        Returns True if anything was written.
+        """
+        student_id = self.getStudentId(person)
+        if student_id is None:
+            stored = storeEvaluation(person, requirement, score_system,
+                                     score, evaluator=evaluator,
+                                     journal=self)
+            return stored is not None
+        current = self.getCompactEvaluation(person, requirement)
+        if current is not None:
             if (current.value == score and
                 current.evaluator == evaluator):
-                return
+                return False
+        elif score is UNSCORED:
+            return False
+        self._attendance.set(student_id, requirement, score_system, score,
+                             evaluator=evaluator)
+        noteEvaluation(person, requirement, current, score_system, score,
+                       journal=self)
+        return True
+
+    def getStoredJournal(self):
+        """Return this journal as stored in the journal container.
+
+        A journal that was only read so far gets stored now.
+        """
+        container = getattr(self, '_v_container', None)
+        if self.__parent__ is not None or container is None:
+            return self
+        journal = container.get(self.__name__, None)
+        if journal is None:
+            container[self.__name__] = journal = self
+        return journal
+
+    def getPeriod(self, requirement):
+        """Return (local start time, period title) of a meeting.
+
+        None if the meeting is no longer in the calendar.
+        """
+        app = ISchoolToolApplication(None, None)
+        section = ISection(self, None)
+        if app is None or section is None:
+            return None
+        meeting_index = getMeetingIndex(section)
+        meeting = meeting_index.keys.get(
+            (requirement.date, requirement.meeting_id))
+        if meeting is None:
+            return None
+        return (meeting_index.localStart(meeting).time(),
+                getPeriodTitle(meeting))
+
+    def indexEvaluation(self, student_id, requirement):
+        """Index an evaluation of a student by int id.
+
+        Index trees are created when the first evaluation is indexed.
+        """
+        if not self.isIndexed(type(requirement)):
+            return
+        journal = self.getStoredJournal()
+        if journal._meeting_index is None:
+            journal._meeting_index = OOBTree()
+            journal._student_index = OOBTree()
+        requirement_type = requirement.requirement_type
+        meeting_key = (requirement_type, requirement.meeting_id, student_id)
+        if meeting_key not in journal._meeting_index:
+            journal._meeting_index[meeting_key] = requirement
+        student_key = (requirement_type, student_id,
+                       requirement.date, requirement.meeting_id)
+        if student_key not in journal._student_index:
+            journal._student_index[student_key] = requirement
+
+    def getCountsStamp(self):
+        """Return what score counts of this journal depend on.
+
+        That is versions of meetings of the section and its term and
+        the dates of the term, or None if scores can not be counted.
+        """
+        app = ISchoolToolApplication(None, None)
+        section = ISection(self, None)
+        if app is None or section is None:
+            return None
+        term = ITerm(section, None)
+        if term is None:
+            return None
+        jc = app['schooltool.lyceum.journal']
+        return (jc.getSectionMeetingsStamp(section), term.first, term.last)
+
+    def isCounted(self, requirement, stamp, meeting_index):
+        """Is the evaluation of a requirement in the score counts?"""
+        if not stamp[1] <= requirement.date <= stamp[2]:
+            return False
+        return (requirement.date, requirement.meeting_id) in meeting_index.keys
+
+    def recountScores(self, stamp=None):
+        """Count scores of students in the term of the section again."""
+        journal = self.getStoredJournal()
+        if stamp is None:
+            stamp = journal.getCountsStamp()
+        journal._counts_stamp = stamp
+        journal._score_counts = None
+        if stamp is None or journal._student_index is None:
+            return
+        journal._score_counts = OOBTree()
+        meeting_index = getMeetingIndex(journal.section)
+        int_ids = getUtility(IIntIds)
+        person = person_id = None
+        for key, requirement in journal._student_index.items():
+            requirement_type, student_id = key[:2]
+            if not journal.isCounted(requirement, stamp, meeting_index):
+                continue
+            if student_id != person_id:
+                person_id = student_id
+                person = int_ids.queryObject(student_id)
+            if person is None:
+                continue
+            score = journal.getEvaluation(person, requirement)
+            if score is None or score.value is UNSCORED:
+                continue
+            journal.addScoreCount(requirement_type, student_id,
+                                  score.scoreSystem, score.value, 1)
+
+    def addScoreCount(self, requirement_type, student_id, score_system,
+                      value, count):
+        key = (requirement_type, student_id)
+        counts = self._score_counts.get(key)
+        if counts is None:
+            counts = self._score_counts[key] = ScoreCounts()
+        counts.add(score_system, value, count)
+
+    def countEvaluation(self, student_id, requirement, previous,
+                        score_system, score):
+        """Update score counts with a new evaluation of a student.
+
+        Scores are counted again from the index if meetings of the
+        section or its term changed since they were counted.
+        """
+        if not self.isIndexed(type(requirement)):
+            return
+        journal = self.getStoredJournal()
+        stamp = journal.getCountsStamp()
+        if stamp is None or journal._counts_stamp != stamp:
+            journal.recountScores(stamp)
+            return
+        meeting_index = getMeetingIndex(journal.section)
+        if not journal.isCounted(requirement, stamp, meeting_index):
+            return
+        requirement_type = requirement.requirement_type
+        if previous is not None and previous.value is not UNSCORED:
+            journal.addScoreCount(requirement_type, student_id,
+                                  previous.scoreSystem, previous.value, -1)
+        if score is not UNSCORED:
+            journal.addScoreCount(requirement_type, student_id,
+                                  score_system, score, 1)
+
+    def getTermScoreCounts(self, person, requirement_factory, first, last):
+        """Return a list of (score, count) of a student from score counts.
+
+        Returns None unless first and last are the dates of the term of
+        the section and scores were counted since meetings last changed.
+        """
+        if self._score_counts is None or self._counts_stamp is None:
+            return None
+        if (first, last) != self._counts_stamp[1:]:
+            return None
+        if self.getCountsStamp() != self._counts_stamp:
+            return None
+        student_id = self.getStudentId(person)
+        if student_id is None:
+            return None
+        counts = self._score_counts.get(
+            (requirement_factory.requirement_type, student_id))
+        if counts is None:
+            return []
+        return counts.items()
+
+    def getScoreCounts(self, person, requirement_factory=GradeRequirement,
+                       first=None, last=None, meetings=None):
+        """Return a list of (score, count) of a student.
+
+        Only evaluations of meetings in the calendar of the section (or
+        in meetings, a dict as returned by getCalendarMeetings) are
+        counted.  Returns None if evaluations of these requirements are
+        not indexed.
+        """
+        if not self.isIndexed(requirement_factory):
+            return None
+        evaluations = self.getStudentEvaluations(
+            person, requirement_factory, first=first, last=last)
+        if not evaluations:
+            return []
+        if meetings is None:
+            meetings = self.getCalendarMeetings()
+        return countScores([score for requirement, score in evaluations
+                            if (requirement.date, requirement.meeting_id)
+                            in meetings])
+
+    def iterStudentRequirements(self, person, requirement_factory,
+                                first=None, last=None):
+        """Indexed requirements of a student, ordered by date.
+
+        If first and last are given, only requirements of meetings
+        in that date range (inclusive) are returned.
+        """
+        if self._student_index is None:
+            return []
+        student_id = self.getStudentId(person)
+        if student_id is None:
+            return []
+        requirement_type = requirement_factory.requirement_type
+        min_key = (requirement_type, student_id)
+        if first is not None:
+            min_key += (first, )
+        if last is None:
+            max_key = (requirement_type, student_id + 1)
         else:
-            if score is UNSCORED:
-                return
+            max_key = (requirement_type, student_id,
+                       last + datetime.timedelta(1))
+        return self._student_index.values(
+            min=min_key, max=max_key, excludemax=True)
+
+    def getStudentEvaluations(self, person, requirement_factory=GradeRequirement,
+                              first=None, last=None):
+        """Return a list of (requirement, evaluation) for a student."""
+        requirements = self.iterStudentRequirements(
+            person, requirement_factory, first=first, last=last)
+        result = []
+        evaluations = None
+        compact = self.isCompact(requirement_factory)
+        for requirement in requirements:
+            if evaluations is None:
+                evaluations = removeSecurityProxy(IEvaluations(person))
+            if compact:
+                score = self.getCompactEvaluation(person, requirement,
+                                                  evaluations)
+            else:
+                score = evaluations.get(requirement)
+            if score is not None:
+                result.append((requirement, score))
+        return result
 
-        eval = Evaluation(requirement, score_system, score, evaluator=evaluator)
-        evaluations.addEvaluation(eval)
+    def hasEvaluation(self, person, requirement):
+        if self._meeting_index is None:
+            return False
+        student_id = self.getStudentId(person)
+        if student_id is None:
+            return False
+        key = (requirement.requirement_type, requirement.meeting_id, student_id)
+        return key in self._meeting_index
+
+    def getEvaluationMatrix(self, persons, meetings, requirement_factory,
+                            score_system=None, default=None):
+        if not self.isCompact(requirement_factory):
+            return getEvaluationMatrix(persons, meetings, requirement_factory,
+                                       score_system=score_system,
+                                       default=default,
+                                       requirements=self.requirements)
+        requirements = [self.requirements(requirement_factory,
+                                          removeSecurityProxy(meeting),
+                                          score_system)
+                        for meeting in meetings]
+        result = []
+        for person in persons:
+            person = removeSecurityProxy(person)
+            evaluations = removeSecurityProxy(IEvaluations(person))
+            row = []
+            for requirement in requirements:
+                score = self.getCompactEvaluation(person, requirement,
+                                                  evaluations)
+                if score is None:
+                    score = default
+                row.append(score)
+            result.append(row)
+        return result
+
+    def evaluate(self, person, requirement, grade, evaluator=None, score_system=None):
+        if score_system is None:
+            score_system = requirement.score_system
+        score = score_system.fromUnicode(grade)
+        self.updateCompactAttendance([requirement])
+        if self.isCompact(type(requirement)):
+            if self.storeCompactEvaluation(person, requirement, score_system,
+                                           score, evaluator=evaluator):
+                self.noteChange()
+            return
+        if storeEvaluation(person, requirement, score_system, score,
+                           evaluator=evaluator, journal=self) is not None:
+            self.noteChange()
+
+    def evaluateMany(self, changes, evaluator=None):
+        parsed, rejected = parseChanges(changes)
+        self.updateCompactAttendance([change[1] for change in parsed])
+        compact = []
+        if self._attendance is not None:
+            stored = []
+            for change in parsed:
+                if not self.isCompact(type(change[1])):
+                    stored.append(change)
+                    continue
+                person, requirement, score = change
+                if self.storeCompactEvaluation(
+                    person, requirement, requirement.score_system, score,
+                    evaluator=evaluator):
+                    compact.append(change)
+            parsed = stored
+        applied = applyChanges(parsed, evaluator=evaluator, journal=self)
+        if compact or applied:
+            self.noteChange()
+        return rejected
 
     def getEvaluation(self, person, requirement, default=None):
+        if self.isCompact(type(requirement)):
+            score = self.getCompactEvaluation(person, requirement)
+            if score is None:
+                return default
+            return score
         evaluations = removeSecurityProxy(IEvaluations(person))
         score = evaluations.get(requirement)
         if score is None:
             return default
         return score
 
+    def getHistory(self, person, requirement):
+        """Previous evaluations, from evaluations of the student first.
+
+        The last evaluation of the student is history too once the
+        mark is changed in compact storage.
+        """
+        evaluations = removeSecurityProxy(IEvaluations(person))
+        history = list(evaluations.getHistory(requirement))
+        student_id = self.getStudentId(person)
+        if (not self.isCompact(type(requirement)) or
+            student_id is None or
+            self._attendance.get(student_id, requirement) is None):
+            return history
+        previous = evaluations.get(requirement)
+        if previous is not None:
+            history.append(previous)
+        history.extend(self._attendance.getHistory(student_id, requirement))
+        return history
+
     def setGrade(self, person, meeting, grade, evaluator=None):
-        requirement = GradeRequirement(removeSecurityProxy(meeting))
+        requirement = self.requirements(
+            GradeRequirement, removeSecurityProxy(meeting))
         self.evaluate(person, requirement, grade, evaluator=evaluator)
 
     def getGrade(self, person, meeting, default=None):
-        requirement = GradeRequirement(removeSecurityProxy(meeting))
+        requirement = self.requirements(
+            GradeRequirement, removeSecurityProxy(meeting))
         score = self.getEvaluation(person, requirement, default=default)
         if score is not default:
             return score.value
         return default
 
     def setAbsence(self, person, meeting, explained=True, evaluator=None, value=ABSENT):
-        requirement = AttendanceRequirement(removeSecurityProxy(meeting))
+        requirement = self.requirements(
+            AttendanceRequirement, removeSecurityProxy(meeting))
         # XXX: how to mark explained absences?  With score comments OFC
         #      so we need score comments now.
         self.evaluate(person, requirement, value, evaluator=evaluator)
 
     def getAbsence(self, person, meeting, default=''):
-        requirement = AttendanceRequirement(removeSecurityProxy(meeting))
+        requirement = self.requirements(
+            AttendanceRequirement, removeSecurityProxy(meeting))
         score = self.getEvaluation(person, requirement, default=default)
         if score is default:
             return default
         return score.value
 
     def isAbsent(self, person, meeting):
-        requirement = AttendanceRequirement(removeSecurityProxy(meeting))
+        requirement = self.requirements(
+            AttendanceRequirement, removeSecurityProxy(meeting))
         score = self.getEvaluation(person, requirement, default=None)
         if score is None:
             return False
         return score.scoreSystem.isAbsent(score)
 
     def isTardy(self, person, meeting):
-        requirement = AttendanceRequirement(removeSecurityProxy(meeting))
+        requirement = self.requirements(
+            AttendanceRequirement, removeSecurityProxy(meeting))
         score = self.getEvaluation(person, requirement, default=None)
         if score is None:
             return False
@@ -456,28 +1987,28 @@ class SectionJournalData(Persistent):
             entry_id = meeting.unique_id
         return (date, entry_id)
 
-    def recordedMeetings(self, person):
-        result = []
-        unique_meetings = set()
+    def getCalendarMeetings(self):
+        """Return a dict of section meetings by their description keys.
+
+        When several events share a meeting id, the earliest one wins.
+        """
+        result = {}
         calendar = ISchoolToolCalendar(self.section)
-        sorted_events = sorted(calendar, key=lambda e: e.dtstart)
-        evaluations = removeSecurityProxy(IEvaluations(person))
-        for event in sorted_events:
-            requirement = GradeRequirement(removeSecurityProxy(event))
-            if (requirement in evaluations and
-                event.meeting_id not in unique_meetings):
-                result.append(event)
-                unique_meetings.add(event.meeting_id)
+        for event in sorted(calendar, key=lambda e: e.dtstart):
+            key = self.descriptionKey(event)
+            if key not in result:
+                result[key] = event
         return result
 
-    def gradedMeetings(self, person, requirement_factory=GradeRequirement):
+    def scanMeetings(self, person, requirement_factory):
         result = []
         unique_meetings = set()
         calendar = ISchoolToolCalendar(self.section)
         sorted_events = sorted(calendar, key=lambda e: e.dtstart)
         evaluations = removeSecurityProxy(IEvaluations(person))
         for event in sorted_events:
-            requirement = requirement_factory(removeSecurityProxy(event))
+            requirement = self.requirements(
+                requirement_factory, removeSecurityProxy(event))
             score = evaluations.get(requirement)
             if (requirement in evaluations and
                 event.meeting_id not in unique_meetings):
@@ -485,6 +2016,24 @@ class SectionJournalData(Persistent):
                 unique_meetings.add(event.meeting_id)
         return result
 
+    def recordedMeetings(self, person):
+        return [event for event, score in self.gradedMeetings(person)]
+
+    def gradedMeetings(self, person, requirement_factory=GradeRequirement):
+        if not self.isIndexed(requirement_factory):
+            return self.scanMeetings(person, requirement_factory)
+        evaluations = self.getStudentEvaluations(person, requirement_factory)
+        if not evaluations:
+            return []
+        meetings = self.getCalendarMeetings()
+        result = []
+        for requirement, score in evaluations:
+            event = meetings.get((requirement.date, requirement.meeting_id))
+            if event is not None:
+                result.append((event, score))
+        result.sort(key=lambda (event, score): event.dtstart)
+        return result
+
     def absentMeetings(self, person):
         return self.gradedMeetings(
             person, requirement_factory=AttendanceRequirement)
@@ -551,15 +2100,7 @@ class SectionJournal(object):
     def meetings(self):
         """Ordered list of all meetings for this section with
            consecutive periods removed if the timetable is so configured."""
-        events = []
-        unique_meetings = set()
-        calendar = ISchoolToolCalendar(removeSecurityProxy(self.section))
-        sorted_events = sorted(calendar, key=lambda e: e.dtstart)
-        for event in sorted_events:
-            if event.meeting_id not in unique_meetings:
-                events.append(event)
-                unique_meetings.add(event.meeting_id)
-        return sorted(events)
+        return list(getMeetingIndex(self.section).meetings)
 
     def recordedMeetings(self, person):
         """Ordered list of all recorded meetings for this person.
@@ -579,6 +2120,32 @@ class SectionJournal(object):
     def absentMeetings(self, person):
         return self.gradedMeetings(person, requirement_factory=AttendanceRequirement)
 
+    def getEvaluationMatrix(self, persons, meetings, requirement_factory,
+                            score_system=None, default=None):
+        sd = ISectionJournalData(removeSecurityProxy(self.section))
+        return sd.getEvaluationMatrix(persons, meetings, requirement_factory,
+                                      score_system=score_system,
+                                      default=default)
+
+    @Lazy
+    def calendar_meetings(self):
+        sd = ISectionJournalData(removeSecurityProxy(self.section))
+        return sd.getCalendarMeetings()
+
+    def getScoreCounts(self, person, requirement_factory=GradeRequirement,
+                       term=None):
+        sd = ISectionJournalData(removeSecurityProxy(self.section))
+        first = last = None
+        if term is not None:
+            first, last = term.first, term.last
+            counts = sd.getTermScoreCounts(person, requirement_factory,
+                                           first, last)
+            if counts is not None:
+                return counts
+        return sd.getScoreCounts(person, requirement_factory,
+                                 first=first, last=last,
+                                 meetings=self.calendar_meetings)
+
     def hasMeeting(self, person, meeting):
         calendar = meeting.__parent__
         owner = calendar.__parent__
@@ -591,7 +2158,11 @@ class SectionJournal(object):
 
 
 def getSectionJournalData(section):
-    """Get the journal for the section."""
+    """Get the journal for the section.
+
+    Journals of sections that were never graded are not stored in the
+    journal container until something gets written to them.
+    """
     app = ISchoolToolApplication(None)
     jc = app['schooltool.lyceum.journal']
 
@@ -600,7 +2171,9 @@ def getSectionJournalData(section):
 
     journal = jc.get(section_id, None)
     if journal is None:
-        jc[section_id] = journal = SectionJournalData()
+        journal = SectionJournalData()
+        journal.__name__ = section_id
+        journal._v_container = jc
 
     return journal
 
@@ -648,6 +2221,19 @@ class JournalXLSReportTask(XLSReportTask):
         XLSReportTask.context.fset(self, section)
 
 
+class XLSXReportTask(XLSReportTask):
+
+    default_mimetype = ('application/'
+                        'vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    default_filename = 'report.xlsx'
+
+
+class JournalXLSXReportTask(JournalXLSReportTask):
+
+    default_mimetype = XLSXReportTask.default_mimetype
+    default_filename = XLSXReportTask.default_filename
+
+
 class JournalPDFReportTask(ReportTask):
 
     @property
@@ -679,6 +2265,7 @@ class ScoreSystemPreferences(Persistent):
 
     grading_scoresystem = None
     attendance_scoresystem = None
+    compact_attendance = False
 
 
 @adapter(Interface)
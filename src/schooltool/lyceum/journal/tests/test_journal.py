@@ -22,14 +22,21 @@ Unit tests for lyceum journal.
 import unittest, doctest
 import datetime
 
+from persistent import Persistent
+from persistent.mapping import PersistentMapping
 from zope.component import adapter
+from zope.component import getGlobalSiteManager
 from zope.component import provideAdapter
+from zope.component import provideUtility
 from zope.app.testing import setup
+from zope.component.hooks import getSite
 from zope.interface import implementer
 from zope.interface import implements
 from zope.interface.verify import verifyObject
 from zope.keyreference.interfaces import IKeyReference
+from zope.intid.interfaces import IIntIds
 
+from schooltool.app.interfaces import ISchoolToolCalendar
 from schooltool.course.interfaces import ISection
 from schooltool.requirement.testing import KeyReferenceStub
 from schooltool.requirement.evaluation import Evaluations
@@ -46,6 +53,52 @@ def stubbedGetEvaluations(context):
     return evals
 
 
+class IntIdsStub(object):
+    implements(IIntIds)
+
+    def getId(self, obj):
+        return obj.intid
+
+    def queryId(self, obj, default=None):
+        return getattr(obj, 'intid', default)
+
+
+class ExportAppStub(PersistentMapping):
+
+    def getSiteManager(self):
+        return getGlobalSiteManager()
+
+
+class ExportObjectStub(Persistent):
+
+    def __init__(self, title):
+        self.title = title
+
+
+class SiteIntIdsStub(object):
+    """Int ids of objects stored in the site by their ids."""
+    implements(IIntIds)
+
+    def getObject(self, id):
+        return getSite()[str(id)]
+
+    def queryObject(self, id, default=None):
+        return getSite().get(str(id), default)
+
+
+class ExportSheetStub(object):
+    name = 'attendance'
+    activities = []
+
+    def __init__(self, engine, section):
+        self.engine = engine
+        self.section = section
+
+    def rows(self):
+        return [(self.engine.term.title, self.section.title,
+                 self.engine.__dict__.get('changes'))]
+
+
 def doctest_SectionJournalData():
     """Tests for SectionJournalData
 
@@ -159,6 +212,574 @@ def doctest_SectionJournalData():
     """
 
 
+def doctest_SectionJournalData_index():
+    """Tests for the evaluation index of SectionJournalData
+
+        >>> from schooltool.lyceum.journal.journal import SectionJournalData
+        >>> from schooltool.lyceum.journal.journal import GradeRequirement
+        >>> from schooltool.lyceum.journal.journal import AttendanceRequirement
+        >>> journal = SectionJournalData()
+
+        >>> class SectionStub(object):
+        ...     def __conform__(self, iface):
+        ...         if iface == ISchoolToolCalendar:
+        ...             return calendar
+        >>> section = SectionStub()
+
+        >>> provideAdapter(lambda jd: section,
+        ...                adapts=(ISectionJournalData, ),
+        ...                provides=ISection)
+        >>> provideAdapter(KeyReferenceStub,
+        ...                adapts=(SectionStub, ),
+        ...                provides=IKeyReference)
+
+        >>> class CalendarStub(list):
+        ...     def __init__(self, section):
+        ...         self.__parent__ = section
+        >>> calendar = CalendarStub(section)
+
+        >>> class MeetingStub(object):
+        ...     __parent__ = calendar
+        ...     meeting_id = None
+        ...     def __init__(self, uid, date):
+        ...         self.dtstart = datetime.datetime(
+        ...             date.year, date.month, date.day)
+        ...         self.unique_id = uid
+
+        >>> class PersonStub(object):
+        ...     def __init__(self, name, intid):
+        ...         self.__name__ = name
+        ...         self.intid = intid
+
+        >>> provideAdapter(stubbedGetEvaluations,
+        ...                adapts=(PersonStub, ),
+        ...                provides=IEvaluations)
+
+        >>> john = PersonStub('john', 1)
+        >>> pete = PersonStub('pete', 2)
+
+        >>> m1 = MeetingStub('m1', datetime.date(2011, 5, 5))
+        >>> m2 = MeetingStub('m2', datetime.date(2011, 5, 6))
+        >>> m3 = MeetingStub('m3', datetime.date(2011, 6, 1))
+        >>> calendar.extend([m3, m1, m2])
+
+    Every evaluation made through the journal gets indexed:
+
+        >>> journal.setGrade(john, m1, "5")
+        >>> journal.setGrade(john, m3, "7")
+        >>> journal.setAbsence(john, m2)
+        >>> journal.setGrade(pete, m2, "3")
+
+    Empty grades of cells that were never scored are not recorded:
+
+        >>> journal.setGrade(pete, m1, "")
+
+        >>> journal.hasEvaluation(john, GradeRequirement(m1))
+        True
+        >>> journal.hasEvaluation(pete, GradeRequirement(m1))
+        False
+
+    So graded meetings can be found without probing every event
+    of the calendar:
+
+        >>> [(e.unique_id, s.value) for e, s in journal.gradedMeetings(john)]
+        [('m1', Decimal('5')), ('m3', Decimal('7'))]
+
+        >>> [(e.unique_id, s.value) for e, s in journal.absentMeetings(john)]
+        [('m2', 'n')]
+
+        >>> [e.unique_id for e in journal.recordedMeetings(pete)]
+        ['m2']
+
+    Evaluations of a student can be limited to a date range:
+
+        >>> evaluations = journal.getStudentEvaluations(
+        ...     john, GradeRequirement,
+        ...     first=datetime.date(2011, 5, 1),
+        ...     last=datetime.date(2011, 5, 31))
+        >>> [(r.date, s.value) for r, s in evaluations]
+        [(datetime.date(2011, 5, 5), Decimal('5'))]
+
+    Evaluations of several students can be fetched at once:
+
+        >>> matrix = journal.getEvaluationMatrix(
+        ...     [john, pete], [m1, m2, m3], GradeRequirement, default='-')
+        >>> for row in matrix:
+        ...     print [getattr(score, 'value', score) for score in row]
+        [Decimal('5'), '-', Decimal('7')]
+        ['-', Decimal('3'), '-']
+
+    Requirements built by the journal are shared:
+
+        >>> requirement = journal.requirements(GradeRequirement, m1)
+        >>> requirement == GradeRequirement(m1)
+        True
+        >>> journal.requirements(GradeRequirement, m1) is requirement
+        True
+
+    The cache is emptied when it gets full:
+
+        >>> journal.requirements.max_size = 1
+        >>> journal.requirements(GradeRequirement, m2) == GradeRequirement(m2)
+        True
+        >>> journal.requirements(GradeRequirement, m1) is requirement
+        False
+
+    Many cells can be evaluated at once.  Grades are validated up front
+    and invalid ones are returned:
+
+        >>> changes = [(pete, GradeRequirement(m1), "8"),
+        ...            (pete, GradeRequirement(m3), "bad"),
+        ...            (john, GradeRequirement(m1), "5")]
+        >>> rejected = journal.evaluateMany(changes)
+        >>> [(person.__name__, grade) for person, r, grade in rejected]
+        [('pete', 'bad')]
+
+        >>> print journal.getGrade(pete, m1)
+        8
+        >>> journal.hasEvaluation(pete, GradeRequirement(m1))
+        True
+        >>> print journal.getGrade(pete, m3)
+        None
+
+    Unchanged cells are not evaluated again:
+
+        >>> history = IEvaluations(john).getHistory(GradeRequirement(m1))
+        >>> len(list(history))
+        0
+
+    Scores of a student are counted from the index:
+
+        >>> def printCounts(counts):
+        ...     for score, count in sorted(counts, key=lambda c: c[0].value):
+        ...         print score.value, count
+        >>> printCounts(journal.getScoreCounts(pete, GradeRequirement))
+        3 1
+        8 1
+        >>> journal.setGrade(pete, m2, "8")
+        >>> printCounts(journal.getScoreCounts(pete, GradeRequirement))
+        8 2
+        >>> journal.setGrade(pete, m1, "")
+        >>> printCounts(journal.getScoreCounts(pete, GradeRequirement))
+        8 1
+        >>> printCounts(journal.getScoreCounts(john, AttendanceRequirement))
+        n 1
+
+    Counts can be limited to the dates of a term.  The section journal
+    counts scores of the term it is asked about:
+
+        >>> from schooltool.lyceum.journal.journal import SectionJournal
+        >>> provideAdapter(lambda section: journal,
+        ...                adapts=(SectionStub, ),
+        ...                provides=ISectionJournalData)
+        >>> class TermStub(object):
+        ...     def __init__(self, first, last):
+        ...         self.first, self.last = first, last
+        >>> may = TermStub(datetime.date(2011, 5, 1), datetime.date(2011, 5, 31))
+        >>> june = TermStub(datetime.date(2011, 6, 1), datetime.date(2011, 6, 30))
+
+        >>> sj = SectionJournal(section)
+        >>> printCounts(sj.getScoreCounts(john, GradeRequirement, term=may))
+        5 1
+        >>> printCounts(sj.getScoreCounts(john, GradeRequirement, term=june))
+        7 1
+        >>> printCounts(sj.getScoreCounts(john, GradeRequirement))
+        5 1
+        7 1
+
+    Meetings that are no longer in the calendar are skipped:
+
+        >>> calendar.remove(m3)
+        >>> [(e.unique_id, s.value) for e, s in journal.gradedMeetings(john)]
+        [('m1', Decimal('5'))]
+        >>> printCounts(journal.getScoreCounts(john, GradeRequirement))
+        5 1
+
+    """
+
+
+def doctest_SectionJournalData_score_counts():
+    """Tests for score counts kept by SectionJournalData
+
+        >>> import pytz
+        >>> from schooltool.app.interfaces import ISchoolToolApplication
+        >>> from schooltool.app.interfaces import IApplicationPreferences
+        >>> from schooltool.term.interfaces import ITerm
+        >>> from schooltool.lyceum.journal.journal import SectionJournalData
+        >>> from schooltool.lyceum.journal.journal import GradeRequirement
+        >>> from schooltool.lyceum.journal.journal import AttendanceRequirement
+        >>> journal = SectionJournalData()
+
+        >>> class TermStub(object):
+        ...     first = datetime.date(2011, 5, 1)
+        ...     last = datetime.date(2011, 5, 31)
+        >>> term = TermStub()
+
+        >>> class SectionStub(object):
+        ...     intid = 10
+        ...     def __conform__(self, iface):
+        ...         if iface == ISchoolToolCalendar:
+        ...             return calendar
+        ...         if iface == ITerm:
+        ...             return term
+        >>> section = SectionStub()
+        >>> provideAdapter(lambda jd: section,
+        ...                adapts=(ISectionJournalData, ),
+        ...                provides=ISection)
+        >>> provideAdapter(KeyReferenceStub,
+        ...                adapts=(SectionStub, ),
+        ...                provides=IKeyReference)
+
+        >>> class JournalContainerStub(object):
+        ...     version = 0
+        ...     def getSectionMeetingsStamp(self, section):
+        ...         return (self.version, 0)
+        >>> jc = JournalContainerStub()
+
+        >>> class AppStub(dict):
+        ...     timezone = 'UTC'
+        ...     def __conform__(self, iface):
+        ...         if iface == IApplicationPreferences:
+        ...             return self
+        >>> app = AppStub({'schooltool.lyceum.journal': jc})
+        >>> provideAdapter(lambda context: app, adapts=[None],
+        ...                provides=ISchoolToolApplication)
+
+        >>> class CalendarStub(list):
+        ...     __parent__ = section
+        >>> calendar = CalendarStub()
+
+        >>> class MeetingStub(object):
+        ...     __parent__ = calendar
+        ...     meeting_id = None
+        ...     def __init__(self, uid, date):
+        ...         self.dtstart = datetime.datetime(
+        ...             date.year, date.month, date.day, tzinfo=pytz.UTC)
+        ...         self.unique_id = uid
+
+        >>> class PersonStub(object):
+        ...     def __init__(self, name, intid):
+        ...         self.__name__ = name
+        ...         self.intid = intid
+        >>> provideAdapter(stubbedGetEvaluations,
+        ...                adapts=(PersonStub, ),
+        ...                provides=IEvaluations)
+
+        >>> john = PersonStub('john', 1)
+        >>> pete = PersonStub('pete', 2)
+
+        >>> class PersonIntIdsStub(IntIdsStub):
+        ...     def queryObject(self, id, default=None):
+        ...         return {1: john, 2: pete}.get(id, default)
+        >>> provideUtility(PersonIntIdsStub())
+
+        >>> m1 = MeetingStub('m1', datetime.date(2011, 5, 5))
+        >>> m2 = MeetingStub('m2', datetime.date(2011, 5, 6))
+        >>> m3 = MeetingStub('m3', datetime.date(2011, 6, 1))
+        >>> calendar.extend([m1, m2, m3])
+
+        >>> def printCounts(counts):
+        ...     if counts is None:
+        ...         print None
+        ...         return
+        ...     for score, count in sorted(counts, key=lambda c: c[0].value):
+        ...         print score.value, count
+        >>> def printTermCounts(person, requirement_factory=GradeRequirement):
+        ...     printCounts(journal.getTermScoreCounts(
+        ...         person, requirement_factory, term.first, term.last))
+
+    Scores of students are counted as they are evaluated, for meetings
+    in the term of the section:
+
+        >>> journal.setGrade(john, m1, "5")
+        >>> journal.setGrade(john, m2, "7")
+        >>> journal.setGrade(john, m3, "9")
+        >>> journal.setAbsence(john, m1)
+        >>> printTermCounts(john)
+        5 1
+        7 1
+        >>> printTermCounts(john, AttendanceRequirement)
+        n 1
+        >>> printTermCounts(pete)
+
+    Changed and cleared scores are counted off:
+
+        >>> journal.setGrade(john, m2, "5")
+        >>> printTermCounts(john)
+        5 2
+        >>> journal.setGrade(john, m1, "")
+        >>> printTermCounts(john)
+        5 1
+
+    Counts of other dates are not kept:
+
+        >>> printCounts(journal.getTermScoreCounts(
+        ...     john, GradeRequirement, term.first, datetime.date(2011, 6, 30)))
+        None
+
+    Counts are out of date when meetings of the section or its term
+    change, until the next evaluation counts them again:
+
+        >>> calendar.remove(m2)
+        >>> jc.version += 1
+        >>> printTermCounts(john)
+        None
+        >>> journal.setGrade(pete, m1, "3")
+        >>> printTermCounts(john)
+        >>> printTermCounts(pete)
+        3 1
+
+    """
+
+
+def doctest_storeEvaluation():
+    """Tests for storeEvaluation
+
+        >>> from schooltool.lyceum.journal.journal import storeEvaluation
+        >>> from schooltool.lyceum.journal.journal import SectionJournalData
+        >>> from schooltool.lyceum.journal.journal import GradeRequirement
+        >>> journal = SectionJournalData()
+
+        >>> class SectionStub(object):
+        ...     implements(ISection)
+        >>> section = SectionStub()
+        >>> provideAdapter(KeyReferenceStub,
+        ...                adapts=(SectionStub, ),
+        ...                provides=IKeyReference)
+        >>> provideAdapter(lambda section: journal,
+        ...                adapts=(SectionStub, ),
+        ...                provides=ISectionJournalData)
+
+        >>> class CalendarStub(list):
+        ...     __parent__ = section
+        >>> class MeetingStub(object):
+        ...     __parent__ = CalendarStub()
+        ...     meeting_id = None
+        ...     unique_id = 'm1'
+        ...     dtstart = datetime.datetime(2011, 5, 5)
+
+        >>> class PersonStub(object):
+        ...     intid = 1
+        >>> provideAdapter(stubbedGetEvaluations,
+        ...                adapts=(PersonStub, ),
+        ...                provides=IEvaluations)
+        >>> john = PersonStub()
+
+    Evaluations written outside of the journal are indexed in the
+    journal of the section they grade:
+
+        >>> requirement = GradeRequirement(MeetingStub())
+        >>> score_system = requirement.score_system
+        >>> previous, evaluation = storeEvaluation(
+        ...     john, requirement, score_system, score_system.fromUnicode('5'),
+        ...     evaluator='teacher')
+        >>> print previous, evaluation.value
+        None 5
+        >>> journal.hasEvaluation(john, requirement)
+        True
+        >>> [r.date for r, s in journal.getStudentEvaluations(john)]
+        [datetime.date(2011, 5, 5)]
+
+    Unchanged scores are not written:
+
+        >>> print storeEvaluation(john, requirement, score_system,
+        ...                       evaluation.value, evaluator='teacher')
+        None
+
+    """
+
+
+def doctest_SectionJournalData_compact_attendance():
+    """Tests for compact attendance storage of SectionJournalData
+
+        >>> from schooltool.lyceum.journal.journal import SectionJournalData
+        >>> from schooltool.lyceum.journal.journal import AttendanceRequirement
+        >>> journal = SectionJournalData()
+
+        >>> class SectionStub(object):
+        ...     pass
+        >>> section = SectionStub()
+        >>> provideAdapter(KeyReferenceStub,
+        ...                adapts=(SectionStub, ),
+        ...                provides=IKeyReference)
+
+        >>> class CalendarStub(list):
+        ...     __parent__ = section
+        >>> calendar = CalendarStub()
+
+        >>> class MeetingStub(object):
+        ...     __parent__ = calendar
+        ...     meeting_id = None
+        ...     def __init__(self, uid, date):
+        ...         self.dtstart = datetime.datetime(
+        ...             date.year, date.month, date.day)
+        ...         self.unique_id = uid
+
+        >>> class PersonStub(object):
+        ...     def __init__(self, name, intid):
+        ...         self.__name__ = name
+        ...         self.intid = intid
+
+        >>> provideAdapter(stubbedGetEvaluations,
+        ...                adapts=(PersonStub, ),
+        ...                provides=IEvaluations)
+
+        >>> john = PersonStub('john', 1)
+        >>> pete = PersonStub('pete', 2)
+        >>> m1 = MeetingStub('m1', datetime.date(2011, 5, 5))
+        >>> m2 = MeetingStub('m2', datetime.date(2011, 6, 6))
+
+    An absence recorded before compact storage was enabled:
+
+        >>> journal.setAbsence(john, m1, value='a')
+
+        >>> journal.enableCompactAttendance()
+
+    New marks are kept in a bucket per month, not in evaluations of
+    students:
+
+        >>> journal.setAbsence(pete, m1, value='t', evaluator='teacher')
+        >>> journal.setAbsence(pete, m2, value='ae')
+        >>> AttendanceRequirement(m1) in IEvaluations(pete)
+        False
+        >>> sorted(journal._attendance.buckets.keys())
+        [(2011, 5), (2011, 6)]
+
+        >>> journal.getAbsence(pete, m1)
+        't'
+        >>> journal.isTardy(pete, m1)
+        True
+        >>> score = journal.getEvaluation(pete, AttendanceRequirement(m1))
+        >>> score.evaluator
+        'teacher'
+
+    Old marks are still found:
+
+        >>> journal.getAbsence(john, m1)
+        'a'
+
+        >>> matrix = journal.getEvaluationMatrix(
+        ...     [john, pete], [m1, m2], AttendanceRequirement, default='')
+        >>> for row in matrix:
+        ...     print [getattr(score, 'value', score) for score in row]
+        ['a', '']
+        ['t', 'ae']
+
+    Cleared marks stay cleared:
+
+        >>> journal.setAbsence(john, m1, value='')
+        >>> from schooltool.requirement.scoresystem import UNSCORED
+        >>> score = journal.getEvaluation(john, AttendanceRequirement(m1))
+        >>> score.value is UNSCORED
+        True
+        >>> journal.isAbsent(john, m1)
+        False
+
+    Changed marks are kept in history, with the mark john had before
+    compact storage was enabled:
+
+        >>> journal.setAbsence(pete, m1, value='p')
+        >>> def printHistory(person, meeting):
+        ...     requirement = AttendanceRequirement(meeting)
+        ...     for score in journal.getHistory(person, requirement):
+        ...         print score.value, score.evaluator
+        >>> printHistory(pete, m1)
+        t teacher
+        >>> printHistory(john, m1)
+        a None
+        >>> printHistory(pete, m2)
+
+    Compact storage is enabled for attendance marks when it is turned
+    on in journal preferences:
+
+        >>> from schooltool.app.interfaces import ISchoolToolApplication
+        >>> from schooltool.lyceum.journal.journal import ScoreSystemPreferences
+        >>> prefs = ScoreSystemPreferences()
+        >>> app = {'schooltool.lyceum.journal-ss-prefs': prefs}
+        >>> provideAdapter(lambda context: app, adapts=[None],
+        ...                provides=ISchoolToolApplication)
+
+        >>> other = SectionJournalData()
+        >>> other.setAbsence(pete, m2, value='a')
+        >>> print other._attendance
+        None
+
+        >>> prefs.compact_attendance = True
+        >>> other.setAbsence(pete, m2, value='t')
+        >>> other._attendance
+        <schooltool.lyceum.journal.attendance.AttendanceStorage object at ...>
+        >>> other.getAbsence(pete, m2)
+        't'
+        >>> [score.value for score in other.getHistory(
+        ...     pete, AttendanceRequirement(m2))]
+        ['a']
+
+    """
+
+
+def doctest_AttendanceBucket_resolveConflict():
+    """Tests for AttendanceBucket._p_resolveConflict
+
+        >>> from schooltool.lyceum.journal.attendance import AttendanceBucket
+
+        >>> def makeState(marks):
+        ...     bucket = AttendanceBucket()
+        ...     for student_id, meeting_key, value, evaluator in marks:
+        ...         bucket.set(student_id, meeting_key, 'ss', value,
+        ...                    evaluator=evaluator,
+        ...                    time=datetime.datetime(2011, 5, 5))
+        ...     return bucket.__getstate__()
+
+        >>> marks = [(1, 'm1', 'a', 'teacher')]
+        >>> old = makeState(marks)
+        >>> saved = makeState(marks + [(1, 'm2', 't', 'teacher')])
+        >>> new = makeState(marks + [(2, 'm1', 'e', 'clerk'),
+        ...                          (1, 'm1', 'p', 'clerk')])
+
+    Marks of different cells changed concurrently are merged:
+
+        >>> bucket = AttendanceBucket()
+        >>> bucket.__setstate__(bucket._p_resolveConflict(old, saved, new))
+        >>> for student_id, meeting_key in [(1, 'm1'), (1, 'm2'), (2, 'm1'),
+        ...                                 (2, 'm2')]:
+        ...     mark = bucket.get(student_id, meeting_key)
+        ...     print student_id, meeting_key, mark and mark[1:3]
+        1 m1 ('p', 'clerk')
+        1 m2 ('t', 'teacher')
+        2 m1 ('e', 'clerk')
+        2 m2 None
+
+    Changed marks of both transactions are kept in history:
+
+        >>> for student_id, meeting_key in [(1, 'm1'), (1, 'm2')]:
+        ...     print student_id, meeting_key, [
+        ...         mark[1:3] for mark in bucket.getHistory(student_id,
+        ...                                                  meeting_key)]
+        1 m1 [('a', 'teacher')]
+        1 m2 []
+
+        >>> saved = makeState(marks + [(1, 'm1', 'e', 'teacher')])
+        >>> new = makeState(marks + [(1, 'm2', 'p', 'clerk'),
+        ...                          (1, 'm2', 't', 'clerk')])
+        >>> bucket.__setstate__(bucket._p_resolveConflict(old, saved, new))
+        >>> for student_id, meeting_key in [(1, 'm1'), (1, 'm2')]:
+        ...     print student_id, meeting_key, [
+        ...         mark[1:3] for mark in bucket.getHistory(student_id,
+        ...                                                  meeting_key)]
+        1 m1 [('a', 'teacher')]
+        1 m2 [('p', 'clerk')]
+
+    Changes of the same mark are a conflict:
+
+        >>> new = makeState(marks + [(1, 'm2', 'p', 'clerk')])
+        >>> bucket._p_resolveConflict(old, saved, new)
+        Traceback (most recent call last):
+          ...
+        ConflictError: database conflict error
+
+    """
+
+
 def doctest_getSectionJournalData():
     """Tests for getSectionJournalData
 
@@ -197,6 +818,19 @@ def doctest_getSectionJournalData():
         >>> journal.__name__ == str(id(section))
         True
 
+    Reading the journal does not store it, nor does it create index
+    trees:
+
+        >>> len(journal_container)
+        0
+        >>> print journal._student_index, journal._meeting_index
+        None None
+
+    It gets stored when something is written to it:
+
+        >>> journal.getStoredJournal() is journal
+        True
+
         >>> journal_container[str(id(section))] is journal
         True
 
@@ -209,6 +843,1128 @@ def doctest_getSectionJournalData():
     """
 
 
+def doctest_AttendanceScoreSystem():
+    """Tests for AttendanceScoreSystem
+
+        >>> from schooltool.lyceum.journal.journal import AttendanceScoreSystem
+        >>> from schooltool.requirement.evaluation import Score
+        >>> ss = AttendanceScoreSystem('Attendance')
+
+    Scores are looked up case insensitively:
+
+        >>> ss.isValidScore('AE')
+        True
+        >>> ss.isValidScore('x')
+        False
+        >>> ss.fromUnicode('Te')
+        'te'
+        >>> from schooltool.requirement.scoresystem import ScoreValidationError
+        >>> try:
+        ...     ss.fromUnicode('x')
+        ... except ScoreValidationError:
+        ...     print 'invalid'
+        invalid
+
+        >>> ss.isAbsent(Score(ss, 'ae')), ss.isExcused(Score(ss, 'ae'))
+        (True, True)
+        >>> ss.isTardy(Score(ss, 'a'))
+        False
+
+    Many values can be classified at once:
+
+        >>> from schooltool.lyceum.journal.journal import ABSENT_FLAG
+        >>> from schooltool.lyceum.journal.journal import TARDY_FLAG
+        >>> from schooltool.lyceum.journal.journal import EXCUSED_FLAG
+        >>> ss.classifyMany(['a', 'te', 'x']) == [
+        ...     ABSENT_FLAG, TARDY_FLAG | EXCUSED_FLAG, 0]
+        True
+
+    Lookup tables are rebuilt when scores change:
+
+        >>> ss.scores = (('p', 'Present'), ('l', 'Late'))
+        >>> ss.tag_tardy = ('l', )
+        >>> ss.isValidScore('a')
+        False
+        >>> ss.isTardy(Score(ss, 'l'))
+        True
+        >>> sorted(ss.scoresDict.items())
+        [('l', 'Late'), ('p', 'Present')]
+
+    """
+
+
+def doctest_JournalPreferences():
+    """Tests for JournalPreferences
+
+        >>> from schooltool.lyceum.journal.journal import JournalPreferences
+        >>> prefs = JournalPreferences()
+        >>> print prefs.get('mode')
+        None
+
+        >>> prefs.set('mode', 'grades')
+        >>> prefs.get('mode')
+        'grades'
+
+    Concurrent changes of different preferences are merged:
+
+        >>> old = {'values': {'mode': 'grades'}}
+        >>> saved = {'values': {'mode': 'grades', 'section': 'history'}}
+        >>> new = {'values': {'mode': 'attendance'}}
+        >>> state = prefs._p_resolveConflict(old, saved, new)
+        >>> sorted(state['values'].items())
+        [('mode', 'attendance'), ('section', 'history')]
+
+    """
+
+
+def doctest_JournalChanges():
+    """Tests for JournalChanges
+
+        >>> from schooltool.lyceum.journal.journal import JournalChanges
+        >>> from schooltool.lyceum.journal.journal import SectionJournalData
+
+        >>> journal = SectionJournalData()
+        >>> journal.getChangeStamp()
+        (0, None)
+
+        >>> journal.noteChange()
+        >>> journal.noteChange()
+        >>> count, time = journal.getChangeStamp()
+        >>> count, isinstance(time, datetime.datetime)
+        (2, True)
+
+    Concurrent changes are merged by adding up their increments, the
+    time of the latest one is kept:
+
+        >>> changes = JournalChanges()
+        >>> old = {'count': 2, 'time': datetime.datetime(2011, 5, 5, 10)}
+        >>> saved = {'count': 3, 'time': datetime.datetime(2011, 5, 5, 12)}
+        >>> new = {'count': 4, 'time': datetime.datetime(2011, 5, 5, 11)}
+        >>> state = changes._p_resolveConflict(old, saved, new)
+        >>> state['count'], state['time']
+        (5, datetime.datetime(2011, 5, 5, 12, 0))
+
+    """
+
+
+def doctest_EvaluationLog_countAttendance():
+    """Tests for EvaluationLog.countAttendance
+
+        >>> from schooltool.requirement.scoresystem import UNSCORED
+        >>> from schooltool.lyceum.journal.journal import AbsenceScoreSystem
+        >>> from schooltool.lyceum.journal.journal import HomeroomLog
+        >>> from schooltool.lyceum.journal.journal import AttendanceRollup
+        >>> from schooltool.lyceum.journal.journal import DailyAttendance
+
+        >>> class RequirementStub(object):
+        ...     def __init__(self, requirement_type, day, period=None):
+        ...         self.requirement_type = requirement_type
+        ...         self.date = datetime.date(2011, 5, day)
+        ...         self.period = period
+        >>> class ScoreStub(object):
+        ...     scoreSystem = AbsenceScoreSystem
+        ...     def __init__(self, value):
+        ...         self.value = value
+
+    Logs count marks in the period of their meetings, which section
+    journals look up in the calendar:
+
+        >>> class LogStub(HomeroomLog):
+        ...     def getPeriod(self, requirement):
+        ...         return requirement.period
+
+        >>> log = LogStub()
+        >>> log.getAttendanceRollups(None, None)
+        []
+
+        >>> first = (datetime.time(8, 0), '1')
+        >>> second = (datetime.time(9, 0), '2')
+        >>> homeroom = RequirementStub('homeroom', 5)
+        >>> period = RequirementStub('attendance', 5, first)
+        >>> log.countAttendance(homeroom, 101, None, AbsenceScoreSystem, 'a')
+        >>> log.countAttendance(period, 101, None, AbsenceScoreSystem, 'ae')
+        >>> log.countAttendance(period, 102, None, AbsenceScoreSystem, 't')
+        >>> log.countAttendance(RequirementStub('attendance', 5, second),
+        ...                     102, None, AbsenceScoreSystem, 't')
+        >>> log.countAttendance(RequirementStub('attendance', 6, first),
+        ...                     102, None, AbsenceScoreSystem, 't')
+
+        >>> [date for date, rollup in log.getAttendanceRollups(None, None)]
+        [datetime.date(2011, 5, 5), datetime.date(2011, 5, 6)]
+
+    Rollups of many logs are merged into sets of students per day, by
+    requirement type, period and tag:
+
+        >>> def getDay(*logs):
+        ...     day = DailyAttendance()
+        ...     for log in logs:
+        ...         for date, rollup in log.getAttendanceRollups(
+        ...             datetime.date(2011, 5, 5), datetime.date(2011, 5, 5)):
+        ...             day.add(rollup)
+        ...     return day
+
+        >>> day = getDay(log)
+        >>> day.count('attendance', 'absent'), day.count('attendance', 'tardy')
+        (1, 1)
+        >>> day.count('homeroom', 'absent'), day.count('attendance', 'excused')
+        (1, 1)
+        >>> list(day.getStudentIds())
+        [101, 102]
+        >>> day.getPeriods('attendance') == [first, second]
+        True
+        >>> day.count('attendance', 'tardy', first)
+        1
+        >>> list(day.getStudentIds('attendance', 'tardy', second))
+        [102]
+
+        >>> other = LogStub()
+        >>> other.countAttendance(RequirementStub('attendance', 5), 103, None,
+        ...                       AbsenceScoreSystem, 'a')
+        >>> day = getDay(log, other)
+        >>> day.count('attendance', 'absent')
+        2
+        >>> day.getPeriods('attendance') == [first, second, None]
+        True
+
+    A student absent in several meetings of a period is counted once:
+
+        >>> log.countAttendance(period, 101, None, AbsenceScoreSystem, 'a')
+        >>> getDay(log).count('attendance', 'absent')
+        1
+        >>> log.countAttendance(period, 101, ScoreStub('a'),
+        ...                     AbsenceScoreSystem, UNSCORED)
+        >>> getDay(log).count('attendance', 'absent')
+        1
+
+    Changed and cleared marks take back their previous counts:
+
+        >>> log.countAttendance(period, 102, ScoreStub('t'),
+        ...                     AbsenceScoreSystem, 'a')
+        >>> log.countAttendance(homeroom, 101, ScoreStub('a'),
+        ...                     AbsenceScoreSystem, UNSCORED)
+        >>> day = getDay(log)
+        >>> day.count('attendance', 'absent'), day.count('attendance', 'tardy')
+        (2, 1)
+        >>> day.count('attendance', 'tardy', first)
+        0
+        >>> list(day.getStudentIds('homeroom'))
+        []
+
+    Concurrent changes are merged by adding up their increments:
+
+        >>> key = ('homeroom', None, 'absent', 101)
+        >>> other_key = ('homeroom', None, 'absent', 102)
+        >>> old = {'students': {key: 1}}
+        >>> saved = {'students': {key: 2, other_key: 1}}
+        >>> new = {'students': {}}
+        >>> state = AttendanceRollup()._p_resolveConflict(old, saved, new)
+        >>> sorted(state['students'].items())
+        [(('homeroom', None, 'absent', 101), 1),
+         (('homeroom', None, 'absent', 102), 1)]
+
+    """
+
+
+def doctest_EvaluationLog_indexChange():
+    """Tests for EvaluationLog.indexChange
+
+        >>> from schooltool.lyceum.journal.journal import HomeroomLog
+
+        >>> log = HomeroomLog()
+        >>> log.getChanges(datetime.datetime(2011, 5, 1))
+        set([])
+
+        >>> log.indexChange(('grade', 1), 101, datetime.datetime(2011, 5, 5))
+        >>> log.indexChange(('grade', 2), 101, datetime.datetime(2011, 5, 6))
+        >>> log.indexChange(('grade', 1), 102, datetime.datetime(2011, 5, 7))
+
+    Changes after a time are returned:
+
+        >>> sorted(log.getChanges(datetime.datetime(2011, 5, 5)))
+        [(101, ('grade', 2)), (102, ('grade', 1))]
+
+    Only the last change of an evaluation is kept:
+
+        >>> log.indexChange(('grade', 1), 101, datetime.datetime(2011, 5, 8))
+        >>> log.indexChange(('grade', 2), 101, datetime.datetime(2011, 5, 1))
+        >>> sorted(log.getChanges(datetime.datetime(2011, 5, 6, 12)))
+        [(101, ('grade', 1)), (102, ('grade', 1))]
+
+    Evaluations are kept in sets of the day of their last change:
+
+        >>> for day, changes in log._change_days.items():
+        ...     print day, list(changes)
+        2011-05-05 []
+        2011-05-06 [(101, ('grade', 2))]
+        2011-05-07 [(102, ('grade', 1))]
+        2011-05-08 [(101, ('grade', 1))]
+        >>> len(log._change_times)
+        3
+
+    Changes later in a day are found too:
+
+        >>> log.indexChange(('grade', 3), 103,
+        ...                 datetime.datetime(2011, 5, 8, 10))
+        >>> sorted(log.getChanges(datetime.datetime(2011, 5, 8, 9)))
+        [(103, ('grade', 3))]
+
+    Changes of old days can be pruned, whole days at a time:
+
+        >>> log.pruneChanges(datetime.datetime(2011, 5, 7, 15))
+        >>> list(log._change_days.keys())
+        [datetime.date(2011, 5, 7), datetime.date(2011, 5, 8)]
+        >>> sorted(log._change_times.keys())
+        [(101, ('grade', 1)), (102, ('grade', 1)), (103, ('grade', 3))]
+
+    """
+
+
+def doctest_LyceumJournalContainer_changes():
+    """Tests for changes logged in LyceumJournalContainer
+
+        >>> from schooltool.lyceum.journal.journal import LyceumJournalContainer
+        >>> from schooltool.lyceum.journal.journal import SectionJournalData
+
+        >>> jc = LyceumJournalContainer()
+        >>> jc.getChangeStamp()
+        (0, None)
+
+    Changes of evaluations not kept in journals are spread over
+    homeroom logs by student int id:
+
+        >>> jc.noteChange(101)
+        >>> jc.noteChange(133)
+        >>> jc.getHomeroomLog(101) is jc.getHomeroomLog(133)
+        True
+        >>> jc.getHomeroomLog(101) is jc.getHomeroomLog(102)
+        False
+        >>> jc.noteChange(102)
+        >>> count, time = jc.getChangeStamp()
+        >>> count, isinstance(time, datetime.datetime)
+        (3, True)
+
+    Changed evaluations are found in journals of sections and in
+    homeroom logs:
+
+        >>> class SectionStub(object):
+        ...     def __init__(self, intid):
+        ...         self.intid = intid
+        >>> jc['5'] = SectionJournalData()
+        >>> jc['6'] = SectionJournalData()
+        >>> jc['5'].indexChange(('grade', 1), 101, datetime.datetime(2011, 5, 5))
+        >>> jc['6'].indexChange(('grade', 2), 101, datetime.datetime(2011, 5, 5))
+        >>> jc.getHomeroomLog(102).indexChange(
+        ...     ('homeroom', 1), 102, datetime.datetime(2011, 5, 5))
+
+        >>> sorted(jc.getChanges(datetime.datetime(2011, 5, 1)))
+        [(101, ('grade', 1)), (101, ('grade', 2)), (102, ('homeroom', 1))]
+        >>> sorted(jc.getChanges(datetime.datetime(2011, 5, 1),
+        ...                      sections=[SectionStub(5), SectionStub(7)]))
+        [(101, ('grade', 1)), (102, ('homeroom', 1))]
+
+    Pruning drops changes of all logs:
+
+        >>> jc.pruneChanges(datetime.datetime(2011, 5, 7, 15))
+        >>> sorted(jc.getChanges(datetime.datetime(2011, 5, 1)))
+        []
+        >>> jc.changes_pruned
+        datetime.datetime(2011, 5, 7, 0, 0)
+
+    Pruning earlier days does not move the time back:
+
+        >>> jc.pruneChanges(datetime.datetime(2011, 5, 1))
+        >>> jc.changes_pruned
+        datetime.datetime(2011, 5, 7, 0, 0)
+
+    """
+
+
+def doctest_getSectionMemberNames():
+    """Tests for getSectionMemberNames
+
+        >>> from schooltool.lyceum.journal.journal import getSectionMemberNames
+        >>> from schooltool.lyceum.journal.journal import LyceumJournalContainer
+
+        >>> journal_container = LyceumJournalContainer()
+        >>> class STAppStub(dict):
+        ...     def __init__(self, context):
+        ...         self['schooltool.lyceum.journal'] = journal_container
+        >>> from schooltool.app.interfaces import ISchoolToolApplication
+        >>> provideAdapter(STAppStub, adapts=[None], provides=ISchoolToolApplication)
+
+        >>> class PersonStub(object):
+        ...     def __init__(self, username):
+        ...         self.username = username
+
+        >>> class MembersStub(list):
+        ...     def all(self):
+        ...         print 'Walking members'
+        ...         return self
+
+        >>> from schooltool.course.interfaces import ISection
+        >>> class SectionStub(object):
+        ...     implements(ISection)
+        ...     intid = 5
+        ...     members = MembersStub([PersonStub('john'), PersonStub('pete')])
+        >>> section = SectionStub()
+
+        >>> sorted(getSectionMemberNames(section))
+        Walking members
+        ['john', 'pete']
+
+    Members are cached until they change:
+
+        >>> sorted(getSectionMemberNames(section))
+        ['john', 'pete']
+
+        >>> journal_container.getMembersStamp(5)
+        (0, None)
+        >>> journal_container.noteMembersChange(5)
+        >>> journal_container.getMembersStamp(5)
+        (1, datetime.datetime(...))
+
+        >>> sorted(getSectionMemberNames(section))
+        Walking members
+        ['john', 'pete']
+
+    Changes of enrollment and changes of members count as changes of
+    members of their sections, journals are not created for them:
+
+        >>> from schooltool.lyceum.journal.journal import noteEnrollmentChange
+        >>> from schooltool.lyceum.journal.journal import notePersonChange
+        >>> from schooltool.app.membership import URIMembership
+        >>> ann = PersonStub('ann')
+        >>> ann.groups = [object(), section]
+        >>> class EventStub(object):
+        ...     rel_type = URIMembership
+        ...     participant1 = ann
+        ...     participant2 = section
+        >>> section.members.append(ann)
+        >>> noteEnrollmentChange(EventStub())
+        >>> journal_container.getMembersStamp(5)[0]
+        2
+        >>> sorted(getSectionMemberNames(section))
+        Walking members
+        ['ann', 'john', 'pete']
+
+        >>> notePersonChange(ann, None)
+        >>> journal_container.getMembersStamp(5)[0]
+        3
+        >>> list(journal_container.keys())
+        []
+
+    """
+
+
+def doctest_getStudentIndex():
+    """Tests for getStudentIndex
+
+        >>> from schooltool.lyceum.journal.journal import getStudentIndex
+        >>> from schooltool.lyceum.journal.journal import noteEnrollmentChange
+        >>> from schooltool.lyceum.journal.journal import LyceumJournalContainer
+
+        >>> journal_container = LyceumJournalContainer()
+        >>> class STAppStub(dict):
+        ...     def __init__(self, context):
+        ...         self['schooltool.lyceum.journal'] = journal_container
+        >>> from schooltool.app.interfaces import ISchoolToolApplication
+        >>> provideAdapter(STAppStub, adapts=[None], provides=ISchoolToolApplication)
+
+        >>> class PersonStub(object):
+        ...     def __init__(self, intid):
+        ...         self.intid = intid
+
+        >>> class MembersStub(list):
+        ...     def all(self):
+        ...         print 'Walking members'
+        ...         return self
+
+        >>> class GroupStub(object):
+        ...     def __init__(self, intid, *ids):
+        ...         self.intid = intid
+        ...         self.members = MembersStub(map(PersonStub, ids))
+
+        >>> from schooltool.course.interfaces import ISectionContainer
+        >>> class TermStub(object):
+        ...     def __init__(self, intid, *sections):
+        ...         self.intid = intid
+        ...         self.sections = dict(enumerate(sections))
+        ...     def __conform__(self, iface):
+        ...         if iface == ISectionContainer:
+        ...             return self.sections
+
+        >>> term = TermStub(1, GroupStub(10, 101, 102), GroupStub(11, 102, 103))
+        >>> group = GroupStub(20, 102, 104)
+
+    Students of all sections of a term and members of groups are
+    collected into sets of int ids:
+
+        >>> index = getStudentIndex()
+        >>> list(index.termStudents(term))
+        Walking members
+        Walking members
+        [101, 102, 103]
+
+        >>> list(index.groupStudents(group))
+        Walking members
+        [102, 104]
+
+    The sets are cached:
+
+        >>> getStudentIndex() is index
+        True
+        >>> list(index.termStudents(term))
+        [101, 102, 103]
+
+    Instructors of sections with members are indexed per term, in
+    the order of the collator:
+
+        >>> class InstructorStub(object):
+        ...     def __init__(self, intid, title):
+        ...         self.intid = intid
+        ...         self.title = title
+        ...     def __repr__(self):
+        ...         return '<Instructor %s>' % self.title
+        >>> class CollatorStub(object):
+        ...     def personKey(self, person):
+        ...         print 'Sorting', person.title
+        ...         return person.title
+        >>> collator = CollatorStub()
+
+        >>> smith, adams = InstructorStub(31, 'Smith'), InstructorStub(32, 'Adams')
+        >>> math, art, empty = (GroupStub(12, 106), GroupStub(13, 107, 108),
+        ...                     GroupStub(14))
+        >>> math.instructors = [smith]
+        >>> art.instructors = [smith, adams]
+        >>> empty.instructors = [InstructorStub(33, 'Jones')]
+        >>> term2 = TermStub(2, math, art, empty)
+
+        >>> index.termInstructors(term2, collator)
+        Walking members
+        Walking members
+        Walking members
+        Sorting ...
+        Sorting ...
+        [<Instructor Adams>, <Instructor Smith>]
+        >>> index.termInstructors(term2, collator)
+        [<Instructor Adams>, <Instructor Smith>]
+
+        >>> list(index.instructorStudents(smith, term2))
+        Walking members
+        Walking members
+        [106, 107, 108]
+        >>> list(index.instructorStudents(adams, term2))
+        Walking members
+        [107, 108]
+
+    Changes of membership or instruction replace the index:
+
+        >>> from schooltool.app.membership import URIMembership
+        >>> class EventStub(object):
+        ...     rel_type = URIMembership
+        ...     participant1 = group
+        ...     participant2 = PersonStub(105)
+        >>> group.members.append(PersonStub(105))
+        >>> noteEnrollmentChange(EventStub())
+        >>> journal_container.getMembershipsVersion()
+        1
+
+        >>> index = getStudentIndex()
+        >>> list(index.groupStudents(group))
+        Walking members
+        [102, 104, 105]
+
+    Other relationships are ignored:
+
+        >>> EventStub.rel_type = 'http://example.com/other'
+        >>> noteEnrollmentChange(EventStub())
+        >>> getStudentIndex() is index
+        True
+
+    """
+
+
+def doctest_getMeetingIndex():
+    """Tests for getMeetingIndex
+
+        >>> import pytz
+        >>> from schooltool.lyceum.journal.journal import getMeetingIndex
+        >>> from schooltool.lyceum.journal.journal import invalidateMeetingIndexes
+        >>> from schooltool.lyceum.journal.journal import LyceumJournalContainer
+
+        >>> journal_container = LyceumJournalContainer()
+        >>> class STAppStub(dict):
+        ...     def __init__(self, context):
+        ...         self['schooltool.lyceum.journal'] = journal_container
+
+        >>> from schooltool.app.interfaces import ISchoolToolApplication
+        >>> provideAdapter(STAppStub, adapts=[None], provides=ISchoolToolApplication)
+
+        >>> class MeetingStub(object):
+        ...     def __init__(self, unique_id, dtstart, meeting_id=None):
+        ...         self.unique_id = unique_id
+        ...         self.dtstart = dtstart
+        ...         self.meeting_id = meeting_id or unique_id
+        ...     def __cmp__(self, other):
+        ...         return cmp(self.dtstart, other.dtstart)
+        ...     def __repr__(self):
+        ...         return '<Meeting %s>' % self.unique_id
+
+        >>> def dt(*args):
+        ...     return datetime.datetime(*args, tzinfo=pytz.utc)
+
+        >>> calendar = [
+        ...     MeetingStub('m3', dt(2011, 6, 1, 9)),
+        ...     MeetingStub('m1', dt(2011, 5, 4, 23)),
+        ...     MeetingStub('m2a', dt(2011, 5, 6, 9), meeting_id='double'),
+        ...     MeetingStub('m2b', dt(2011, 5, 6, 10), meeting_id='double'),
+        ...     ]
+
+        >>> from schooltool.term.interfaces import ITerm
+        >>> class TermStub(object):
+        ...     intid = 4
+        ...     first = datetime.date(2011, 5, 5)
+        ...     last = datetime.date(2011, 5, 31)
+        >>> term = TermStub()
+
+        >>> class SectionStub(object):
+        ...     def __init__(self, intid):
+        ...         self.intid = intid
+        ...     def __conform__(self, iface):
+        ...         if iface == ISchoolToolCalendar:
+        ...             calendar_walks.append(self.intid)
+        ...             return calendar
+        ...         if iface == ITerm:
+        ...             return term
+        >>> section = SectionStub(5)
+        >>> calendar_walks = []
+
+    The index keeps unique meetings of the section in order, with their
+    starts in the given timezone:
+
+        >>> vilnius = pytz.timezone('Europe/Vilnius')
+        >>> index = getMeetingIndex(section, vilnius)
+        >>> index.meetings
+        [<Meeting m1>, <Meeting m2a>, <Meeting m3>]
+
+        >>> index.localDate(index.meetings[0])
+        datetime.date(2011, 5, 5)
+
+        >>> index.getMonths(index.meetings)
+        [(2011, 5), (2011, 6)]
+
+        >>> index.getTermMeetings(term)
+        [<Meeting m1>, <Meeting m2a>]
+
+    The index is cached, the calendar is walked only once:
+
+        >>> getMeetingIndex(section, vilnius) is index
+        True
+        >>> calendar_walks
+        [5]
+
+    Changes of schedules or calendars invalidate the index of their
+    section only:
+
+        >>> from zope.interface import directlyProvides
+        >>> directlyProvides(section, ISection)
+        >>> other_section = SectionStub(6)
+        >>> other_index = getMeetingIndex(other_section, vilnius)
+
+        >>> class CalendarEventStub(object):
+        ...     __parent__ = None
+        >>> event = CalendarEventStub()
+        >>> event.__parent__ = CalendarEventStub()
+        >>> event.__parent__.__parent__ = section
+
+        >>> calendar.append(MeetingStub('m4', dt(2011, 6, 2, 9)))
+        >>> invalidateMeetingIndexes(event, None)
+        >>> journal_container.getMeetingsStamp((5, 6))
+        (1, 0)
+
+        >>> index = getMeetingIndex(section, vilnius)
+        >>> index.meetings
+        [<Meeting m1>, <Meeting m2a>, <Meeting m3>, <Meeting m4>]
+        >>> getMeetingIndex(other_section, vilnius) is other_index
+        True
+        >>> calendar_walks
+        [5, 6, 5]
+
+    Changes of the term invalidate indexes of all its sections:
+
+        >>> directlyProvides(term, ITerm)
+        >>> invalidateMeetingIndexes(term, None)
+        >>> getMeetingIndex(section, vilnius) is index
+        False
+        >>> getMeetingIndex(other_section, vilnius) is other_index
+        False
+
+    Changes of objects that do not belong to sections or terms are
+    ignored:
+
+        >>> invalidateMeetingIndexes(CalendarEventStub(), None)
+        >>> journal_container.getMeetingsStamp((4, 5, 6))
+        (1, 1, 0)
+
+    The index is rebuilt for a different timezone too:
+
+        >>> getMeetingIndex(section, pytz.utc).localDate(index.meetings[0])
+        datetime.date(2011, 5, 4)
+
+    """
+
+
+def doctest_getSchoolDayCalendar():
+    """Tests for getSchoolDayCalendar
+
+        >>> import pytz
+        >>> from schooltool.lyceum.journal.journal import getSchoolDayCalendar
+        >>> from schooltool.lyceum.journal.journal import invalidateMeetingIndexes
+        >>> from schooltool.lyceum.journal.journal import LyceumJournalContainer
+
+        >>> journal_container = LyceumJournalContainer()
+        >>> class STAppStub(dict):
+        ...     def __init__(self, context):
+        ...         self['schooltool.lyceum.journal'] = journal_container
+        >>> from schooltool.app.interfaces import ISchoolToolApplication
+        >>> provideAdapter(STAppStub, adapts=[None], provides=ISchoolToolApplication)
+
+        >>> class TermStub(object):
+        ...     intid = 1
+        ...     first = datetime.date(2011, 9, 1)
+        ...     last = datetime.date(2011, 12, 23)
+        ...     def __contains__(self, date):
+        ...         return self.first <= date <= self.last
+        ...     def isSchoolday(self, date):
+        ...         lookups.append(date)
+        ...         return date.weekday() < 5
+        >>> term = TermStub()
+        >>> lookups = []
+
+    School days of the month get a synthetic meeting each:
+
+        >>> tz = pytz.timezone('Europe/Vilnius')
+        >>> days = getSchoolDayCalendar([term], 2011, 12, tz)
+        >>> days.days
+        [datetime.date(2011, 12, 1), datetime.date(2011, 12, 2),
+         datetime.date(2011, 12, 5), ...
+         datetime.date(2011, 12, 22), datetime.date(2011, 12, 23)]
+        >>> [meeting.unique_id for meeting in days.meetings[:2]]
+        ['2011-12-01T00:00:00+02:00', '2011-12-02T00:00:00+02:00']
+        >>> len(lookups)
+        23
+
+    The calendar is cached:
+
+        >>> getSchoolDayCalendar([term], 2011, 12, tz) is days
+        True
+        >>> len(lookups)
+        23
+
+    Changes of terms invalidate it:
+
+        >>> from zope.interface import directlyProvides
+        >>> from schooltool.term.interfaces import ITerm
+        >>> directlyProvides(term, ITerm)
+        >>> invalidateMeetingIndexes(term, None)
+        >>> getSchoolDayCalendar([term], 2011, 12, tz) is days
+        False
+        >>> len(lookups)
+        46
+
+    """
+
+
+def doctest_JournalExportEngine():
+    """Tests for JournalExportEngine
+
+        >>> import pytz
+        >>> from schooltool.requirement.scoresystem import UNSCORED
+        >>> from schooltool.lyceum.journal.dataexport import JournalExportEngine
+        >>> from schooltool.lyceum.journal.dataexport import JournalSheet
+
+        >>> from schooltool.basicperson.interfaces import IDemographics
+        >>> class PersonStub(object):
+        ...     def __init__(self, name, student_id):
+        ...         self.__name__ = name
+        ...         self.first_name = name.capitalize()
+        ...         self.last_name = 'Doe'
+        ...         self.demographics = {'ID': student_id}
+        >>> lookups = []
+        >>> def getDemographics(person):
+        ...     lookups.append(person.__name__)
+        ...     return person.demographics
+        >>> provideAdapter(getDemographics, adapts=[PersonStub],
+        ...                provides=IDemographics)
+
+        >>> class ScoreStub(object):
+        ...     evaluator = 'teacher'
+        ...     time = None
+        ...     def __init__(self, value):
+        ...         self.value = value
+        >>> class JournalDataStub(object):
+        ...     def getEvaluationMatrix(self, persons, meetings, factory,
+        ...                             score_system=None, default=None):
+        ...         print 'Evaluations of', [p.__name__ for p in persons],
+        ...         print 'in', meetings
+        ...         return [[ScoreStub(p.__name__[0]), default, ScoreStub(UNSCORED)]
+        ...                 for p in persons]
+
+        >>> class MembersStub(list):
+        ...     def all(self):
+        ...         return self
+        >>> class SectionStub(object):
+        ...     __name__ = 'math'
+        ...     title = 'Math'
+        ...     members = MembersStub([PersonStub('pete', '2'),
+        ...                            PersonStub('ann', '1'),
+        ...                            PersonStub('john', '')])
+        ...     def __conform__(self, iface):
+        ...         if iface == ISectionJournalData:
+        ...             return JournalDataStub()
+        >>> section = SectionStub()
+
+        >>> class TermStub(object):
+        ...     __name__ = 'fall'
+        >>> engine = JournalExportEngine(TermStub(), pytz.utc)
+
+    Students are ordered by their IDs:
+
+        >>> [student.__name__ for student in engine.getStudents(section)]
+        ['john', 'ann', 'pete']
+
+    A sheet fetches evaluations of the whole section at once and
+    yields a row per student:
+
+        >>> sheet = JournalSheet(engine, section, 'scores', 'Scores', None,
+        ...                      None, ['m1', 'm2', 'm3'])
+        >>> for row in sheet.rows():
+        ...     print row
+        Evaluations of ['john', 'ann', 'pete'] in ['m1', 'm2', 'm3']
+        ('', 'John', 'Doe', ['j', None, None])
+        ('1', 'Ann', 'Doe', ['a', None, None])
+        ('2', 'Pete', 'Doe', ['p', None, None])
+
+    Demographics of each student are looked up only once:
+
+        >>> sorted(lookups)
+        ['ann', 'john', 'pete']
+
+    Records are yielded for evaluations only, skipping empty and
+    cleared cells:
+
+        >>> import datetime
+        >>> class MeetingStub(object):
+        ...     def __init__(self, meeting_id):
+        ...         self.meeting_id = meeting_id
+        >>> meetings = [MeetingStub(m) for m in ('m1', 'm2', 'm3')]
+        >>> sheet = JournalSheet(engine, section, 'scores', 'Scores', None,
+        ...                      None, meetings)
+        >>> sheet.activities = [
+        ...     {'date': datetime.date(2014, 9, day), 'period': 'A'}
+        ...     for day in (1, 2, 3)]
+        >>> for record in sheet.records():
+        ...     print sorted(record.items())
+        Evaluations of ['john', 'ann', 'pete'] in [...]
+        [('date', '2014-09-01'), ('evaluator', 'teacher'), ('kind', 'scores'),
+         ('meeting_id', 'm1'), ('period', 'A'), ('section', 'Math'),
+         ('section_id', 'math'), ('student', 'john'), ('student_id', ''),
+         ('term', 'fall'), ('time', None), ('value', u'j')]
+        [('date', '2014-09-01'), ('evaluator', 'teacher'), ('kind', 'scores'),
+         ('meeting_id', 'm1'), ('period', 'A'), ('section', 'Math'),
+         ('section_id', 'math'), ('student', 'ann'), ('student_id', '1'),
+         ('term', 'fall'), ('time', None), ('value', u'a')]
+        [('date', '2014-09-01'), ('evaluator', 'teacher'), ('kind', 'scores'),
+         ('meeting_id', 'm1'), ('period', 'A'), ('section', 'Math'),
+         ('section_id', 'math'), ('student', 'pete'), ('student_id', '2'),
+         ('term', 'fall'), ('time', None), ('value', u'p')]
+
+    Exports of changes since a time only have students with changed
+    evaluations, and records of cleared evaluations too:
+
+        >>> engine = JournalExportEngine(TermStub(), pytz.utc,
+        ...                              since=datetime.datetime(2014, 9, 2))
+        >>> engine.changes = set([('ann', 'r1'), ('pete', 'r3')])
+        >>> engine.getStudentIntId = lambda student: student.__name__
+        >>> sheet = JournalSheet(engine, section, 'scores', 'Scores', None,
+        ...                      None, meetings)
+        >>> sheet.activities = [
+        ...     {'date': datetime.date(2014, 9, day), 'period': 'A'}
+        ...     for day in (1, 2, 3)]
+        >>> sheet.requirement_keys = [('r1', ), ('r2', ), ('r3', )]
+
+        >>> for record in sheet.records():
+        ...     print record['student'], record['meeting_id'], record['value']
+        Evaluations of ['ann', 'pete'] in [...]
+        ann m1 a
+        pete m3 None
+
+    Rows mark cleared evaluations, so that they are not taken for cells
+    that did not change:
+
+        >>> for row in sheet.rows():
+        ...     print row
+        Evaluations of ['ann', 'pete'] in [...]
+        ('1', 'Ann', 'Doe', ['a', None, None])
+        ('2', 'Pete', 'Doe', ['p', None, CLEARED])
+
+    The mark is the same after being sent to another process:
+
+        >>> import cPickle
+        >>> from schooltool.lyceum.journal.dataexport import CLEARED
+        >>> cPickle.loads(cPickle.dumps(CLEARED, 2)) is CLEARED
+        True
+
+    """
+
+
+def doctest_ParallelJournalExport():
+    """Tests for ParallelJournalExport
+
+        >>> from schooltool.lyceum.journal.dataexport import ParallelJournalExport
+        >>> from schooltool.lyceum.journal.dataexport import getStorageOpener
+
+        >>> class EngineStub(object):
+        ...     term = object()
+        ...     sections = ['s%d' % n for n in range(10)]
+        ...     def getSheets(self, section):
+        ...         return ['%s sheet' % section]
+
+    Sections are split into a few shards per worker:
+
+        >>> sheets = ParallelJournalExport(EngineStub(), workers=2)
+        >>> [len(shard) for shard in sheets.getShards(EngineStub.sections)]
+        [1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+        >>> sheets.shards_per_worker = 1
+        >>> sheets.getShards(EngineStub.sections)
+        [['s0', 's1', 's2', 's3', 's4'], ['s5', 's6', 's7', 's8', 's9']]
+
+    With few sections sheets are built in this process:
+
+        >>> list(sheets)[:2]
+        [('s0', ['s0 sheet']), ('s1', ['s1 sheet'])]
+        >>> print sheets.fallback
+        None
+
+    So they are if the term is not stored in a database served by ZEO,
+    which is logged and kept:
+
+        >>> from zope.testing.loggingsupport import InstalledHandler
+        >>> handler = InstalledHandler('schooltool.lyceum.journal.dataexport')
+
+        >>> sheets.min_sections = 1
+        >>> print sheets.getOpener()
+        None
+        >>> len(list(sheets))
+        10
+        >>> sheets.fallback
+        u'The database is not served by ZEO'
+        >>> print handler
+        schooltool.lyceum.journal.dataexport WARNING
+          Journal export of 10 sections runs in one process: The database
+          is not served by ZEO
+
+        >>> from ZODB.FileStorage import FileStorage
+        >>> print getStorageOpener(object())
+        None
+        >>> print getStorageOpener(FileStorage.__new__(FileStorage))
+        None
+
+    Processes with other threads do not fork workers either:
+
+        >>> import threading
+        >>> class ZEOExport(ParallelJournalExport):
+        ...     def getOpener(self):
+        ...         return ('ClientStorage', (), {})
+        >>> sheets = ZEOExport(EngineStub(), workers=2)
+        >>> print sheets.getFallback(sheets.getOpener())
+        None
+
+        >>> done = threading.Event()
+        >>> thread = threading.Thread(target=done.wait)
+        >>> thread.start()
+        >>> sheets.getFallback(sheets.getOpener())
+        u'Processes with other threads can not start workers'
+        >>> done.set()
+        >>> thread.join()
+
+        >>> handler.uninstall()
+
+    """
+
+
+def doctest_getRequirementKey():
+    """Tests for getRequirementKey
+
+        >>> from schooltool.lyceum.journal.dataexport import getRequirementKey
+
+        >>> class RequirementStub(object):
+        ...     requirement_type = 'grade'
+        ...     date = datetime.date(2014, 9, 1)
+        ...     meeting_id = 'm1'
+        ...     target = ExportObjectStub('Math')
+
+    Grading targets are identified by their oids, so keys are the same
+    in all processes:
+
+        >>> RequirementStub.target._p_oid = '\\0' * 7 + '\\1'
+        >>> getRequirementKey(RequirementStub())
+        ('grade', datetime.date(2014, 9, 1), 'm1', '\\x00...\\x01')
+
+        >>> RequirementStub.target = None
+        >>> getRequirementKey(RequirementStub())
+        ('grade', datetime.date(2014, 9, 1), 'm1', None)
+
+    """
+
+
+def doctest_ParallelJournalExport_workers():
+    """Tests for exporting journals in worker processes
+
+        >>> import os, shutil, tempfile, transaction
+        >>> from ZODB.DB import DB
+        >>> from ZODB.FileStorage import FileStorage
+        >>> from zope.app.publication.zopepublication import ZopePublication
+        >>> from schooltool.lyceum.journal import dataexport
+
+        >>> provideUtility(SiteIntIdsStub())
+
+    A database with a term and two sections:
+
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs')))
+        >>> connection = db.open()
+        >>> app = ExportAppStub()
+        >>> connection.root()[ZopePublication.root_name] = app
+        >>> for name, title in [('1', 'Fall'), ('2', 'Math'), ('3', 'Art')]:
+        ...     app[name] = ExportObjectStub(title)
+        >>> transaction.commit()
+        >>> tid = db.lastTransaction()
+
+        >>> del app['3']
+        >>> transaction.commit()
+
+    Workers open the storage read-only.  In a site that is a ZEO client
+    storage, here the FileStorage is opened directly:
+
+        >>> opener = (FileStorage, (os.path.join(tmpdir, 'Data.fs'), ),
+        ...           {'read_only': True})
+
+        >>> def getSheets(engine, section):
+        ...     return [ExportSheetStub(engine, section)]
+        >>> old_getSheets = dataexport.JournalExportEngine.getSheets
+        >>> dataexport.JournalExportEngine.getSheets = getSheets
+
+        >>> class EngineStub(object):
+        ...     pass
+        >>> export = dataexport.ParallelJournalExport(EngineStub(), workers=2)
+        >>> pool = export.startPool(opener)
+
+    They read the database as of the transaction the export started at,
+    so a section removed later is still exported.  Sections that are
+    missing have no sheets.  Changed evaluations are passed along:
+
+        >>> since = datetime.datetime(2014, 9, 1)
+        >>> tasks = [(1, 'UTC', None, None, tid, [2, 3]),
+        ...          (1, 'UTC', since, set([(7, 'key')]), tid, [2, 4])]
+        >>> pool.map(dataexport.exportShard, tasks)
+        [[[('attendance', [], [('Fall', 'Math', None)])],
+          [('attendance', [], [('Fall', 'Art', None)])]],
+         [[('attendance', [], [('Fall', 'Math', set([(7, 'key')]))])],
+          []]]
+
+        >>> pool.close()
+        >>> pool.join()
+        >>> dataexport.JournalExportEngine.getSheets = old_getSheets
+        >>> transaction.abort()
+        >>> connection.close()
+        >>> db.close()
+        >>> shutil.rmtree(tmpdir)
+
+    """
+
+
+def doctest_XLSXWorkbook():
+    """Tests for XLSXWorkbook
+
+        >>> import zipfile
+        >>> from StringIO import StringIO
+        >>> from schooltool.lyceum.journal.xlsx import XLSXWorkbook
+
+        >>> workbook = XLSXWorkbook()
+        >>> sheet = workbook.add_sheet('Scores & <notes>')
+        >>> sheet.write(0, 0, 'ID', bold=True)
+        >>> sheet.write(0, 1, datetime.date(2011, 5, 5), bold=True)
+        >>> sheet.write(1, 300, u'a<b>')
+        >>> sheet.write(1, 2, 10)
+        >>> sheet.write(2, 0, '')
+
+    Rows are written to a file as soon as the next row is started,
+    going back to a written row is not allowed:
+
+        >>> sheet.write(0, 3, 'late')
+        Traceback (most recent call last):
+          ...
+        ValueError: Row 0 was already written
+
+        >>> datafile = StringIO()
+        >>> workbook.save(datafile)
+        >>> archive = zipfile.ZipFile(datafile)
+        >>> sorted(archive.namelist())
+        ['[Content_Types].xml', '_rels/.rels', 'xl/_rels/workbook.xml.rels',
+         'xl/styles.xml', 'xl/workbook.xml', 'xl/worksheets/sheet1.xml']
+
+        >>> print archive.read('xl/worksheets/sheet1.xml')
+        <?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+        <worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData><row r="1"><c r="A1" s="1" t="inlineStr"><is><t xml:space="preserve">ID</t></is></c><c r="B1" s="3"><v>40668.0</v></c></row><row r="2"><c r="C2" s="0"><v>10</v></c><c r="KO2" s="0" t="inlineStr"><is><t xml:space="preserve">a&lt;b&gt;</t></is></c></row></sheetData></worksheet>
+
+        >>> print archive.read('xl/workbook.xml')
+        <?xml ...>
+        <workbook ...>
+        <sheets>
+        <sheet name="Scores &amp; &lt;notes&gt;" sheetId="1" r:id="rId1"/>
+        </sheets>
+        </workbook>
+
+    Temporary files of the sheets are removed:
+
+        >>> import os
+        >>> os.path.exists(sheet.filename)
+        False
+
+    Only the file of the last added sheet is kept open, earlier sheets
+    are appended to if they are written to again:
+
+        >>> workbook = XLSXWorkbook()
+        >>> first = workbook.add_sheet('First')
+        >>> first.write(0, 0, 'a')
+        >>> second = workbook.add_sheet('Second')
+        >>> first.file is None, second.file is not None
+        (True, True)
+        >>> first.write(1, 0, 'b')
+        >>> first.write(2, 0, 'c')
+        >>> first.file is not None
+        True
+
+        >>> datafile = StringIO()
+        >>> workbook.save(datafile)
+        >>> archive = zipfile.ZipFile(datafile)
+        >>> print archive.read('xl/worksheets/sheet1.xml')
+        <?xml ...><row r="1">...a...</row><row r="2">...b...</row><row r="3">...c...</row></sheetData></worksheet>
+
+    Workbooks that will not be saved remove their files:
+
+        >>> workbook = XLSXWorkbook()
+        >>> sheet = workbook.add_sheet('Scores')
+        >>> sheet.write(0, 0, 'ID')
+        >>> filename = sheet.filename
+        >>> workbook.remove()
+        >>> os.path.exists(filename)
+        False
+
+    """
+
+
 def doctest_SectionJournal():
     """Tests for SectionJournal adapter:
 
@@ -308,6 +2064,7 @@ def doctest_SectionJournal_findMeeting():
 
 def setUp(test):
     setup.placelessSetUp()
+    provideUtility(IntIdsStub())
 
 
 def tearDown(test):
@@ -0,0 +1,272 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Streaming XLSX workbooks.
+
+Rows of each worksheet are written to a temporary file as they come,
+so memory use does not grow with the size of the workbook.  Workbooks
+have the same add_sheet, write and save methods as xlwt workbooks.
+"""
+import datetime
+import os
+import re
+import tempfile
+import zipfile
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+
+
+MAX_ROWS = 1048576
+MAX_COLUMNS = 16384
+
+EPOCH = datetime.datetime(1899, 12, 30)
+
+# Characters that are not allowed in XML 1.0
+_invalid_chars = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# Cell formats of styles.xml, by (bold, date)
+_styles = {
+    (False, False): 0,
+    (True, False): 1,
+    (False, True): 2,
+    (True, True): 3,
+    }
+
+STYLES_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="1"><numFmt numFmtId="164" formatCode="YYYY-MM-DD"/></numFmts>
+<fonts count="2"><font><sz val="10"/><name val="Arial"/></font><font><b/><sz val="10"/><name val="Arial"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="4">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="164" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1" applyNumberFormat="1"/>
+</cellXfs>
+</styleSheet>
+'''
+
+CONTENT_TYPES_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+%s
+</Types>
+'''
+
+SHEET_CONTENT_TYPE = '<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+
+ROOT_RELS_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>
+'''
+
+WORKBOOK_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>
+%s
+</sheets>
+</workbook>
+'''
+
+WORKBOOK_RELS_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+%s
+<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>
+'''
+
+SHEET_HEADER = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/'
+                'spreadsheetml/2006/main"><sheetData>')
+
+SHEET_FOOTER = '</sheetData></worksheet>'
+
+
+def columnName(col):
+    """Spreadsheet name of a zero based column number."""
+    name = ''
+    col += 1
+    while col:
+        col, rest = divmod(col - 1, 26)
+        name = chr(ord('A') + rest) + name
+    return name
+
+
+def cellXML(row, col, data, bold=False, format_str=None):
+    ref = '%s%d' % (columnName(col), row + 1)
+    is_date = False
+    if isinstance(data, bool):
+        return '<c r="%s" s="%d" t="b"><v>%d</v></c>' % (
+            ref, _styles[bool(bold), False], data)
+    if isinstance(data, datetime.date):
+        if not isinstance(data, datetime.datetime):
+            data = datetime.datetime(data.year, data.month, data.day)
+        delta = data.replace(tzinfo=None) - EPOCH
+        data = delta.days + delta.seconds / 86400.0
+        is_date = True
+    style = _styles[bool(bold), is_date]
+    if isinstance(data, (int, long, float, Decimal)):
+        return '<c r="%s" s="%d"><v>%s</v></c>' % (ref, style, data)
+    if not isinstance(data, unicode):
+        data = str(data).decode('UTF-8')
+    data = _invalid_chars.sub(u'', data)
+    return '<c r="%s" s="%d" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+        ref, _styles[bool(bold), False], escape(data).encode('UTF-8'))
+
+
+class XLSXWorksheet(object):
+    """A worksheet written row by row to a temporary file.
+
+    Cells of a row may be written in any order, rows must be written
+    in ascending order.  The file is only kept open while the sheet is
+    being written to, it is opened again for appending if needed.
+    """
+
+    def __init__(self, title):
+        self.title = title
+        fd, self.filename = tempfile.mkstemp(suffix='.xml')
+        self.file = os.fdopen(fd, 'wb')
+        self.file.write(SHEET_HEADER)
+        self.finished = False
+        self.row = None
+        self.cells = {}
+
+    def getFile(self):
+        if self.finished:
+            raise ValueError('Worksheet %r was already finished' % self.title)
+        if self.file is None:
+            self.file = open(self.filename, 'ab')
+        return self.file
+
+    def flush(self):
+        if self.row is None:
+            return
+        if self.cells:
+            file = self.getFile()
+            file.write('<row r="%d">' % (self.row + 1))
+            for col in sorted(self.cells):
+                file.write(self.cells[col])
+            file.write('</row>')
+        self.row = None
+        self.cells = {}
+
+    def suspend(self):
+        """Write the pending row and close the file for now."""
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, row, col, data, bold=False, format_str=None):
+        if not (0 <= row < MAX_ROWS and 0 <= col < MAX_COLUMNS):
+            raise ValueError('Cell (%d, %d) out of range' % (row, col))
+        if self.row is not None and row < self.row:
+            raise ValueError('Row %d was already written' % row)
+        if row != self.row:
+            self.flush()
+            self.row = row
+        if data is None or data == '':
+            self.cells.pop(col, None)
+            return
+        self.cells[col] = cellXML(row, col, data, bold=bold,
+                                  format_str=format_str)
+
+    def close(self):
+        if self.finished:
+            return
+        self.flush()
+        self.getFile().write(SHEET_FOOTER)
+        self.file.close()
+        self.file = None
+        self.finished = True
+
+    def remove(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.finished = True
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class XLSXWorkbook(object):
+    """A workbook that is saved as an Office Open XML spreadsheet.
+
+    Only the file of the last added sheet is kept open.  Temporary
+    files are removed when the workbook is saved, or by remove() if it
+    never will be.
+    """
+
+    def __init__(self):
+        self.sheets = []
+
+    def add_sheet(self, title):
+        if self.sheets:
+            self.sheets[-1].suspend()
+        sheet = XLSXWorksheet(title[:31])
+        self.sheets.append(sheet)
+        return sheet
+
+    def remove(self):
+        """Remove temporary files of all sheets."""
+        for sheet in self.sheets:
+            sheet.remove()
+
+    def save(self, file):
+        """Save the workbook to a file name or file and remove its sheets."""
+        if not self.sheets:
+            self.add_sheet('Sheet1')
+        try:
+            archive = zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED)
+            try:
+                self.writeArchive(archive)
+            finally:
+                archive.close()
+        finally:
+            self.remove()
+
+    def writeArchive(self, archive):
+        count = len(self.sheets)
+        archive.writestr('[Content_Types].xml', CONTENT_TYPES_XML % '\n'.join(
+            [SHEET_CONTENT_TYPE % (n + 1) for n in range(count)]))
+        archive.writestr('_rels/.rels', ROOT_RELS_XML)
+        sheets = []
+        rels = []
+        for n, sheet in enumerate(self.sheets):
+            title = sheet.title
+            if not isinstance(title, unicode):
+                title = title.decode('UTF-8')
+            sheets.append('<sheet name=%s sheetId="%d" r:id="rId%d"/>' % (
+                quoteattr(title).encode('UTF-8'), n + 1, n + 1))
+            rels.append(
+                '<Relationship Id="rId%d" Type="http://schemas.openxmlformats'
+                '.org/officeDocument/2006/relationships/worksheet" '
+                'Target="worksheets/sheet%d.xml"/>' % (n + 1, n + 1))
+        archive.writestr('xl/workbook.xml', WORKBOOK_XML % '\n'.join(sheets))
+        archive.writestr('xl/_rels/workbook.xml.rels',
+                         WORKBOOK_RELS_XML % ('\n'.join(rels), count + 1))
+        archive.writestr('xl/styles.xml', STYLES_XML)
+        for n, sheet in enumerate(self.sheets):
+            sheet.close()
+            archive.write(sheet.filename, 'xl/worksheets/sheet%d.xml' % (n + 1))